@@ -6,11 +6,21 @@ from pydantic import BaseModel
 from pydantic_ai import Agent
 from pydantic_ai.models import ModelMessage
 from pydantic_ai.result import RunResult
+
+from agents.model_router import model_router
 # from pydantic_ai.models import KnownModelName
 
 class ChatAgent():
-    agent = Agent('openai:gpt-4o', result_type=str)
+    # the model is picked by `model_router` on every run
+    agent = Agent(result_type=str)
 
     async def chat(self, message: str, messages: list[ModelMessage]) -> RunResult[str]:
-        result = await self.agent.run(message, message_history=messages)
-        return result
\ No newline at end of file
+        model = model_router.select(message)
+        result = await self.agent.run(message, message_history=messages, model=model)
+        return result
+
+    async def chat_stream(self, message: str, messages: list[ModelMessage]):
+        """Run the streaming agent while keeping resources open."""
+        model = model_router.select(message)
+        async with self.agent.run_stream(message, message_history=messages, model=model) as stream:
+            yield stream
\ No newline at end of file
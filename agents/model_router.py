@@ -0,0 +1,255 @@
+import time
+import asyncio
+import logfire
+
+from collections import deque
+from contextlib import AsyncExitStack, asynccontextmanager
+
+from pydantic_ai.messages import ModelMessage, ModelResponse
+from pydantic_ai.models import AgentModel, KnownModelName, Model, StreamedResponse, infer_model
+from pydantic_ai.settings import ModelSettings
+from pydantic_ai.usage import Usage
+
+from utils.settings import Settings, get_settings, on_reload
+
+class LatencyTracker:
+    """Rolling window of model latencies, used to decide when to hedge."""
+    window: int
+    min_samples: int
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.window = window
+        self.min_samples = min_samples
+        self.samples: dict[str, deque[float]] = {}
+
+    def record(self, key: str, seconds: float):
+        if key not in self.samples:
+            self.samples[key] = deque(maxlen=self.window)
+        self.samples[key].append(seconds)
+
+    def percentile(self, key: str, q: float) -> float | None:
+        samples = self.samples.get(key)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+    def p95(self, key: str) -> float | None:
+        return self.percentile(key, 0.95)
+
+    def snapshot(self) -> dict[str, dict]:
+        return {
+            key: {"samples": len(samples), "p50": self.percentile(key, 0.5), "p95": self.p95(key)}
+            for key, samples in self.samples.items()
+        }
+
+# shared by every agent in the process so all runs feed the same latency picture
+latency_tracker = LatencyTracker()
+
+class HedgedModel(Model):
+    """Model that sends a second request to a backup when the primary is slower than its p95.
+
+    Whichever model answers first is used and the other request is cancelled. Until the
+    tracker has enough samples, `default_delay` (full requests) and `default_stream_delay`
+    (time to first chunk) are used as the hedge threshold.
+    """
+    primary: Model
+    backup: Model
+    def __init__(
+        self,
+        primary: Model | KnownModelName,
+        backup: Model | KnownModelName,
+        tracker: LatencyTracker = latency_tracker,
+        default_delay: float = 10.0,
+        default_stream_delay: float = 2.0,
+    ):
+        self.primary = infer_model(primary)
+        self.backup = infer_model(backup)
+        self.tracker = tracker
+        self.default_delay = default_delay
+        self.default_stream_delay = default_stream_delay
+
+    async def agent_model(self, *, function_tools, allow_text_result: bool, result_tools) -> AgentModel:
+        primary, backup = await asyncio.gather(
+            self.primary.agent_model(function_tools=function_tools, allow_text_result=allow_text_result, result_tools=result_tools),
+            self.backup.agent_model(function_tools=function_tools, allow_text_result=allow_text_result, result_tools=result_tools),
+        )
+        return HedgedAgentModel(self, primary, backup)
+
+    def name(self) -> str:
+        return f'hedged:{self.primary.name()},{self.backup.name()}'
+
+async def _cancel(task: asyncio.Task):
+    task.cancel()
+    try:
+        await task
+    except BaseException:
+        pass
+
+class HedgedAgentModel(AgentModel):
+    def __init__(self, model: HedgedModel, primary: AgentModel, backup: AgentModel):
+        self.model = model
+        self.primary = primary
+        self.backup = backup
+
+    async def _timed(self, key: str, call, slow_after: float):
+        """Await `call`, recording its latency under `key`.
+
+        A call cancelled or failed (a timeout) after running `slow_after` is recorded too,
+        leaving out the slow requests that lose the race would pull the p95 down.
+        """
+        started = time.perf_counter()
+        completed = False
+        try:
+            result = await call
+            completed = True
+            return result
+        finally:
+            elapsed = time.perf_counter() - started
+            if completed or elapsed >= slow_after:
+                self.model.tracker.record(key, elapsed)
+
+    async def _race(self, key_suffix: str, default_delay: float, start) -> tuple[object, asyncio.Task | None]:
+        """Run `start(agent_model)` on the primary, hedging to the backup after the p95 delay.
+
+        Returns the winning result and the losing task, if it finished too and needs cleanup.
+        """
+        primary_key = self.model.primary.name() + key_suffix
+        backup_key = self.model.backup.name() + key_suffix
+        delay = self.model.tracker.p95(primary_key) or default_delay
+        primary_task = asyncio.create_task(self._timed(primary_key, start(self.primary), delay))
+        done, _ = await asyncio.wait({primary_task}, timeout=delay)
+        if done and primary_task.exception() is None:
+            return primary_task.result(), None
+        if done:
+            logfire.error(f'Primary model failed, falling back: {primary_task.exception()}')
+        else:
+            logfire.info(f'Hedging {primary_key} after {delay:.2f}s')
+        backup_delay = self.model.tracker.p95(backup_key) or default_delay
+        backup_task = asyncio.create_task(self._timed(backup_key, start(self.backup), backup_delay))
+        pending = {backup_task} if done else {primary_task, backup_task}
+        error: BaseException | None = primary_task.exception() if done else None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    for other in pending:
+                        await _cancel(other)
+                    loser = primary_task if task is backup_task else backup_task
+                    return task.result(), loser if loser.done() and not loser.cancelled() and loser.exception() is None else None
+        except asyncio.CancelledError:
+            # the caller went away, don't leave both requests running
+            for task in (primary_task, backup_task):
+                await _cancel(task)
+            raise
+        raise error
+
+    async def request(
+        self, messages: list[ModelMessage], model_settings: ModelSettings | None
+    ) -> tuple[ModelResponse, Usage]:
+        result, _ = await self._race('', self.model.default_delay, lambda agent_model: agent_model.request(messages, model_settings))
+        return result
+
+    @asynccontextmanager
+    async def request_stream(self, messages: list[ModelMessage], model_settings: ModelSettings | None):
+        async def open_stream(agent_model: AgentModel) -> tuple[AsyncExitStack, StreamedResponse]:
+            # entering the stream waits for the first chunk, so this races time to first token
+            stack = AsyncExitStack()
+            try:
+                response = await stack.enter_async_context(agent_model.request_stream(messages, model_settings))
+            except BaseException:
+                await stack.aclose()
+                raise
+            return stack, response
+
+        (stack, response), loser = await self._race(':stream', self.model.default_stream_delay, open_stream)
+        if loser is not None:
+            # both streams opened at the same moment, close the one we don't use
+            loser_stack, _ = loser.result()
+            await loser_stack.aclose()
+        async with stack:
+            yield response
+
+class ModelRouter:
+    """Chooses the model for each run.
+
+    Short, simple prompts go to the fast model, everything else and RAG turns to the strong
+    model. When a backup is configured for a model it is wrapped in `HedgedModel`.
+    Models are built on first use, so provider SDKs are only imported when needed.
+    A router from `from_settings()` without settings reads them on first use too.
+    """
+    def __init__(
+        self,
+        strong: KnownModelName | str = 'openai:gpt-4o',
+        fast: KnownModelName | str = 'openai:gpt-4o-mini',
+        strong_backup: str | None = None,
+        fast_backup: str | None = None,
+        simple_max_words: int = 30,
+    ):
+        self.names = {"strong": (strong, strong_backup), "fast": (fast, fast_backup)}
+        self.simple_max_words = simple_max_words
+        self._models: dict[str, Model] = {}
+        self.settings_pending = False
+
+    @classmethod
+    def from_settings(cls, settings: Settings | None = None) -> "ModelRouter":
+        """A router with the models of `settings`, of `get_settings()` on first use when None."""
+        router = cls()
+        if settings is None:
+            router.settings_pending = True
+        else:
+            router.configure(settings)
+        return router
+
+    def _ensure_configured(self):
+        if self.settings_pending:
+            self.configure(get_settings())
+
+    def configure(self, settings: Settings):
+        """Use the models of `settings`, models of unchanged names are kept."""
+        names = {
+            "strong": (settings.model_strong, settings.model_strong_backup),
+            "fast": (settings.model_fast, settings.model_fast_backup),
+        }
+        for tier, name in names.items():
+            if self.names.get(tier) != name:
+                self._models.pop(tier, None)
+        self.names = names
+        self.simple_max_words = settings.model_simple_max_words
+        self.settings_pending = False
+
+    def model(self, tier: str) -> Model:
+        self._ensure_configured()
+        if tier not in self._models:
+            name, backup = self.names[tier]
+            model = infer_model(name)
+            if backup:
+                try:
+                    model = HedgedModel(model, backup)
+                except Exception as e:
+                    # a missing API key for the backup provider should not take the primary down
+                    logfire.error(f'Backup model {backup} unavailable, not hedging {name}: {e}')
+            self._models[tier] = model
+        return self._models[tier]
+
+    def is_simple(self, prompt: str, rag: bool) -> bool:
+        words = len(prompt.split())
+        if rag:
+            # acknowledgements like "thanks, got it" don't need the documentation
+            return words <= 4 and '?' not in prompt
+        if words > self.simple_max_words or '```' in prompt:
+            return False
+        lowered = prompt.lower()
+        return not any(word in lowered for word in ('explain', 'compare', 'why', 'step by step', 'analy', 'design'))
+
+    def select(self, prompt: str, rag: bool = False) -> Model:
+        self._ensure_configured()
+        tier = "fast" if self.is_simple(prompt, rag) else "strong"
+        logfire.info('Routing to {tier} model', tier=tier)
+        return self.model(tier)
+
+# .env is read on the first run, not when the agents are imported
+model_router = ModelRouter.from_settings()
+on_reload(model_router.configure)
@@ -1,108 +1,265 @@
+import asyncio
 import logfire
 from dataclasses import dataclass
 
 from openai import AsyncOpenAI
-from dotenv import get_key
 
 from pydantic_ai import RunContext
 from pydantic_ai.result import RunResult
 from pydantic_ai.agent import Agent
+from pydantic_ai.settings import ModelSettings
 from pydantic_ai.messages import (
     ModelMessage,
 )
 
-from databases.mongo import MongoClient
+from databases.mongo import MongoClient, get_shared_client
+from databases.embedding_space import embedding_spaces
+from databases.corpus_version import corpus_versions
+from databases.search_index import group_filter, selectivity, vector_search_stage
+from utils.retrieval import embed_queries, merge_results, normalize_query, retrieval_cache
+from utils.profiling import scope
+from utils.settings import get_settings
+from agents.model_router import model_router
 
 @dataclass
 
 class Deps:
     openai: AsyncOpenAI
     mongo: MongoClient
+    # documentation group every search is narrowed to, None searches the whole corpus
+    group: str | None = None
+
+def sections_pipeline(embedding: list[float], query: dict | None = None, limit: int = 20, candidates: int | None = None) -> list[dict]:
+    return [
+        vector_search_stage(embedding, limit=limit, query=query, candidates=candidates),
+        {
+            '$project': {
+                '_id': 0,
+                'group': 1,
+                'title': 1,
+                'content': 1
+            }
+        }
+    ]
+
+async def search_by_vector(deps: Deps, embedding: list[float], group: str | None = None, limit: int = 20) -> list[dict]:
+    await embedding_spaces.ensure(deps.mongo, "doc_sections")
+    collection = deps.mongo.get_collection("doc_sections")
+    query = group_filter(group or deps.group)
+    candidates = await selectivity.num_candidates(collection, query, limit)
+    data = await collection.aggregate(sections_pipeline(embedding, query, limit, candidates))
+    rows = []
+    async for dt in data:
+        row = {
+            "group": dt["group"],
+            "title": dt["title"],
+            "content": dt["content"]
+        }
+        rows.append(row)
+    return rows
+
+async def search_sections(deps: Deps, search_query: str, group: str | None = None) -> list[dict]:
+    """Embed the search query and run the vector search against `doc_sections`."""
+    group = group or deps.group
+    version = await corpus_versions.current(deps.mongo, "doc_sections")
+    rows = retrieval_cache.get(version, "sections", search_query, group)
+    if rows is not None:
+        logfire.info('Reusing sections found earlier for {search_query=}', search_query=search_query)
+        return rows
+    with logfire.span(
+        'create embedding for {search_query=}', search_query=search_query
+    ):
+        embeddings = await embed_queries(deps.openai, [search_query])
+    rows = await search_by_vector(deps, embeddings[0], group)
+    retrieval_cache.put(version, "sections", search_query, group, rows)
+    return rows
+
+async def search_sections_many(deps: Deps, search_queries: list[str], group: str | None = None) -> list[dict]:
+    """Embed all queries in one request, search concurrently and merge the results."""
+    group = group or deps.group
+    version = await corpus_versions.current(deps.mongo, "doc_sections")
+    result_lists = [retrieval_cache.get(version, "sections", query, group) for query in search_queries]
+    missing = [query for query, rows in zip(search_queries, result_lists) if rows is None]
+    if missing:
+        with logfire.span(
+            'create embeddings for {search_queries=}', search_queries=missing
+        ):
+            embeddings = await embed_queries(deps.openai, missing)
+        searched = iter(await asyncio.gather(*(search_by_vector(deps, embedding, group) for embedding in embeddings)))
+        for i, rows in enumerate(result_lists):
+            if rows is None:
+                result_lists[i] = next(searched)
+                retrieval_cache.put(version, "sections", search_queries[i], group, result_lists[i])
+    return merge_results(result_lists)
+
+def format_sections(rows: list[dict]) -> str:
+    return '\n\n'.join(
+        f'# {row["title"]}\nDocumentation group:{row["group"]}\n\n{row["content"]}\n'
+        for row in rows
+    )
+
+def pack_context(rows: list[dict], max_chars: int = 12000) -> str:
+    """Format retrieved rows in rank order until the character budget is used up."""
+    packed = []
+    used = 0
+    for row in rows:
+        section = format_sections([row])
+        if used + len(section) > max_chars and packed:
+            break
+        packed.append(section)
+        used += len(section)
+    return '\n\n'.join(packed)
+
+class SharedOpenAI:
+    """The OpenAI client of every `MongoRagAgent`, created and instrumented once on first use.
+
+    Setting `openai` on the class or on an agent replaces it, as the benchmarks do.
+    """
+    def __init__(self):
+        self.client: AsyncOpenAI | None = None
+
+    def __get__(self, instance, owner) -> AsyncOpenAI:
+        if self.client is None:
+            self.client = AsyncOpenAI()
+            logfire.instrument_openai(self.client)
+        return self.client
 
 class MongoRagAgent():
-    agent = Agent('openai:gpt-4o', deps_type=Deps)
-    openai = AsyncOpenAI()
-    def __init__(self, mongo_uri = ""):
+    # several `retrieve` calls in one model response run concurrently, the model is picked
+    # by `model_router` on every run, so no provider client is built at import
+    agent = Agent(deps_type=Deps, model_settings=ModelSettings(parallel_tool_calls=True))
+    openai = SharedOpenAI()
+    def __init__(self, mongo_uri = "", eager: bool = False, mongo_client: MongoClient | None = None, group: str | None = None):
+        # eager mode searches with the question itself while the request is accepted, so the
+        # first model call already has the context instead of spending a round-trip on `retrieve`
+        self.eager = eager
+        self.group = group
+        self.prefetched: asyncio.Future | None = None
+        if mongo_client is not None:
+            self.mongo_client = mongo_client
+            return
         if mongo_uri == "":
-            mongo_uri = get_key(".env", "MONGO_URI")
+            mongo_uri = get_settings().mongo_uri
         if mongo_uri is None:
             logfire.error("MONGO_URI not found")
             return
-        self.mongo_client = MongoClient(mongo_uri, "pyAgent")
-    
+        self.mongo_client = get_shared_client(mongo_uri, "pyAgent")
+
+    def deps(self) -> Deps:
+        return Deps(openai=self.openai, mongo=self.mongo_client, group=self.group)
+
+    def prefetch(self, question: str):
+        """Start the eager retrieval in the background, no-op unless eager mode is on."""
+        if self.eager and self.prefetched is None:
+            self.prefetched = asyncio.create_task(search_sections(self.deps(), question))
+
+    async def build_prompt(self, question: str) -> str:
+        if not self.eager:
+            return question
+        self.prefetch(question)
+        try:
+            rows = await self.prefetched
+        except Exception as e:
+            # fall back to letting the model call `retrieve` itself
+            logfire.error(f"Eager retrieval failed: {e}")
+            return question
+        return (
+            f'{question}\n\n'
+            'Documentation sections retrieved for this question are below. Answer from them, '
+            'use the `retrieve` tool only if you need to search for something else.\n\n'
+            f'<context>\n{pack_context(rows)}\n</context>'
+        )
+
     async def run_agent(self, question: str, messages: list[ModelMessage]) -> RunResult[str]:
         """Entry point to run the agent and perform RAG based question answering."""
-        logfire.instrument_openai(self.openai)
         logfire.info('Asking "{question}"', question=question)
 
-        deps = Deps(openai=self.openai, mongo=self.mongo_client)
-        answer = await self.agent.run(question, deps=deps, message_history=messages)
-        
+        prompt = await self.build_prompt(question)
+        model = model_router.select(question, rag=True)
+        answer = await self.agent.run(prompt, deps=self.deps(), message_history=messages, model=model)
+
         return answer
     async def run_stream_agent(self, question: str, messages: list[ModelMessage]):
         """Run the streaming agent while keeping resources open."""
-        logfire.instrument_openai(self.openai)
         logfire.info('Asking "{question}"', question=question)
 
-        deps = Deps(openai=self.openai, mongo=self.mongo_client)
-    
-        async with self.agent.run_stream(question, deps=deps, message_history=messages) as stream:
+        prompt = await self.build_prompt(question)
+        model = model_router.select(question, rag=True)
+        async with self.agent.run_stream(prompt, deps=self.deps(), message_history=messages, model=model) as stream:
             yield stream
-    
+
     @agent.tool
-    async def retrieve(context: RunContext[Deps], search_query: str) -> str:
+    async def retrieve(context: RunContext[Deps], search_query: str, group: str | None = None) -> str:
         """Retrieve documentation sections based on a search query.
 
+        Sections retrieved earlier in the conversation are still in the history, don't search for them again.
+
         Args:
             context: The call context.
             search_query: The search query.
+            group: Only search this documentation group, omit to search all documentation.
         """
-        with logfire.span(
-            'create embedding for {search_query=}', search_query=search_query
-        ):
-            embedding = await context.deps.openai.embeddings.create(
-                input=search_query,
-                model='text-embedding-3-small',
-            )
-            
-
-        assert (
-            len(embedding.data) == 1
-        ), f'Expected 1 embedding, got {len(embedding.data)}, doc query: {search_query!r}'
-        embedding = embedding.data[0].embedding
-        pipeline = [
-            {
-                '$vectorSearch': {
-                    'index': 'embedding_index', 
-                    'path': 'embedding', 
-                    'filter': {}, 
-                    'queryVector': embedding, 
-                    'numCandidates': 150, 
-                    'limit': 20
-                }
-            }, 
-            {
-                '$project': {
-                    '_id': 0, 
-                    'group': 1, 
-                    'title': 1, 
-                    'content': 1
-                }
-            }
-        ]
-        context.deps.mongo.ping()
-        collection = context.deps.mongo.get_collection("doc_sections")
-        data = await collection.aggregate(pipeline)
-        # data = await context.deps.mongo.vector_search("doc_sections", pipeline)
-        rows = []
-        async for dt in data:
-            row = {
-                "group": dt["group"],
-                "title": dt["title"],
-                "content": dt["content"]
-            }
-            rows.append(row)
-        return '\n\n'.join(
-            f'# {row["title"]}\nDocumentation group:{row["group"]}\n\n{row["content"]}\n'
-            for row in rows
-        )
\ No newline at end of file
+        with scope("retrieve"):
+            rows = await search_sections(context.deps, search_query, group)
+            return format_sections(rows)
+
+    @agent.tool
+    async def retrieve_many(context: RunContext[Deps], search_queries: list[str], group: str | None = None) -> str:
+        """Retrieve documentation sections for several search queries at once.
+
+        Prefer this over calling `retrieve` repeatedly when a question needs more than one search.
+
+        Args:
+            context: The call context.
+            search_queries: The search queries.
+            group: Only search this documentation group, omit to search all documentation.
+        """
+        if not search_queries:
+            return ""
+        with scope("retrieve_many"):
+            rows = await search_sections_many(context.deps, search_queries, group)
+            return format_sections(rows)
+
+async def ask_many(agent: MongoRagAgent, questions: list[str], concurrency: int = 8):
+    """Answer a batch of questions, yielding `(index, result or exception)` as each completes.
+
+    The distinct questions not in the retrieval cache are embedded with one request and
+    searched once, each eager prompt is built from the sections found for its question and
+    a `retrieve` call repeating it hits the cache. At most `concurrency` agent runs are in
+    flight.
+    """
+    deps = agent.deps()
+    distinct = list({normalize_query(question): question for question in questions}.values())
+    with logfire.span('shared retrieval for {count} questions', count=len(distinct)):
+        version = await corpus_versions.current(deps.mongo, "doc_sections")
+        found = {question: retrieval_cache.get(version, "sections", question, agent.group) for question in distinct}
+        missing = [question for question, rows in found.items() if rows is None]
+        if missing:
+            embeddings = await embed_queries(agent.openai, missing)
+            result_lists = await asyncio.gather(*(search_by_vector(deps, embedding) for embedding in embeddings))
+            for question, rows in zip(missing, result_lists):
+                found[question] = rows
+                retrieval_cache.put(version, "sections", question, agent.group, rows)
+    sections = {normalize_query(question): rows for question, rows in found.items()}
+
+    semaphore = asyncio.Semaphore(concurrency)
+    async def answer(index: int, question: str):
+        async with semaphore:
+            run = MongoRagAgent(eager=True, mongo_client=agent.mongo_client, group=agent.group)
+            run.openai = agent.openai
+            run.prefetched = asyncio.get_running_loop().create_future()
+            run.prefetched.set_result(sections[normalize_query(question)])
+            try:
+                return index, await run.run_agent(question, [])
+            except Exception as e:
+                logfire.error(f"Batch question {index} failed: {e}")
+                return index, e
+
+    tasks = [asyncio.create_task(answer(index, question)) for index, question in enumerate(questions)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        # the client went away, don't keep answering
+        for task in tasks:
+            task.cancel()
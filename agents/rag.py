@@ -5,17 +5,18 @@ import logfire
 import re
 import unicodedata
 from dataclasses import dataclass
+from typing import AsyncIterator
 
 import asyncpg
 import httpx
 import pydantic_core
 from openai import AsyncOpenAI
 from pydantic import TypeAdapter
-from dotenv import get_key
 
 from pydantic_ai import RunContext
 from pydantic_ai.result import RunResult
 from pydantic_ai.agent import Agent
+from pydantic_ai.settings import ModelSettings
 from pydantic_ai.messages import (
     ModelMessage,
 )
@@ -23,13 +24,24 @@ from pydantic_ai.messages import (
 from databases.pg_vector import (
     database_connect as vector_db_connect, 
     setup_schema,
+    embedding_space,
     search_docs,
     create_embedding,
-    check_embedding_exists
+    create_embeddings,
+    check_embedding_exists,
+    existing_urls,
 )
-from databases.mongo import MongoClient
-logfire.configure(send_to_logfire='if-token-present', token=get_key(".env", "LOGFIRE_KEY"))
-logfire.instrument_asyncpg()
+from databases.mongo import MongoClient, get_shared_client
+from databases.embedding_space import embedding_spaces
+from databases.corpus_version import corpus_versions
+from databases.search_index import group_filter, selectivity, vector_search_stage
+from utils.vectors import vector_literal
+from utils.embedders import check_space, embed_texts, embedding_provider
+from utils.json_stream import iter_file, iter_json_array
+from utils.retrieval import embed_queries, merge_results, retrieval_cache
+from utils.profiling import scope
+from agents.model_router import model_router
+from utils.settings import get_settings
 
 @dataclass
 class Deps:
@@ -37,43 +49,14 @@ class Deps:
     pool: asyncpg.Pool
 
 
-agent = Agent('openai:gpt-4o', deps_type=Deps)
+# several `retrieve` calls in one model response run concurrently, the model is picked
+# by `model_router` on every run
+agent = Agent(deps_type=Deps, model_settings=ModelSettings(parallel_tool_calls=True))
 
 
-@agent.tool
-async def retrieve(context: RunContext[Deps], search_query: str) -> str:
-    """Retrieve documentation sections based on a search query.
-
-    Args:
-        context: The call context.
-        search_query: The search query.
-    """
-    with logfire.span(
-        'create embedding for {search_query=}', search_query=search_query
-    ):
-        embedding = await context.deps.openai.embeddings.create(
-            input=search_query,
-            model='text-embedding-3-small',
-        )
-        
-
-    assert (
-        len(embedding.data) == 1
-    ), f'Expected 1 embedding, got {len(embedding.data)}, doc query: {search_query!r}'
-    embedding = embedding.data[0].embedding
-    # embedding_json = pydantic_core.to_json(embedding).decode()
-    # rows = await search_docs(context.deps.pool, embedding_json)
-    pipeline = [
-        {
-            '$vectorSearch': {
-                'index': 'embedding_index', 
-                'path': 'embedding', 
-                'filter': {}, 
-                'queryVector': embedding, 
-                'numCandidates': 150, 
-                'limit': 20
-            }
-        }, 
+def docs_pipeline(embedding: list[float], query: dict | None = None, limit: int = 20, candidates: int | None = None) -> list[dict]:
+    return [
+        vector_search_stage(embedding, limit=limit, query=query, candidates=candidates), 
         {
             '$project': {
                 '_id': 0, 
@@ -83,13 +66,24 @@ async def retrieve(context: RunContext[Deps], search_query: str) -> str:
             }
         }
     ]
-    mongo_uri = get_key(".env", "MONGO_URI")
+
+
+def docs_client() -> MongoClient | None:
+    mongo_uri = get_settings().mongo_uri
     if mongo_uri is None:
         logfire.error("MONGO_URI not found in .env file")
-        return
-    mongo_client = MongoClient(mongo_uri, "pyAgent")
-    mongo_client.ping()
-    data = await mongo_client.vector_search("doc_sections", pipeline)
+        return None
+    return get_shared_client(mongo_uri, "pyAgent")
+
+
+async def search_by_vector(mongo_client: MongoClient, embedding: list[float], group: str | None = None, limit: int = 20) -> list[dict]:
+    # embedding_json = pydantic_core.to_json(embedding).decode()
+    # rows = await search_docs(context.deps.pool, embedding_json)
+    await embedding_spaces.ensure(mongo_client, "doc_sections")
+    collection = mongo_client.get_collection("doc_sections")
+    query = group_filter(group)
+    candidates = await selectivity.num_candidates(collection, query, limit)
+    data = await collection.aggregate(docs_pipeline(embedding, query, limit, candidates))
     rows = []
     async for dt in data:
         row = {
@@ -98,18 +92,84 @@ async def retrieve(context: RunContext[Deps], search_query: str) -> str:
             "content": dt["content"]
         }
         rows.append(row)
+    return rows
+
+
+def format_docs(rows: list[dict]) -> str:
     return '\n\n'.join(
         f'# {row["title"]}\nDocumentation URL:{row["slug"]}\n\n{row["content"]}\n'
         for row in rows
     )
 
+
+@agent.tool
+async def retrieve(context: RunContext[Deps], search_query: str, group: str | None = None) -> str:
+    """Retrieve documentation sections based on a search query.
+
+    Sections retrieved earlier in the conversation are still in the history, don't search for them again.
+
+    Args:
+        context: The call context.
+        search_query: The search query.
+        group: Only search this documentation group, omit to search all documentation.
+    """
+    with scope("retrieve"):
+        mongo_client = docs_client()
+        if mongo_client is None:
+            return ''
+        version = await corpus_versions.current(mongo_client, "doc_sections")
+        rows = retrieval_cache.get(version, "docs", search_query, group)
+        if rows is None:
+            with logfire.span(
+                'create embedding for {search_query=}', search_query=search_query
+            ):
+                embeddings = await embed_queries(context.deps.openai, [search_query])
+            rows = await search_by_vector(mongo_client, embeddings[0], group)
+            retrieval_cache.put(version, "docs", search_query, group, rows)
+        return format_docs(rows)
+
+
+@agent.tool
+async def retrieve_many(context: RunContext[Deps], search_queries: list[str], group: str | None = None) -> str:
+    """Retrieve documentation sections for several search queries at once.
+
+    Prefer this over calling `retrieve` repeatedly when a question needs more than one search.
+
+    Args:
+        context: The call context.
+        search_queries: The search queries.
+        group: Only search this documentation group, omit to search all documentation.
+    """
+    if not search_queries:
+        return ''
+    with scope("retrieve_many"):
+        mongo_client = docs_client()
+        if mongo_client is None:
+            return ''
+        version = await corpus_versions.current(mongo_client, "doc_sections")
+        result_lists = [retrieval_cache.get(version, "docs", query, group) for query in search_queries]
+        missing = [query for query, rows in zip(search_queries, result_lists) if rows is None]
+        if missing:
+            with logfire.span(
+                'create embeddings for {search_queries=}', search_queries=missing
+            ):
+                embeddings = await embed_queries(context.deps.openai, missing)
+            searched = iter(await asyncio.gather(*(search_by_vector(mongo_client, embedding, group) for embedding in embeddings)))
+            for i, rows in enumerate(result_lists):
+                if rows is None:
+                    result_lists[i] = next(searched)
+                    retrieval_cache.put(version, "docs", search_queries[i], group, result_lists[i])
+        rows = merge_results(result_lists, key=lambda row: row["slug"])
+        return format_docs(rows)
+
 async def run_stream_agent(question: str, messages: list[ModelMessage]):
     """Run the streaming agent while keeping resources open."""
     openai = AsyncOpenAI()
     
     async with vector_db_connect(False) as pool:
         deps = Deps(openai=openai, pool=pool)
-        async with agent.run_stream(question, deps=deps, message_history=messages) as stream:
+        model = model_router.select(question, rag=True)
+        async with agent.run_stream(question, deps=deps, message_history=messages, model=model) as stream:
             yield stream
     
 
@@ -123,26 +183,40 @@ async def run_agent(question: str, messages: list[ModelMessage]) -> RunResult[st
 
     async with vector_db_connect(False) as pool:
         deps = Deps(openai=openai, pool=pool)
-        answer = await agent.run(question, deps=deps, message_history=messages)
+        model = model_router.select(question, rag=True)
+        answer = await agent.run(question, deps=deps, message_history=messages, model=model)
     
     return answer
 
-async def build_search_db():
-    """Build the search database."""
-    doc_json = get_key(".env", "DOCS_JSON")
-    if doc_json == "":
+async def build_search_db(streaming: bool = True, workers: int = 4, batch_size: int = 32):
+    """Build the search database.
+
+    In streaming mode `DOCS_JSON`, a URL or a local file, is parsed section by section
+    into a bounded queue that `workers` embedding workers drain `batch_size` sections
+    at a time, so build memory depends on the workers and not on the corpus size.
+    """
+    doc_json = get_settings().docs_json
+    if not doc_json:
         raise ValueError('DOCS_JSON not set in .env file')
-    async with httpx.AsyncClient() as client:
-        response = await client.get(doc_json)
-        response.raise_for_status()
-    sections = sessions_ta.validate_json(response.content)
 
     openai = AsyncOpenAI()
     logfire.instrument_openai(openai)
 
+    embedder = embedding_provider()
     async with vector_db_connect(True) as pool:
         with logfire.span('create schema'):
-            await setup_schema(pool)
+            await setup_schema(pool, embedder.dimensions)
+            provider, dimensions = await embedding_space(pool, "doc_sections", embedder.name, embedder.dimensions)
+        check_space("doc_sections", provider, dimensions, embedder)
+
+        if streaming:
+            await stream_doc_sections(doc_json, openai, pool, workers, batch_size)
+            return
+
+        async with httpx.AsyncClient() as client:
+            response = await client.get(doc_json)
+            response.raise_for_status()
+        sections = sessions_ta.validate_json(response.content)
 
         sem = asyncio.Semaphore(10)
         async with asyncio.TaskGroup() as tg:
@@ -164,17 +238,77 @@ async def insert_doc_section(
             return
 
         with logfire.span('create embedding for {url=}', url=url):
-            embedding = await openai.embeddings.create(
-                input=section.embedding_content(),
-                model='text-embedding-3-small',
-            )
-        assert (
-            len(embedding.data) == 1
-        ), f'Expected 1 embedding, got {len(embedding.data)}, doc section: {section}'
-        embedding = embedding.data[0].embedding
-        embedding_json = pydantic_core.to_json(embedding).decode()
+            embeddings = await embed_texts(openai, [section.embedding_content()])
         
-        await create_embedding(pool, url, section.title, section.content, embedding_json)
+        await create_embedding(pool, url, section.title, section.content, vector_literal(embeddings[0]))
+
+
+async def iter_doc_sections(doc_json: str) -> AsyncIterator[DocsSection]:
+    """Parse the sections of `doc_json` one at a time as it is downloaded or read."""
+    if doc_json.startswith(('http://', 'https://')):
+        async with httpx.AsyncClient() as client:
+            async with client.stream('GET', doc_json) as response:
+                response.raise_for_status()
+                async for item in iter_json_array(response.aiter_bytes()):
+                    yield section_ta.validate_python(item)
+    else:
+        async for item in iter_json_array(iter_file(doc_json)):
+            yield section_ta.validate_python(item)
+
+
+async def stream_doc_sections(
+    doc_json: str,
+    openai: AsyncOpenAI,
+    pool: asyncpg.Pool,
+    workers: int = 4,
+    batch_size: int = 32,
+) -> None:
+    # the parser waits while the queue is full, at most this many sections are in flight
+    queue: asyncio.Queue[DocsSection | None] = asyncio.Queue(maxsize=workers * batch_size)
+
+    async def produce():
+        with logfire.span('parse {doc_json=}', doc_json=doc_json):
+            async for section in iter_doc_sections(doc_json):
+                await queue.put(section)
+        for _ in range(workers):
+            await queue.put(None)
+
+    async def work():
+        done = False
+        while not done:
+            batch: list[DocsSection] = []
+            section = await queue.get()
+            while section is not None:
+                batch.append(section)
+                if len(batch) == batch_size or queue.empty():
+                    break
+                section = queue.get_nowait()
+            # every worker takes exactly one of the end markers
+            done = section is None
+            if batch:
+                await insert_doc_sections(openai, pool, batch)
+
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(produce())
+        for _ in range(workers):
+            tg.create_task(work())
+
+
+async def insert_doc_sections(openai: AsyncOpenAI, pool: asyncpg.Pool, sections: list[DocsSection]) -> None:
+    """Embed the sections that aren't stored yet with one request and write them with one statement."""
+    by_url = {section.url(): section for section in sections}
+    existing = await existing_urls(pool, list(by_url))
+    if existing:
+        logfire.info('Skipping {count} stored sections', count=len(existing))
+    new = [(url, section) for url, section in by_url.items() if url not in existing]
+    if not new:
+        return
+    with logfire.span('create embeddings for {count} sections', count=len(new)):
+        embeddings = await embed_texts(openai, [section.embedding_content() for _, section in new])
+    await create_embeddings(pool, [
+        (url, section.title, section.content, vector_literal(embedding))
+        for (url, section), embedding in zip(new, embeddings)
+    ])
 
 
 @dataclass
@@ -197,6 +331,7 @@ class DocsSection:
 
 
 sessions_ta = TypeAdapter(list[DocsSection])
+section_ta = TypeAdapter(DocsSection)
 
 
 def slugify(value: str, separator: str, unicode: bool = False) -> str:
@@ -0,0 +1,80 @@
+"""Wall time of answering a list of questions, one `/learning/ask` call each vs one batch.
+
+The sequential side runs the eager agent once per question, as a client looping over
+`/learning/ask` does. The batch side runs `ask_many`, which `/learning/ask/batch` streams.
+Both use the stub LLM and the local vector stand-in, so the numbers only depend on the
+simulated latencies given on the command line.
+
+    python -m benchmarks.batch_ask --questions 50 --concurrency 8
+"""
+import os
+import time
+import asyncio
+import argparse
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+os.environ.setdefault("LOGFIRE_IGNORE_NO_CONFIG", "1")
+
+from agents.mongo_rag import MongoRagAgent, ask_many
+from databases.local_vector import LocalMongoClient
+from utils.retrieval import embedding_cache, retrieval_cache
+from utils.embedders import OpenAIEmbedder, set_embedding_provider
+from benchmarks.stubs import StubOpenAI, stub_llm
+from benchmarks.eager_retrieval import QUESTIONS, seed_corpus
+
+def batch_questions(count: int) -> list[str]:
+    # a few repeats, as in a list of questions collected from users
+    return [f"{QUESTIONS[i % len(QUESTIONS)]} ({i % (count * 3 // 4 or 1)})" for i in range(count)]
+
+async def sequential(mongo: LocalMongoClient, openai: StubOpenAI, questions: list[str]) -> float:
+    started = time.perf_counter()
+    for question in questions:
+        agent = MongoRagAgent(eager=True, mongo_client=mongo)
+        agent.openai = openai
+        await agent.run_agent(question, [])
+    return time.perf_counter() - started
+
+async def batch(mongo: LocalMongoClient, openai: StubOpenAI, questions: list[str], concurrency: int) -> float:
+    started = time.perf_counter()
+    agent = MongoRagAgent(mongo_client=mongo)
+    agent.openai = openai
+    async for _, result in ask_many(agent, questions, concurrency):
+        if isinstance(result, Exception):
+            raise result
+    return time.perf_counter() - started
+
+async def run(args):
+    # every run pays for its embeddings and searches, as the first request of a question does
+    embedding_cache.ttl = 0
+    retrieval_cache.ttl = 0
+    set_embedding_provider(OpenAIEmbedder(dimensions=args.dims))
+    mongo = LocalMongoClient(latency=args.search_latency)
+    seed_corpus(mongo, args.sections, args.dims)
+    questions = batch_questions(args.questions)
+    model = stub_llm(first_token_latency=args.llm_latency)
+
+    print(f"{'mode':<12}{'wall s':>10}{'per question s':>16}{'embedding calls':>17}")
+    timings = {}
+    with MongoRagAgent.agent.override(model=model):
+        for mode in ("sequential", "batch"):
+            openai = StubOpenAI(latency=args.embedding_latency, dims=args.dims)
+            if mode == "sequential":
+                timings[mode] = await sequential(mongo, openai, questions)
+            else:
+                timings[mode] = await batch(mongo, openai, questions, args.concurrency)
+            print(f"{mode:<12}{timings[mode]:>10.2f}{timings[mode] / len(questions):>16.3f}{openai.embeddings.calls:>17}")
+    print(f"batch is {timings['sequential'] / timings['batch']:.1f}x faster")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--questions", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--sections", type=int, default=500)
+    parser.add_argument("--dims", type=int, default=64)
+    parser.add_argument("--llm-latency", type=float, default=0.4, help="stub LLM response latency")
+    parser.add_argument("--embedding-latency", type=float, default=0.05)
+    parser.add_argument("--search-latency", type=float, default=0.03)
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
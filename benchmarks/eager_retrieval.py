@@ -0,0 +1,93 @@
+"""Time-to-first-token of `MongoRagAgent` with and without eager retrieval.
+
+Runs the streaming agent against the stub LLM and the local vector stand-in, so
+the numbers only depend on the simulated latencies given on the command line.
+
+    python -m benchmarks.eager_retrieval --runs 10 --llm-latency 0.4
+"""
+import os
+import time
+import asyncio
+import argparse
+import statistics
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+os.environ.setdefault("LOGFIRE_IGNORE_NO_CONFIG", "1")
+
+from agents.mongo_rag import MongoRagAgent
+from databases.local_vector import LocalMongoClient
+from utils.retrieval import embedding_cache, retrieval_cache
+from utils.embedders import OpenAIEmbedder, set_embedding_provider
+from benchmarks.stubs import StubOpenAI, hash_vector, stub_llm
+
+QUESTIONS = [
+    "how do I refresh the access token",
+    "which headers are required for the transfer api",
+    "what does error code 4010 mean",
+]
+
+def seed_corpus(mongo: LocalMongoClient, sections: int, dims: int):
+    collection = mongo.get_collection("doc_sections")
+    for i in range(sections):
+        content = f"section {i} about token refresh headers transfer error code {i % 50}"
+        collection.docs.append({
+            "group": "ocbc-doc-tech",
+            "title": f"doc-{i % 20}.md",
+            "content": content,
+            "embedding": hash_vector(content, dims),
+        })
+
+async def time_to_first_token(agent: MongoRagAgent, question: str) -> float:
+    started = time.perf_counter()
+    # what post_chat does when the request is accepted
+    agent.prefetch(question)
+    first_token = None
+    async for stream in agent.run_stream_agent(question, messages=[]):
+        # drain the stream so the run closes the same way it does in post_chat
+        async for _ in stream.stream(debounce_by=None):
+            if first_token is None:
+                first_token = time.perf_counter() - started
+    if first_token is None:
+        raise RuntimeError("stream produced no text")
+    return first_token
+
+async def run(args):
+    # every run pays for its embeddings and searches, as the first request of a question does
+    embedding_cache.ttl = 0
+    retrieval_cache.ttl = 0
+    # the stub answers like the OpenAI API, with vectors of the corpus size
+    set_embedding_provider(OpenAIEmbedder(dimensions=args.dims))
+    mongo = LocalMongoClient(latency=args.search_latency)
+    seed_corpus(mongo, args.sections, args.dims)
+    openai = StubOpenAI(latency=args.embedding_latency, dims=args.dims)
+    model = stub_llm(first_token_latency=args.llm_latency)
+
+    results: dict[str, list[float]] = {"tool": [], "eager": []}
+    with MongoRagAgent.agent.override(model=model):
+        for _ in range(args.runs):
+            for question in QUESTIONS:
+                for mode in results:
+                    agent = MongoRagAgent(eager=mode == "eager", mongo_client=mongo)
+                    agent.openai = openai
+                    results[mode].append(await time_to_first_token(agent, question))
+
+    print(f"{'mode':<8}{'p50 ttft':>12}{'p95 ttft':>12}")
+    for mode, values in results.items():
+        values.sort()
+        p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+        print(f"{mode:<8}{statistics.median(values):>12.3f}{p95:>12.3f}")
+    saved = statistics.median(results["tool"]) - statistics.median(results["eager"])
+    print(f"eager retrieval saves {saved:.3f}s at the median")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--sections", type=int, default=500)
+    parser.add_argument("--dims", type=int, default=64)
+    parser.add_argument("--llm-latency", type=float, default=0.4, help="stub LLM time to first token")
+    parser.add_argument("--embedding-latency", type=float, default=0.05)
+    parser.add_argument("--search-latency", type=float, default=0.03)
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
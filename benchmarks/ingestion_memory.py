@@ -0,0 +1,63 @@
+"""Peak memory of a batch of ingested sections, float lists vs float32 buffers.
+
+Builds `--sections` sections of `--dims` dimensions the way the ingestion path does
+and measures the peak with tracemalloc, up to the documents handed to the writer:
+the `list` rows are what decoding the JSON `float` response and `to_dict()` used to
+keep, the `float32` rows decode the `base64` response into a `DocSection` buffer.
+
+    python -m benchmarks.ingestion_memory --sections 2000
+"""
+import json
+import base64
+import random
+import argparse
+import tracemalloc
+
+from array import array
+
+from models import DocSection
+from utils.vectors import decode_base64
+
+def float_payload(dims: int) -> str:
+    return json.dumps([random.uniform(-0.1, 0.1) for _ in range(dims)])
+
+def base64_payload(dims: int) -> str:
+    return base64.b64encode(array("f", (random.uniform(-0.1, 0.1) for _ in range(dims))).tobytes()).decode()
+
+def with_lists(payloads: list[str]) -> list[dict]:
+    docs = []
+    for i, payload in enumerate(payloads):
+        embedding = json.loads(payload)
+        # the old to_dict() kept the list, the bulk write then held every one of them
+        docs.append({"group": "g", "title": f"doc-{i}", "content": "x" * 800, "embedding": list(embedding)})
+    return docs
+
+def with_buffers(payloads: list[str]) -> list[dict]:
+    return [
+        DocSection(group="g", title=f"doc-{i}", content="x" * 800, embedding=decode_base64(payload)).to_dict()
+        for i, payload in enumerate(payloads)
+    ]
+
+def peak(build, payloads: list[str]) -> int:
+    tracemalloc.start()
+    docs = build(payloads)
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del docs
+    return peak_bytes
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sections", type=int, default=2000)
+    parser.add_argument("--dims", type=int, default=1536)
+    args = parser.parse_args()
+
+    lists = peak(with_lists, [float_payload(args.dims) for _ in range(args.sections)])
+    buffers = peak(with_buffers, [base64_payload(args.dims) for _ in range(args.sections)])
+    print(f"{'representation':<16}{'peak MB':>10}{'per section KB':>16}")
+    for name, value in (("list", lists), ("float32", buffers)):
+        print(f"{name:<16}{value / 2**20:>10.1f}{value / args.sections / 1024:>16.1f}")
+    print(f"{lists / buffers:.1f}x less memory")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Page load cost of the chat app, cold and warm.
+
+Fetches the page the way a browser does, in-process against the ASGI app: the
+HTML, then every script it references from this server. A warm load revalidates
+the HTML with its ETag and skips immutable assets entirely. Without a build
+(`python -m services.frontend`) this measures the in-browser compile fallback,
+whose TypeScript compiler download from the CDN is reported separately.
+
+    python -m benchmarks.page_load --runs 20
+"""
+import os
+import re
+import time
+import asyncio
+import argparse
+import statistics
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+os.environ.setdefault("LOGFIRE_IGNORE_NO_CONFIG", "1")
+
+import httpx
+
+from main import app
+
+SCRIPT_SRC = re.compile(rb'<script[^>]*src="([^"]+)"')
+HEADERS = {"accept-encoding": "gzip, br"}
+
+class BrowserCache:
+    def __init__(self):
+        self.html = b""
+        self.html_etag = ""
+        self.immutable: set[str] = set()
+
+def wire_bytes(response: httpx.Response) -> int:
+    # httpx decodes the body, count what was sent
+    return int(response.headers.get("content-length", len(response.content)))
+
+async def load(client: httpx.AsyncClient, cache: BrowserCache) -> tuple[float, int, int]:
+    """Load the page once, returns seconds, bytes on the wire and number of requests."""
+    started = time.perf_counter()
+    headers = dict(HEADERS)
+    if cache.html_etag:
+        headers["if-none-match"] = cache.html_etag
+    response = await client.get("/", headers=headers)
+    transferred = wire_bytes(response)
+    requests = 1
+    if response.status_code == 200:
+        cache.html = response.content
+        cache.html_etag = response.headers.get("etag", "")
+    scripts = [src.decode() for src in SCRIPT_SRC.findall(cache.html) if src.startswith(b"/")]
+    if b"/chat_app.ts" in cache.html:
+        # the fallback loader fetches the raw TypeScript itself
+        scripts.append("/chat_app.ts")
+    for src in scripts:
+        if src in cache.immutable:
+            continue
+        response = await client.get(src, headers=HEADERS)
+        transferred += wire_bytes(response)
+        requests += 1
+        if "immutable" in response.headers.get("cache-control", ""):
+            cache.immutable.add(src)
+    return time.perf_counter() - started, transferred, requests
+
+async def run(args):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        results: dict[str, list[tuple[float, int, int]]] = {"cold": [], "warm": []}
+        for _ in range(args.runs):
+            cache = BrowserCache()
+            results["cold"].append(await load(client, cache))
+            results["warm"].append(await load(client, cache))
+        html = (await client.get("/")).content
+
+    print(f"{'load':<8}{'p50 ms':>10}{'bytes':>10}{'requests':>10}")
+    for name, values in results.items():
+        seconds = statistics.median(v[0] for v in values) * 1000
+        print(f"{name:<8}{seconds:>10.2f}{values[-1][1]:>10}{values[-1][2]:>10}")
+    if b"typescript.min.js" in html:
+        print("no compiled bundle: every cold load also downloads and runs the TypeScript compiler from the CDN")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=20)
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""Replay captured traffic and report latency distributions.
+
+Reads the JSONL written by `services.capture.TrafficCapture`, rotated files included,
+and sends every request at its original offset from the first one, divided by
+`--speed`: 1 keeps the captured arrival times, 4 plays the same load shape four
+times as fast. Requests whose body was too large to capture are skipped.
+
+Against a running instance:
+
+    python -m benchmarks.replay --capture ./captures --target http://localhost:8000 --speed 2
+
+or in process against the stub LLM and the local vector stand-in, where the numbers
+only depend on the simulated latencies. The in-process transport buffers responses,
+there the time to first byte is the full duration:
+
+    python -m benchmarks.replay --capture ./captures --local --llm-latency 0.4
+"""
+import os
+import json
+import time
+import asyncio
+import argparse
+import statistics
+
+from pathlib import Path
+from contextlib import ExitStack
+
+os.environ.setdefault("LOGFIRE_IGNORE_NO_CONFIG", "1")
+
+import httpx
+
+from services.capture import capture_files
+
+def load_capture(path: Path) -> list[dict]:
+    files = capture_files(path) if path.is_dir() else [path]
+    records = []
+    for file in files:
+        with open(file, encoding="utf-8") as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    records.sort(key=lambda record: record["arrived"])
+    return records
+
+def percentile(values: list[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+class Result:
+    endpoint: str
+    status: int | None
+    first_byte: float | None
+    duration: float
+    lag: float
+    def __init__(self, endpoint: str, status: int | None, first_byte: float | None, duration: float, lag: float):
+        self.endpoint = endpoint
+        self.status = status
+        self.first_byte = first_byte
+        self.duration = duration
+        # how late the request was sent compared to the schedule, the replayer keeping up
+        self.lag = lag
+
+async def send(client: httpx.AsyncClient, record: dict, due: float) -> Result:
+    endpoint = f'{record["method"]} {record["path"]}'
+    started = time.perf_counter()
+    lag = started - due
+    url = record["path"] + (f'?{record["query"]}' if record["query"] else "")
+    headers = {"content-type": record["content_type"]} if record["content_type"] else {}
+    body = record["body"].encode("utf-8") if record["body"] else None
+    first_byte = None
+    try:
+        async with client.stream(record["method"], url, content=body, headers=headers) as response:
+            async for chunk in response.aiter_raw():
+                if first_byte is None and chunk:
+                    first_byte = time.perf_counter() - started
+            status = response.status_code
+    except httpx.HTTPError:
+        status = None
+    return Result(endpoint, status, first_byte, time.perf_counter() - started, lag)
+
+async def replay(client: httpx.AsyncClient, records: list[dict], speed: float) -> list[Result]:
+    first = records[0]["arrived"]
+    started = time.perf_counter()
+    tasks = []
+    for record in records:
+        due = started + (record["arrived"] - first) / speed
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(send(client, record, due)))
+    return await asyncio.gather(*tasks)
+
+def report(records: list[dict], results: list[Result], as_json: bool):
+    captured: dict[str, list[float]] = {}
+    for record in records:
+        captured.setdefault(f'{record["method"]} {record["path"]}', []).append(record["duration"])
+    rows = []
+    for endpoint in sorted({result.endpoint for result in results}):
+        mine = [result for result in results if result.endpoint == endpoint]
+        durations = [result.duration for result in mine]
+        first_bytes = [result.first_byte for result in mine if result.first_byte is not None] or [0.0]
+        rows.append({
+            "endpoint": endpoint,
+            "count": len(mine),
+            # 503s are load shed by admission control, not failures
+            "shed": sum(1 for result in mine if result.status == 503),
+            "errors": sum(1 for result in mine if result.status is None or (result.status >= 500 and result.status != 503)),
+            "ttfb_p50": percentile(first_bytes, 0.5),
+            "ttfb_p99": percentile(first_bytes, 0.99),
+            "p50": percentile(durations, 0.5),
+            "p90": percentile(durations, 0.9),
+            "p99": percentile(durations, 0.99),
+            "max": max(durations),
+            "captured_p50": percentile(captured[endpoint], 0.5),
+            "captured_p99": percentile(captured[endpoint], 0.99),
+        })
+    lags = [result.lag for result in results]
+    if as_json:
+        print(json.dumps({"endpoints": rows, "lag_p99": percentile(lags, 0.99)}, indent=2))
+        return
+    print(f"{'endpoint':<24}{'n':>5}{'shed':>6}{'err':>5}{'ttfb p50':>10}{'ttfb p99':>10}{'p50':>8}{'p90':>8}{'p99':>8}{'max':>8}{'capt p50':>10}{'capt p99':>10}")
+    for row in rows:
+        print(
+            f"{row['endpoint']:<24}{row['count']:>5}{row['shed']:>6}{row['errors']:>5}{row['ttfb_p50']:>10.3f}{row['ttfb_p99']:>10.3f}"
+            f"{row['p50']:>8.3f}{row['p90']:>8.3f}{row['p99']:>8.3f}{row['max']:>8.3f}{row['captured_p50']:>10.3f}{row['captured_p99']:>10.3f}"
+        )
+    print(f"send lag p50 {statistics.median(lags) * 1000:.1f}ms, p99 {percentile(lags, 0.99) * 1000:.1f}ms")
+
+def local_app(args):
+    """The app wired to the stand-ins, as the other benchmarks do, with capture turned off."""
+    os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+    import main
+    import models
+    from agents import mongo_rag
+    from agents.chat import ChatAgent
+    from databases.memory import engine
+    from databases.local_vector import LocalMongoClient
+    from services.capture import TrafficCapture
+    from benchmarks.stubs import StubOpenAI, stub_llm
+    from benchmarks.eager_retrieval import seed_corpus
+    from utils.embedders import OpenAIEmbedder, set_embedding_provider
+
+    models.Base.metadata.create_all(bind=engine)
+    mongo = LocalMongoClient(latency=args.search_latency)
+    seed_corpus(mongo, args.sections, args.dims)
+    set_embedding_provider(OpenAIEmbedder(dimensions=args.dims))
+    mongo_rag.MongoRagAgent.openai = StubOpenAI(latency=args.embedding_latency, dims=args.dims)
+    mongo_rag.MongoRagAgent.mongo_client = mongo
+    mongo_rag.get_shared_client = lambda uri, database: mongo
+    overrides = [
+        mongo_rag.MongoRagAgent.agent.override(model=stub_llm(first_token_latency=args.llm_latency)),
+        ChatAgent.agent.override(model=stub_llm(first_token_latency=args.llm_latency, retrieve=False)),
+    ]
+    main.app.user_middleware = [m for m in main.app.user_middleware if m.cls is not TrafficCapture]
+    return main.app, overrides
+
+async def run(args):
+    records = load_capture(Path(args.capture))
+    replayable = [record for record in records if record["body"] is not None or not record["body_bytes"]]
+    if args.limit:
+        replayable = replayable[:args.limit]
+    if not replayable:
+        raise SystemExit(f"Nothing to replay in {args.capture}")
+    if len(replayable) < len(records):
+        print(f"skipping {len(records) - len(replayable)} requests without a replayable body")
+    span = replayable[-1]["arrived"] - replayable[0]["arrived"]
+    print(f"replaying {len(replayable)} requests over {span / args.speed:.1f}s (captured {span:.1f}s, speed {args.speed}x)")
+
+    timeout = httpx.Timeout(args.timeout)
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    if args.local:
+        app, overrides = local_app(args)
+        with ExitStack() as stack:
+            for override in overrides:
+                stack.enter_context(override)
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://replay", timeout=timeout) as client:
+                results = await replay(client, replayable, args.speed)
+    else:
+        async with httpx.AsyncClient(base_url=args.target, timeout=timeout, limits=limits) as client:
+            results = await replay(client, replayable, args.speed)
+    report(replayable, results, args.json)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--capture", default="./captures", help="capture directory or a single JSONL file")
+    parser.add_argument("--target", default="http://localhost:8000")
+    parser.add_argument("--local", action="store_true", help="replay in process against the stand-ins")
+    parser.add_argument("--speed", type=float, default=1.0, help="divides the captured inter-arrival times")
+    parser.add_argument("--limit", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--sections", type=int, default=500)
+    parser.add_argument("--dims", type=int, default=64)
+    parser.add_argument("--llm-latency", type=float, default=0.4, help="stub LLM time to first token")
+    parser.add_argument("--embedding-latency", type=float, default=0.05)
+    parser.add_argument("--search-latency", type=float, default=0.03)
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
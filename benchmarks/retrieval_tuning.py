@@ -0,0 +1,404 @@
+"""Recall and latency of the retrieval settings, swept per backend.
+
+Every combination of chunking, `limit`, candidate count (`numCandidates` on Atlas,
+the rerank window for binary quantization), HNSW `ef_search` (pgvector) and
+quantization mode is run over a labelled query set. The report has recall@k,
+MRR, p50/p99 search latency and the prompt tokens the retrieved sections cost
+per answer. Rows marked `*` are on the Pareto front: no other setting is at
+least as good on all four of recall, MRR, p99 and tokens.
+
+    python -m benchmarks.retrieval_tuning --corpus ./uploads/md --queries queries.jsonl \\
+        --backend local --backend mongo --backend pgvector
+
+The query set is JSON lines, `{"query": "...", "answers": ["text that answers it"]}`.
+A retrieved section is relevant when it contains one of the answers (case and
+whitespace normalised), so the labels hold whatever the chunking. `mongo` and
+`pgvector` load each chunking into a scratch `tuning_sections` collection/table
+and build their own indexes, nothing in `doc_sections` is touched.
+"""
+import os
+import re
+import json
+import time
+import asyncio
+import argparse
+import statistics
+
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+# a real key from .env wins, the placeholder only lets `--stub-embeddings` run without one
+load_dotenv()
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+os.environ.setdefault("LOGFIRE_IGNORE_NO_CONFIG", "1")
+
+from agents.mongo_rag import format_sections
+from databases.local_vector import cosine_similarity
+from databases.search_index import ensure_vector_index, vector_index_definition, vector_search_stage
+from utils.settings import get_settings
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+SCRATCH = "tuning_sections"
+GROUP = "ocbc-doc-tech"
+
+def normalize(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+class LabelledQuery:
+    query: str
+    answers: list[str]
+    def __init__(self, query: str, answers: list[str]):
+        self.query = query
+        self.answers = [normalize(answer) for answer in answers]
+
+def load_queries(path: str) -> list[LabelledQuery]:
+    queries = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                queries.append(LabelledQuery(item["query"], item["answers"]))
+    return queries
+
+def load_corpus(corpus_dir: str) -> list[tuple[str, str]]:
+    files = sorted(p for p in Path(corpus_dir).rglob("*") if p.suffix in (".md", ".txt"))
+    return [(p.name, p.read_text()) for p in files]
+
+def chunk_corpus(corpus: list[tuple[str, str]], chunk_size: int, chunk_overlap: int) -> list[dict]:
+    from langchain_text_splitters import MarkdownTextSplitter
+    splitter = MarkdownTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return [
+        {"group": GROUP, "title": filename, "content": chunk}
+        for filename, text in corpus
+        for chunk in splitter.split_text(text)
+    ]
+
+def count_tokens(text: str) -> int:
+    if tiktoken is None:
+        # close enough for English prose when tiktoken isn't installed
+        return len(text) // 4
+    return len(tiktoken.encoding_for_model("gpt-4o").encode(text))
+
+class EmbeddingCache:
+    """Embeds each distinct text once per run, in batches."""
+    def __init__(self, openai, batch_size: int = 256):
+        self.openai = openai
+        self.batch_size = batch_size
+        self.vectors: dict[str, list[float]] = {}
+
+    async def embed(self, texts: list[str]) -> list[list[float]]:
+        missing = list(dict.fromkeys(text for text in texts if text not in self.vectors))
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            response = await self.openai.embeddings.create(input=batch, model='text-embedding-3-small')
+            for item in response.data:
+                self.vectors[batch[item.index]] = item.embedding
+        return [self.vectors[text] for text in texts]
+
+class LocalBackend:
+    """Exact cosine search in process, with scalar (int8) and binary quantization.
+
+    Binary ranks by Hamming distance and rescores the top `candidates` with the full
+    vectors, like Atlas does, so the candidate count matters for it only.
+    """
+    name = "local"
+    quantizations = ("none", "scalar", "binary")
+
+    async def load(self, chunks: list[dict], dims: int):
+        self.chunks = chunks
+        self.vectors = [chunk["embedding"] for chunk in chunks]
+
+    async def prepare(self, quantization: str):
+        self.quantization = quantization
+        if quantization == "scalar":
+            lows = [min(column) for column in zip(*self.vectors)]
+            highs = [max(column) for column in zip(*self.vectors)]
+            steps = [(high - low) / 255 or 1.0 for low, high in zip(lows, highs)]
+            # decoded int8 codes, the search sees the same rounding error as an int8 index
+            self.scored = [
+                [low + round((v - low) / step) * step for v, low, step in zip(vector, lows, steps)]
+                for vector in self.vectors
+            ]
+        elif quantization == "binary":
+            self.bits = [self._bits(vector) for vector in self.vectors]
+
+    @staticmethod
+    def _bits(vector: list[float]) -> int:
+        return sum(1 << i for i, v in enumerate(vector) if v > 0)
+
+    def settings(self, quantization: str, args) -> list[dict]:
+        candidates = args.candidates if quantization == "binary" else [None]
+        return [{"limit": limit, "candidates": c} for limit in args.limits for c in candidates]
+
+    async def configure(self, setting: dict):
+        pass
+
+    async def search(self, embedding: list[float], setting: dict) -> list[dict]:
+        limit = setting["limit"]
+        if self.quantization == "binary":
+            query_bits = self._bits(embedding)
+            ranked = sorted(range(len(self.bits)), key=lambda i: (self.bits[i] ^ query_bits).bit_count())
+            indexes = ranked[:max(limit, setting["candidates"])]
+            vectors = self.vectors
+        else:
+            indexes = range(len(self.vectors))
+            vectors = self.scored if self.quantization == "scalar" else self.vectors
+        scores = sorted(((cosine_similarity(embedding, vectors[i]), i) for i in indexes), reverse=True)
+        return [self.chunks[i] for _, i in scores[:limit]]
+
+    async def close(self):
+        pass
+
+class MongoBackend:
+    """Atlas `$vectorSearch` on a scratch collection, one search index per quantization."""
+    name = "mongo"
+    quantizations = ("none", "scalar", "binary")
+
+    def __init__(self, mongo_uri: str, index_timeout: float = 600.0):
+        from databases.mongo import MongoClient
+        self.client = MongoClient(mongo_uri, "pyAgent")
+        self.collection = self.client.get_collection(SCRATCH)
+        self.index_timeout = index_timeout
+
+    async def load(self, chunks: list[dict], dims: int):
+        self.dims = dims
+        # dropping the collection drops its search indexes too, they are rebuilt per chunking
+        await self.collection.drop()
+        await self.collection.insert_many([dict(chunk) for chunk in chunks])
+
+    async def prepare(self, quantization: str):
+        self.index = f"tuning_{quantization}"
+        definition = vector_index_definition(self.dims)
+        if quantization != "none":
+            definition["fields"][0]["quantization"] = quantization
+        await ensure_vector_index(self.collection, definition, self.index)
+        deadline = time.monotonic() + self.index_timeout
+        while time.monotonic() < deadline:
+            cursor = await self.collection.list_search_indexes(self.index)
+            indexes = await cursor.to_list()
+            if indexes and indexes[0].get("queryable") and indexes[0].get("status") == "READY":
+                return
+            await asyncio.sleep(2)
+        raise TimeoutError(f"search index {self.index} not ready after {self.index_timeout}s")
+
+    def settings(self, quantization: str, args) -> list[dict]:
+        return [{"limit": limit, "candidates": c} for limit in args.limits for c in args.candidates if c >= limit]
+
+    async def configure(self, setting: dict):
+        pass
+
+    async def search(self, embedding: list[float], setting: dict) -> list[dict]:
+        stage = vector_search_stage(embedding, limit=setting["limit"], candidates=setting["candidates"], index=self.index)
+        cursor = await self.collection.aggregate([stage, {'$project': {'_id': 0, 'group': 1, 'title': 1, 'content': 1}}])
+        return await cursor.to_list()
+
+    async def close(self):
+        await self.collection.drop()
+        await self.client.client.close()
+
+class PgVectorBackend:
+    """pgvector HNSW on a scratch table: full vectors, `halfvec`, or binary with a rerank window.
+
+    Needs pgvector 0.7 or later for `halfvec` and `binary_quantize`.
+    """
+    name = "pgvector"
+    quantizations = ("none", "halfvec", "binary")
+
+    async def load(self, chunks: list[dict], dims: int):
+        from databases.pg_vector import database_connect
+        self.dims = dims
+        self.chunks = chunks
+        self._pool_context = database_connect(False)
+        self.pool = await self._pool_context.__aenter__()
+        # one connection so `SET hnsw.ef_search` applies to every timed query
+        self.conn = await self.pool.acquire()
+        await self.conn.execute(f"DROP TABLE IF EXISTS {SCRATCH}")
+        await self.conn.execute(
+            f"CREATE TABLE {SCRATCH} (id serial PRIMARY KEY, title text, content text, embedding vector({dims}))"
+        )
+        await self.conn.executemany(
+            f"INSERT INTO {SCRATCH} (title, content, embedding) VALUES ($1, $2, $3)",
+            [(chunk["title"], chunk["content"], json.dumps(chunk["embedding"])) for chunk in chunks],
+        )
+
+    async def prepare(self, quantization: str):
+        self.quantization = quantization
+        dims = self.dims
+        expression = {
+            "none": "embedding vector_cosine_ops",
+            "halfvec": f"(embedding::halfvec({dims})) halfvec_cosine_ops",
+            "binary": f"(binary_quantize(embedding)::bit({dims})) bit_hamming_ops",
+        }[quantization]
+        await self.conn.execute(f"DROP INDEX IF EXISTS {SCRATCH}_hnsw")
+        await self.conn.execute(f"CREATE INDEX {SCRATCH}_hnsw ON {SCRATCH} USING hnsw ({expression})")
+        await self.conn.execute(f"ANALYZE {SCRATCH}")
+
+    def settings(self, quantization: str, args) -> list[dict]:
+        candidates = args.candidates if quantization == "binary" else [None]
+        return [
+            {"limit": limit, "candidates": c, "ef_search": ef}
+            for limit in args.limits for c in candidates for ef in args.ef_search
+            if c is None or c >= limit
+        ]
+
+    async def configure(self, setting: dict):
+        await self.conn.execute(f"SET hnsw.ef_search = {int(setting['ef_search'])}")
+
+    async def search(self, embedding: list[float], setting: dict) -> list[dict]:
+        dims = self.dims
+        vector = json.dumps(embedding)
+        if self.quantization == "binary":
+            rows = await self.conn.fetch(
+                f"""SELECT title, content FROM (
+                    SELECT title, content, embedding FROM {SCRATCH}
+                    ORDER BY binary_quantize(embedding)::bit({dims}) <~> binary_quantize($1::vector({dims}))
+                    LIMIT $3
+                ) candidates ORDER BY embedding <=> $1::vector({dims}) LIMIT $2""",
+                vector, setting["limit"], setting["candidates"],
+            )
+        elif self.quantization == "halfvec":
+            rows = await self.conn.fetch(
+                f"SELECT title, content FROM {SCRATCH} ORDER BY embedding::halfvec({dims}) <=> $1::halfvec({dims}) LIMIT $2",
+                vector, setting["limit"],
+            )
+        else:
+            rows = await self.conn.fetch(
+                f"SELECT title, content FROM {SCRATCH} ORDER BY embedding <=> $1::vector({dims}) LIMIT $2",
+                vector, setting["limit"],
+            )
+        return [{"group": GROUP, "title": row["title"], "content": row["content"]} for row in rows]
+
+    async def close(self):
+        await self.conn.execute(f"DROP TABLE IF EXISTS {SCRATCH}")
+        await self.pool.release(self.conn)
+        await self._pool_context.__aexit__(None, None, None)
+
+def make_backend(name: str, args):
+    if name == "local":
+        return LocalBackend()
+    if name == "mongo":
+        mongo_uri = get_settings().mongo_uri
+        if mongo_uri is None:
+            raise ValueError("MONGO_URI not found in .env file")
+        return MongoBackend(mongo_uri)
+    if name == "pgvector":
+        return PgVectorBackend()
+    raise ValueError(f"Unknown backend {name}")
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+async def evaluate(backend, setting: dict, queries: list[LabelledQuery], query_vectors: list[list[float]], repeat: int) -> dict:
+    await backend.configure(setting)
+    latencies, recalls, reciprocal_ranks, tokens = [], [], [], []
+    for labelled, vector in zip(queries, query_vectors):
+        for _ in range(repeat):
+            started = time.perf_counter()
+            rows = await backend.search(vector, setting)
+            latencies.append(time.perf_counter() - started)
+        contents = [normalize(row["content"]) for row in rows]
+        found = [answer for answer in labelled.answers if any(answer in content for content in contents)]
+        recalls.append(len(found) / len(labelled.answers) if labelled.answers else 0.0)
+        ranks = [rank for rank, content in enumerate(contents, 1) if any(a in content for a in labelled.answers)]
+        reciprocal_ranks.append(1.0 / ranks[0] if ranks else 0.0)
+        # what the `retrieve` tool hands the model for this question
+        tokens.append(count_tokens(format_sections(rows)))
+    return {
+        "recall": statistics.mean(recalls),
+        "mrr": statistics.mean(reciprocal_ranks),
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "tokens": statistics.mean(tokens),
+    }
+
+def mark_pareto(results: list[dict]):
+    """Flag results no other result beats on recall, MRR, p99 and tokens at once."""
+    def at_least_as_good(a: dict, b: dict) -> bool:
+        return a["recall"] >= b["recall"] and a["mrr"] >= b["mrr"] and a["p99_ms"] <= b["p99_ms"] and a["tokens"] <= b["tokens"]
+    for result in results:
+        result["pareto"] = not any(
+            other is not result and at_least_as_good(other, result) and not at_least_as_good(result, other)
+            for other in results
+        )
+
+def print_table(results: list[dict], pareto_only: bool):
+    header = f"{'':<2}{'backend':<10}{'chunk':>10}{'quant':>9}{'limit':>7}{'cand':>7}{'ef':>6}{'recall@k':>10}{'mrr':>7}{'p50 ms':>9}{'p99 ms':>9}{'tokens':>8}"
+    print(header)
+    for r in sorted(results, key=lambda r: (-r["recall"], -r["mrr"], r["p99_ms"])):
+        if pareto_only and not r["pareto"]:
+            continue
+        print(
+            f"{'*' if r['pareto'] else '':<2}{r['backend']:<10}{r['chunking']:>10}{r['quantization']:>9}{r['limit']:>7}"
+            f"{r.get('candidates') or '-':>7}{r.get('ef_search') or '-':>6}{r['recall']:>10.3f}{r['mrr']:>7.3f}"
+            f"{r['p50_ms']:>9.2f}{r['p99_ms']:>9.2f}{r['tokens']:>8.0f}"
+        )
+
+async def run(args):
+    queries = load_queries(args.queries)
+    corpus = load_corpus(args.corpus)
+    if args.stub_embeddings:
+        from benchmarks.stubs import StubOpenAI
+        openai = StubOpenAI(latency=0.0, dims=args.dims)
+    else:
+        from openai import AsyncOpenAI
+        openai = AsyncOpenAI()
+    embeddings = EmbeddingCache(openai)
+    query_vectors = await embeddings.embed([q.query for q in queries])
+
+    results = []
+    for chunking in args.chunking:
+        chunk_size, chunk_overlap = (int(n) for n in chunking.split(":"))
+        chunks = chunk_corpus(corpus, chunk_size, chunk_overlap)
+        vectors = await embeddings.embed([f"{chunk['title']} {chunk['content']}" for chunk in chunks])
+        for chunk, vector in zip(chunks, vectors):
+            chunk["embedding"] = vector
+        print(f"chunking {chunking}: {len(chunks)} sections")
+        for backend_name in args.backend:
+            backend = make_backend(backend_name, args)
+            try:
+                await backend.load(chunks, len(vectors[0]))
+                for quantization in args.quantization or backend.quantizations:
+                    if quantization not in backend.quantizations:
+                        continue
+                    await backend.prepare(quantization)
+                    for setting in backend.settings(quantization, args):
+                        metrics = await evaluate(backend, setting, queries, query_vectors, args.repeat)
+                        results.append({"backend": backend.name, "chunking": chunking, "quantization": quantization, **setting, **metrics})
+            finally:
+                await backend.close()
+
+    mark_pareto(results)
+    print_table(results, args.pareto_only)
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+
+def number_list(value: str) -> list[int]:
+    return [int(n) for n in value.split(",")]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", required=True, help="directory of markdown/text files")
+    parser.add_argument("--queries", required=True, help="labelled query set, JSON lines")
+    parser.add_argument("--backend", action="append", choices=("local", "mongo", "pgvector"))
+    parser.add_argument("--chunking", type=lambda v: v.split(","), default=["1000:200", "500:100", "1500:300"], help="size:overlap,...")
+    parser.add_argument("--limits", type=number_list, default=[4, 8, 20])
+    parser.add_argument("--candidates", type=number_list, default=[50, 150, 400], help="numCandidates / binary rerank window")
+    parser.add_argument("--ef-search", type=number_list, default=[40, 100, 200], help="pgvector hnsw.ef_search")
+    parser.add_argument("--quantization", action="append", help="default: every mode the backend supports")
+    parser.add_argument("--repeat", type=int, default=3, help="timed searches per query")
+    parser.add_argument("--stub-embeddings", action="store_true", help="hashed bag-of-words vectors instead of OpenAI")
+    parser.add_argument("--dims", type=int, default=256, help="dimensions of the stub embeddings")
+    parser.add_argument("--pareto-only", action="store_true")
+    parser.add_argument("--json", help="also write every result to this file")
+    args = parser.parse_args()
+    args.backend = args.backend or ["local"]
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
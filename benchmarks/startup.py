@@ -0,0 +1,80 @@
+"""Cold start benchmark for the API.
+
+Measures how long `import main` takes in a fresh interpreter and how long a new
+uvicorn process takes until `/ready` answers 200, the number a new pod waits for.
+
+`/ready` waits for the warmup checks in `READY_CHECKS`, by default RabbitMQ, Mongo
+and the OpenAI API have to be reachable. A placeholder key is enough for the OpenAI
+check. Set `READY_CHECKS = "none"` in `.env` to time the startup alone.
+
+    python -m benchmarks.startup --runs 5 --budget 1.0
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def measure_import() -> float:
+    code = "import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)"
+    output = subprocess.check_output([sys.executable, "-c", code], cwd=ROOT, env=bench_env())
+    return float(output.decode().strip().splitlines()[-1])
+
+def measure_ready(port: int, timeout: float) -> tuple[float, dict]:
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT,
+        env=bench_env(),
+    )
+    try:
+        with httpx.Client() as client:
+            while time.perf_counter() - started < timeout:
+                try:
+                    response = client.get(f"http://127.0.0.1:{port}/ready", timeout=1)
+                    if response.status_code == 200:
+                        return time.perf_counter() - started, response.json()
+                except httpx.TransportError:
+                    pass
+                time.sleep(0.01)
+        raise TimeoutError(f"/ready did not answer 200 within {timeout}s")
+    finally:
+        process.terminate()
+        process.wait()
+
+def bench_env() -> dict:
+    env = dict(os.environ)
+    # the model clients refuse to construct without a key, it is never used for a real call here
+    env.setdefault("OPENAI_API_KEY", "sk-benchmark")
+    return env
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--port", type=int, default=8123)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--budget", type=float, default=1.0, help="time-to-ready budget in seconds")
+    args = parser.parse_args()
+
+    imports = [measure_import() for _ in range(args.runs)]
+    readies = []
+    for _ in range(args.runs):
+        seconds, body = measure_ready(args.port, args.timeout)
+        readies.append(seconds)
+        print(f"ready in {seconds:.3f}s, checks: {body['checks']}")
+
+    print(f"{'metric':<16}{'min':>10}{'median':>10}{'max':>10}")
+    for name, values in (("import main", imports), ("time to ready", readies)):
+        print(f"{name:<16}{min(values):>10.3f}{statistics.median(values):>10.3f}{max(values):>10.3f}")
+
+    if statistics.median(readies) > args.budget:
+        print(f"time to ready is over the {args.budget}s budget")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Local stand-ins for OpenAI used by the benchmarks.
+
+`StubOpenAI` answers `embeddings.create` with deterministic hashed bag-of-words
+vectors, `stub_llm` is a pydantic-ai `FunctionModel` that behaves like a RAG
+model: it calls `retrieve` unless the prompt already carries a `<context>` block
+or a tool result, then streams an answer. Both add configurable latency.
+"""
+import json
+import math
+import asyncio
+import base64
+import hashlib
+
+from array import array
+from types import SimpleNamespace
+
+from pydantic_ai.messages import (
+    ModelMessage,
+    ModelRequest,
+    ModelResponse,
+    TextPart,
+    ToolCallPart,
+    ToolReturnPart,
+    UserPromptPart,
+)
+from pydantic_ai.models.function import AgentInfo, DeltaToolCall, FunctionModel
+
+def hash_vector(text: str, dims: int = 64) -> list[float]:
+    vector = [0.0] * dims
+    for word in text.lower().split():
+        digest = hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest()
+        index = int.from_bytes(digest[:4], "big") % dims
+        vector[index] += 1.0 if digest[4] & 1 else -1.0
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+class StubEmbeddings:
+    def __init__(self, latency: float, dims: int):
+        self.latency = latency
+        self.dims = dims
+        self.calls = 0
+
+    async def create(self, input: str | list[str], model: str, encoding_format: str = "float", **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        inputs = [input] if isinstance(input, str) else input
+        vectors = [hash_vector(text, self.dims) for text in inputs]
+        if encoding_format == "base64":
+            vectors = [base64.b64encode(array("f", vector).tobytes()).decode() for vector in vectors]
+        return SimpleNamespace(
+            data=[SimpleNamespace(index=i, embedding=vector) for i, vector in enumerate(vectors)]
+        )
+
+class StubOpenAI:
+    """Just enough of `AsyncOpenAI` for the retrieval code paths."""
+    def __init__(self, latency: float = 0.05, dims: int = 64):
+        self.embeddings = StubEmbeddings(latency, dims)
+
+def _needs_retrieval(messages: list[ModelMessage]) -> str | None:
+    """Return the query to retrieve for, or None when the model can answer."""
+    last = messages[-1]
+    if not isinstance(last, ModelRequest):
+        return None
+    prompt = ""
+    for part in last.parts:
+        if isinstance(part, ToolReturnPart):
+            return None
+        if isinstance(part, UserPromptPart):
+            prompt = part.content
+    if "<context>" in prompt:
+        return None
+    return prompt
+
+def stub_llm(first_token_latency: float = 0.4, token_latency: float = 0.005, answer_tokens: int = 40, retrieve: bool = True) -> FunctionModel:
+    """A model that calls `retrieve` once per question, unless the context is in the prompt or
+    `retrieve` is False for agents without tools."""
+    answer = [f"token{i} " for i in range(answer_tokens)]
+
+    async def respond(messages: list[ModelMessage], info: AgentInfo) -> ModelResponse:
+        await asyncio.sleep(first_token_latency + token_latency * answer_tokens)
+        query = _needs_retrieval(messages) if retrieve else None
+        if query is not None:
+            return ModelResponse(parts=[ToolCallPart(tool_name="retrieve", args={"search_query": query})])
+        return ModelResponse(parts=[TextPart(content="".join(answer))])
+
+    async def stream(messages: list[ModelMessage], info: AgentInfo):
+        await asyncio.sleep(first_token_latency)
+        query = _needs_retrieval(messages) if retrieve else None
+        if query is not None:
+            yield {0: DeltaToolCall(name="retrieve", json_args=json.dumps({"search_query": query}))}
+            return
+        for token in answer:
+            await asyncio.sleep(token_latency)
+            yield token
+
+    return FunctionModel(respond, stream_function=stream)
@@ -1,64 +1,127 @@
 import pika, sys, os
+import signal
 import logfire
 import asyncio
 
-from dotenv import load_dotenv, get_key
-from databases.rabbitmq import RabbitClient, queue_configs
+from dotenv import load_dotenv
+from databases.rabbitmq import PRIORITIES, LaneScheduler, RabbitClient, queue_configs
 from pika.adapters.blocking_connection import BlockingChannel
 from pika.spec import Basic, BasicProperties
 
 from databases.mongo import MongoClient
 from services.file_processor import FileProcessor
+from services.conversion_cache import hash_file
 from utils.embedding import Embedding
+from utils.dedup import ChunkDeduplicator
+from utils.profiling import maybe_profiled
+from utils.settings import get_settings, reload_settings
 
 # load the config from dot env file
 load_dotenv()
 
-logfire.configure(send_to_logfire='if-token-present', token=get_key(".env", "LOGFIRE_KEY"))
+logfire.configure(send_to_logfire='if-token-present', token=get_settings().logfire_key)
 
-mongo_uri = get_key(".env", "MONGO_URI")
+mongo_uri = get_settings().mongo_uri
 if mongo_uri is None:
     logfire.error("MONGO_URI not found in .env file")
 mongo_client = MongoClient(mongo_uri, "pyAgent")
+# shared by every learning message so duplicates are detected across the corpus
+deduplicator = ChunkDeduplicator()
+
+async def index_file(markdown_path: str, source: str):
+    """Embed a markdown file and save its sections, `source` is the file they are recorded from."""
+    mongo_client.ping()
+    if not deduplicator.loaded:
+        await deduplicator.load(mongo_client.get_collection("doc_sections"))
+    embedding_pkg = Embedding()
+    embeding_file = await embedding_pkg.generate_from_file(markdown_path, source, dedup=deduplicator)
+    await mongo_client.save_doc_sections("doc_sections", embeding_file, embedding_pkg.references)
+    # only now, a file that fails before its sections are stored is indexed in full on a retry
+    for chunk_hash, signature in embedding_pkg.pending.items():
+        deduplicator.add(chunk_hash, signature)
+
+def index_message(ch: BlockingChannel, method: Basic.Deliver, file_name: str, task):
+    """Run the indexing of `file_name` and record the result on its upload.
+
+    Files that came in through /learning/upload are recorded by content hash, a failed
+    one is marked "failed" so uploading it again queues it again, and the message is
+    dropped instead of being redelivered forever.
+    """
+    async def run():
+        file_hash = None
+        try:
+            file_hash = hash_file(file_name)
+            await task()
+        except Exception as e:
+            logfire.error(f"Indexing {file_name} failed: {e}")
+            if file_hash is not None:
+                await mongo_client.set_upload_status(file_hash, "failed", error=str(e))
+            return False
+        await mongo_client.set_upload_status(file_hash, "indexed")
+        return True
+    if asyncio.run(run()):
+        ch.basic_ack(delivery_tag = method.delivery_tag)
+    else:
+        ch.basic_nack(delivery_tag = method.delivery_tag, requeue=False)
 
 def ai_upload_callback(ch: BlockingChannel, method: Basic.Deliver, properties: BasicProperties, body: bytes):
     file_name: str = body.decode()
-    with logfire.span('ai_upload_callback'):
-        logfire.info(f'Processing {file_name}')
-        file_processor = FileProcessor(file_name)
-        
-        file_processor.process_file()
-        ch.basic_ack(delivery_tag = method.delivery_tag)
+    async def process_file():
+        with logfire.span('ai_upload_callback'):
+            logfire.info(f'Processing {file_name}')
+            markdown_path = FileProcessor(file_name).process_file()
+            await index_file(markdown_path, file_name)
+    # PROFILE_CONSUMER_RATE of the messages are profiled, the PDF pages are converted in
+    # worker processes that the profile doesn't see
+    with maybe_profiled("ai.upload"):
+        index_message(ch, method, file_name, process_file)
         
 def learning_callback(ch: BlockingChannel, method: Basic.Deliver, properties: BasicProperties, body: bytes):
     file_name: str = body.decode()
     async def process_file():
         with logfire.span('learning_callback'):
             logfire.info(f'Processing {file_name}')
-            
-            mongo_client.ping()
-            embedding_pkg = Embedding()
-            embeding_file = await embedding_pkg.generate_from_file(file_name, "")
-            await mongo_client.get_collection("doc_sections").insert_many(embeding_file)
-            ch.basic_ack(delivery_tag = method.delivery_tag)
-    asyncio.run(process_file()) 
+            await index_file(file_name, "")
+    with maybe_profiled("learning.async"):
+        index_message(ch, method, file_name, process_file)
 
 def main():
+    # `kill -HUP <pid>` re-reads .env, the RabbitMQ and Mongo connections stay as they are
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda signum, frame: reload_settings())
     # listen rabbitmq
+    settings = get_settings()
     rabbit_client = RabbitClient(
-        host=get_key(".env", "RABBIT_HOST"),
-        port=get_key(".env", "RABBIT_PORT"),
-        username=get_key(".env", "RABBIT_USER"),
-        password=get_key(".env", "RABBIT_PASS")
+        host=settings.rabbit_host,
+        port=settings.rabbit_port,
+        username=settings.rabbit_user,
+        password=settings.rabbit_pass
     )
     rabbit_client.setup()
     channel = rabbit_client.get_channel()
 
-    channel.basic_consume(queue=queue_configs["ai.upload"].queue, on_message_callback=ai_upload_callback)
-    channel.basic_consume(queue=queue_configs["learning.async"].queue, on_message_callback=learning_callback)
+    # one unacknowledged message per queue, the rest wait in RabbitMQ where an upload
+    # isn't queued behind them
+    channel.basic_qos(prefetch_count=1)
+    scheduler = LaneScheduler()
+    callbacks = {"ai.upload": ai_upload_callback, "learning.async": learning_callback}
+    for key, callback in callbacks.items():
+        for priority in PRIORITIES:
+            queue, _ = queue_configs[key].lane(priority)
+            channel.basic_consume(
+                queue=queue,
+                on_message_callback=lambda ch, method, properties, body, priority=priority, callback=callback:
+                    scheduler.add(priority, (callback, ch, method, properties, body)),
+            )
 
     print(' [*] Waiting for messages. To exit press CTRL+C')
-    channel.start_consuming()
+    while True:
+        # block until a message arrives when none is pending, else only take in what already did
+        rabbit_client.conn.process_data_events(time_limit=0 if scheduler else None)
+        delivery = scheduler.next(get_settings().consumer_interactive_weight)
+        if delivery is not None:
+            callback, *arguments = delivery
+            callback(*arguments)
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,38 @@
+"""Version of the contents of a Mongo collection, for caches of its search results.
+
+`corpus_versions` holds one document per collection with a counter that every write
+to the collection bumps once it is done. Cached results are keyed by the version read
+before their search, so after a write they are no longer found and a search with the
+new contents is made. The counter lives in Mongo and not in the shared cache since the
+consumer writing the sections may not share the API's cache store.
+
+The epoch, set once when the document is created, keeps a counter that starts over
+after the document was dropped from matching entries cached before.
+"""
+import uuid
+
+VERSIONS_COLLECTION = "corpus_versions"
+
+class CorpusVersions:
+    async def current(self, mongo, collection_name: str) -> str:
+        """The version of `collection_name`, a point read by primary key."""
+        versions = mongo.get_collection(VERSIONS_COLLECTION)
+        recorded = await versions.find_one({"_id": collection_name})
+        if recorded is None:
+            await versions.update_one(
+                {"_id": collection_name},
+                {"$setOnInsert": {"epoch": uuid.uuid4().hex, "version": 0}},
+                upsert=True,
+            )
+            recorded = await versions.find_one({"_id": collection_name})
+        return f"{recorded['epoch']}.{recorded['version']}"
+
+    async def bump(self, mongo, collection_name: str):
+        """Call after a write to `collection_name` completed, searches cached before it are not served again."""
+        await mongo.get_collection(VERSIONS_COLLECTION).update_one(
+            {"_id": collection_name},
+            {"$inc": {"version": 1}, "$setOnInsert": {"epoch": uuid.uuid4().hex}},
+            upsert=True,
+        )
+
+corpus_versions = CorpusVersions()
@@ -0,0 +1,49 @@
+"""Which embedding provider the vectors of a Mongo collection come from.
+
+The provider name and dimensions are kept in `embedding_spaces`, one document per
+collection. The first write or search records the configured provider, later ones
+are compared against the record and fail with `EmbeddingMismatch` instead of storing
+or searching vectors that can't be compared. A collection filled before the record
+existed is adopted when its stored vectors have the configured dimensions.
+"""
+from datetime import datetime, timezone
+
+from utils.embedders import Embedder, EmbeddingMismatch, check_space, embedding_provider
+from utils.vectors import as_floats
+
+SPACES_COLLECTION = "embedding_spaces"
+
+class EmbeddingSpaces:
+    """Checks once per process, client and collection, later calls are a set lookup."""
+    def __init__(self):
+        self.checked: set[tuple[int, str, str, int]] = set()
+
+    async def ensure(self, mongo, collection_name: str, embedder: Embedder | None = None):
+        embedder = embedder or embedding_provider()
+        key = (id(mongo), collection_name, embedder.name, embedder.dimensions)
+        if key in self.checked:
+            return
+        spaces = mongo.get_collection(SPACES_COLLECTION)
+        recorded = await spaces.find_one({"_id": collection_name})
+        if recorded is None:
+            stored = await mongo.get_collection(collection_name).find_one({"embedding": {"$exists": True}}, {"embedding": 1})
+            if stored is not None and len(as_floats(stored["embedding"])) != embedder.dimensions:
+                raise EmbeddingMismatch(
+                    f"{collection_name} holds vectors of {len(as_floats(stored['embedding']))} dimensions, "
+                    f"EMBEDDING_PROVIDER is {embedder.name} with {embedder.dimensions}"
+                )
+            await spaces.update_one(
+                {"_id": collection_name},
+                {"$setOnInsert": {
+                    "provider": embedder.name,
+                    "dimensions": embedder.dimensions,
+                    "created_at": datetime.now(timezone.utc),
+                }},
+                upsert=True,
+            )
+            # another process may have recorded it first
+            recorded = await spaces.find_one({"_id": collection_name})
+        check_space(collection_name, recorded["provider"], recorded["dimensions"], embedder)
+        self.checked.add(key)
+
+embedding_spaces = EmbeddingSpaces()
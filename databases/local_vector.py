@@ -0,0 +1,240 @@
+import math
+import asyncio
+
+from utils.vectors import as_floats
+
+class LocalCursor:
+    """Async iterable over documents, standing in for a pymongo async cursor."""
+    def __init__(self, docs: list[dict]):
+        self.docs = docs
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self.docs:
+            yield doc
+
+    async def to_list(self, length: int | None = None) -> list[dict]:
+        return self.docs if length is None else self.docs[:length]
+
+def cosine_similarity(left: list[float], right: list[float]) -> float:
+    dot = sum(l * r for l, r in zip(left, right))
+    norm = math.sqrt(sum(l * l for l in left)) * math.sqrt(sum(r * r for r in right))
+    return dot / norm if norm else 0.0
+
+def _compare(value, op: str, operand) -> bool:
+    if op == "$eq":
+        return value == operand
+    if op == "$in":
+        return value in operand
+    if value is None or operand is None:
+        return False
+    try:
+        if op == "$gt":
+            return value > operand
+        if op == "$gte":
+            return value >= operand
+        if op == "$lt":
+            return value < operand
+        if op == "$lte":
+            return value <= operand
+    except TypeError:
+        # like Mongo, values of different types don't compare
+        return False
+    raise ValueError(f"Unsupported filter operator {op}")
+
+def _matches_condition(doc: dict, field: str, condition) -> bool:
+    value = doc.get(field)
+    # an array field matches when any of its elements does, as in Mongo
+    values = value if isinstance(value, list) else [value]
+    if not isinstance(condition, dict):
+        condition = {"$eq": condition}
+    for op, operand in condition.items():
+        if op == "$exists":
+            matched = (field in doc) == operand
+        elif op == "$ne":
+            matched = not any(_compare(v, "$eq", operand) for v in values)
+        elif op == "$nin":
+            matched = not any(_compare(v, "$in", operand) for v in values)
+        elif op == "$not":
+            matched = not _matches_condition(doc, field, operand)
+        else:
+            matched = any(_compare(v, op, operand) for v in values)
+        if not matched:
+            return False
+    return True
+
+def matches_filter(doc: dict, query: dict) -> bool:
+    for field, condition in query.items():
+        if field == "$and":
+            matched = all(matches_filter(doc, q) for q in condition)
+        elif field == "$or":
+            matched = any(matches_filter(doc, q) for q in condition)
+        elif field == "$nor":
+            matched = not any(matches_filter(doc, q) for q in condition)
+        else:
+            matched = _matches_condition(doc, field, condition)
+        if not matched:
+            return False
+    return True
+
+def filter_paths(query: dict) -> set[str]:
+    paths = set()
+    for field, condition in query.items():
+        if field in ("$and", "$or", "$nor"):
+            for q in condition:
+                paths |= filter_paths(q)
+        else:
+            paths.add(field)
+    return paths
+
+def project(doc: dict, projection: dict, score: float | None = None) -> dict:
+    if not projection:
+        return dict(doc)
+    included = {k for k, v in projection.items() if v == 1 or v is True}
+    result = {}
+    if included:
+        for field in included:
+            if field in doc:
+                result[field] = doc[field]
+        if projection.get("_id", 1) and "_id" in doc:
+            result["_id"] = doc["_id"]
+    else:
+        excluded = {k for k, v in projection.items() if v == 0 or v is False}
+        result = {k: v for k, v in doc.items() if k not in excluded}
+    for field, value in projection.items():
+        if isinstance(value, dict) and value.get("$meta") == "vectorSearchScore":
+            result[field] = score
+    return result
+
+class LocalVectorCollection:
+    """In-memory stand-in for a Mongo collection with an Atlas `$vectorSearch` index.
+
+    Supports the pipeline stages the agents use: `$vectorSearch` (exact cosine
+    similarity, `filter`, `limit`), `$project` and `$limit`. Once a search index is
+    created, `$vectorSearch` is checked against it the way Atlas does: filtering on a
+    path that isn't a filter field is an error. `latency` is added to every call to
+    mimic a network round-trip.
+    """
+    docs: list[dict]
+    def __init__(self, docs: list[dict] | None = None, latency: float = 0.0, name: str = "local"):
+        self.docs = list(docs) if docs else []
+        self.latency = latency
+        self.name = name
+        self.search_indexes: dict[str, dict] = {}
+
+    async def _wait(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def insert_many(self, docs: list[dict]):
+        await self._wait()
+        self.docs.extend(dict(doc) for doc in docs)
+
+    async def find_one(self, query: dict | None = None, projection: dict | None = None) -> dict | None:
+        await self._wait()
+        for doc in self.docs:
+            if matches_filter(doc, query or {}):
+                return project(doc, projection or {})
+        return None
+
+    async def update_one(self, query: dict, update: dict, upsert: bool = False):
+        """`$set` and `$inc` on the first match, `$setOnInsert` too when nothing matches and `upsert` is set."""
+        await self._wait()
+        for doc in self.docs:
+            if matches_filter(doc, query):
+                doc.update(update.get("$set", {}))
+                for field, amount in update.get("$inc", {}).items():
+                    doc[field] = doc.get(field, 0) + amount
+                return
+        if upsert:
+            doc = {field: value for field, value in query.items() if not field.startswith("$") and not isinstance(value, dict)}
+            doc.update(update.get("$setOnInsert", {}))
+            doc.update(update.get("$set", {}))
+            for field, amount in update.get("$inc", {}).items():
+                doc[field] = doc.get(field, 0) + amount
+            self.docs.append(doc)
+
+    async def count_documents(self, query: dict) -> int:
+        await self._wait()
+        return sum(1 for doc in self.docs if matches_filter(doc, query))
+
+    async def estimated_document_count(self) -> int:
+        await self._wait()
+        return len(self.docs)
+
+    async def create_index(self, keys, **kwargs):
+        pass
+
+    async def list_search_indexes(self, name: str | None = None) -> LocalCursor:
+        return LocalCursor([
+            {"name": index_name, "type": "vectorSearch", "latestDefinition": definition}
+            for index_name, definition in self.search_indexes.items()
+            if name is None or index_name == name
+        ])
+
+    async def create_search_index(self, model) -> str:
+        document = model.document
+        self.search_indexes[document["name"]] = document["definition"]
+        return document["name"]
+
+    async def update_search_index(self, name: str, definition: dict):
+        if name not in self.search_indexes:
+            raise ValueError(f"Search index {name} not found")
+        self.search_indexes[name] = definition
+
+    def _check_search(self, search: dict):
+        if search["numCandidates"] < search["limit"] or search["numCandidates"] > 10000:
+            raise ValueError("numCandidates must be at least limit and at most 10000")
+        definition = self.search_indexes.get(search["index"])
+        if definition is None:
+            return
+        filter_fields = {field["path"] for field in definition["fields"] if field["type"] == "filter"}
+        for path in filter_paths(search.get("filter", {})):
+            if path not in filter_fields:
+                raise ValueError(f"Path '{path}' needs to be indexed as filter")
+
+    def find(self, query: dict | None = None, projection: dict | None = None) -> LocalCursor:
+        query = query or {}
+        return LocalCursor([project(doc, projection or {}) for doc in self.docs if matches_filter(doc, query)])
+
+    async def aggregate(self, pipeline: list[dict]) -> LocalCursor:
+        await self._wait()
+        rows: list[tuple[dict, float | None]] = [(doc, None) for doc in self.docs]
+        for stage in pipeline:
+            if "$vectorSearch" in stage:
+                search = stage["$vectorSearch"]
+                self._check_search(search)
+                query_vector = search["queryVector"]
+                path = search["path"]
+                candidates = [doc for doc, _ in rows if matches_filter(doc, search.get("filter", {}))]
+                scored = [(doc, cosine_similarity(query_vector, as_floats(doc[path]))) for doc in candidates]
+                scored.sort(key=lambda row: row[1], reverse=True)
+                rows = scored[:search["limit"]]
+            elif "$project" in stage:
+                rows = [(project(doc, stage["$project"], score), score) for doc, score in rows]
+            elif "$limit" in stage:
+                rows = rows[:stage["$limit"]]
+            else:
+                raise ValueError(f"Unsupported pipeline stage {list(stage)}")
+        return LocalCursor([doc for doc, _ in rows])
+
+class LocalMongoClient:
+    """Stand-in for `databases.mongo.MongoClient` backed by `LocalVectorCollection`."""
+    db_name: str
+    def __init__(self, db_name: str = "pyAgent", latency: float = 0.0):
+        self.db_name = db_name
+        self.latency = latency
+        self.collections: dict[str, LocalVectorCollection] = {}
+
+    def get_collection(self, collection_name: str) -> LocalVectorCollection:
+        if collection_name not in self.collections:
+            self.collections[collection_name] = LocalVectorCollection(latency=self.latency, name=collection_name)
+        return self.collections[collection_name]
+
+    async def ping_async(self):
+        pass
+
+    def ping(self):
+        pass
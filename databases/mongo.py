@@ -1,5 +1,10 @@
+import os
 
-from pymongo import AsyncMongoClient
+from datetime import datetime, timezone
+from pymongo import AsyncMongoClient, UpdateOne
+from utils.profiling import scope
+from databases.embedding_space import embedding_spaces
+from databases.corpus_version import corpus_versions
 # from pymongo.server_api import ServerApi
 from openai import AsyncOpenAI
 
@@ -19,6 +24,9 @@ class MongoClient:
         db = self.client[self.db_name]
         return db[collection_name]
 
+    async def ping_async(self):
+        await self.client.admin.command('ping')
+
     def ping(self):
         try:
             # Send a ping to confirm a successful connection
@@ -27,8 +35,76 @@ class MongoClient:
         except Exception as e:
             print(e)
 
+    async def save_doc_sections(self, collection_name: str, docs: list[dict], references: list[tuple[str, str]]):
+        """Store new sections once per content hash and add source references to existing ones."""
+        # building the operations and their BSON encoding in bulk_write
+        with scope("save_doc_sections"):
+            operations = []
+            for doc in docs:
+                sources = doc.get("sources", [])
+                new_doc = {k: v for k, v in doc.items() if k != "sources"}
+                operations.append(UpdateOne(
+                    {"content_hash": doc["content_hash"]},
+                    {"$setOnInsert": new_doc, "$addToSet": {"sources": {"$each": sources}}},
+                    upsert=True,
+                ))
+            for chunk_hash, source in references:
+                operations.append(UpdateOne(
+                    {"content_hash": chunk_hash},
+                    {"$addToSet": {"sources": source}},
+                ))
+            if not operations:
+                return None
+            if docs:
+                await embedding_spaces.ensure(self, collection_name)
+            result = await self.get_collection(collection_name).bulk_write(operations, ordered=False)
+            # added sources aren't in any search result, only new sections change them
+            if result.upserted_count:
+                await corpus_versions.bump(self, collection_name)
+            return result
+
+    async def register_upload(self, file_hash: str, filename: str, path: str) -> dict | None:
+        """Record an uploaded file by content hash, returns the earlier record when the content is known."""
+        collection = self.get_collection("uploaded_files")
+        result = await collection.update_one(
+            {"file_hash": file_hash},
+            {"$setOnInsert": {
+                "file_hash": file_hash,
+                "filename": filename,
+                "path": path,
+                "status": "queued",
+                "created_at": datetime.now(timezone.utc),
+            }},
+            upsert=True,
+        )
+        if result.upserted_id is not None:
+            return None
+        return await collection.find_one({"file_hash": file_hash}, {"_id": 0})
+
+    async def set_upload_status(self, file_hash: str, status: str, **fields):
+        await self.get_collection("uploaded_files").update_one(
+            {"file_hash": file_hash},
+            {"$set": {"status": status, **fields}},
+        )
+
     def vector_search(self, collection_name: str, pipeline: list):
         print(f"collenction {collection_name}")
         coll = self.client[collection_name]
         return coll.aggregate(pipeline)
 
+# clients shared by the API process, keyed by uri and database, so requests reuse one connection pool
+_shared_clients: dict[tuple[str, str], MongoClient] = {}
+
+def get_shared_client(uri: str, db_name: str = "pyAgent") -> MongoClient:
+    key = (uri, db_name)
+    if key not in _shared_clients:
+        _shared_clients[key] = MongoClient(uri, db_name)
+    return _shared_clients[key]
+
+# clients created before a fork belong to the parent, a child opens its own
+os.register_at_fork(after_in_child=_shared_clients.clear)
+
+async def close_shared_clients():
+    for client in _shared_clients.values():
+        await client.client.close()
+    _shared_clients.clear()
@@ -5,6 +5,8 @@ import asyncpg
 from typing_extensions import AsyncGenerator
 from contextlib import asynccontextmanager
 
+from utils.embedders import EmbeddingMismatch
+
 # pyright: reportUnknownMemberType=false
 # pyright: reportUnknownVariableType=false
 @asynccontextmanager
@@ -41,16 +43,51 @@ CREATE TABLE IF NOT EXISTS doc_sections (
     url text NOT NULL UNIQUE,
     title text NOT NULL,
     content text NOT NULL,
-    -- text-embedding-3-small returns a vector of 1536 floats
-    embedding vector(1536) NOT NULL
+    -- the dimensions of the embedding provider the table was created with
+    embedding vector({dimensions}) NOT NULL
 );
 CREATE INDEX IF NOT EXISTS idx_doc_sections_embedding ON doc_sections USING hnsw (embedding vector_l2_ops);
+
+-- provider and dimensions of the vectors in each table
+CREATE TABLE IF NOT EXISTS embedding_spaces (
+    collection text PRIMARY KEY,
+    provider text NOT NULL,
+    dimensions integer NOT NULL
+);
 """
 
-async def setup_schema(pool: asyncpg.Pool) -> None:
+async def setup_schema(pool: asyncpg.Pool, dimensions: int = 1536) -> None:
     async with pool.acquire() as conn:
         async with conn.transaction():
-            await conn.execute(DB_SCHEMA)
+            await conn.execute(DB_SCHEMA.format(dimensions=dimensions))
+
+async def embedding_space(pool: asyncpg.Pool, collection: str, provider: str, dimensions: int) -> tuple[str, int]:
+    """Record the provider of a table unless one is recorded already, returns the recorded one.
+
+    A table created before the record existed is adopted when its `embedding` column has `dimensions`.
+    """
+    row = await pool.fetchrow('SELECT provider, dimensions FROM embedding_spaces WHERE collection = $1', collection)
+    if row is not None:
+        return row['provider'], row['dimensions']
+    # pgvector keeps N of a vector(N) column as its type modifier
+    column_dimensions = await pool.fetchval(
+        "SELECT atttypmod FROM pg_attribute WHERE attrelid = to_regclass($1) AND attname = 'embedding' AND NOT attisdropped",
+        collection,
+    )
+    if column_dimensions is not None and column_dimensions > 0 and column_dimensions != dimensions:
+        raise EmbeddingMismatch(
+            f"{collection} holds vectors of {column_dimensions} dimensions, "
+            f"EMBEDDING_PROVIDER is {provider} with {dimensions}"
+        )
+    await pool.execute(
+        'INSERT INTO embedding_spaces (collection, provider, dimensions) VALUES ($1, $2, $3) ON CONFLICT (collection) DO NOTHING',
+        collection,
+        provider,
+        dimensions,
+    )
+    # another process may have recorded it first
+    row = await pool.fetchrow('SELECT provider, dimensions FROM embedding_spaces WHERE collection = $1', collection)
+    return row['provider'], row['dimensions']
             
 async def search_docs(pool: asyncpg.Pool, embedding_json: str) -> list:
     return await pool.fetch(
@@ -66,5 +103,16 @@ async def create_embedding(pool: asyncpg.Pool, url: str, title: str, content: st
             content,
             embedding,
         )
+async def create_embeddings(pool: asyncpg.Pool, rows: list[tuple[str, str, str, str]]) -> None:
+    """Insert (url, title, content, embedding) rows in one statement, sections stored meanwhile are skipped."""
+    await pool.executemany(
+        'INSERT INTO doc_sections (url, title, content, embedding) VALUES ($1, $2, $3, $4) ON CONFLICT (url) DO NOTHING',
+        rows,
+    )
+
+async def existing_urls(pool: asyncpg.Pool, urls: list[str]) -> set[str]:
+    rows = await pool.fetch('SELECT url FROM doc_sections WHERE url = ANY($1::text[])', urls)
+    return {row['url'] for row in rows}
+
 async def check_embedding_exists(pool: asyncpg.Pool, url: str):
     return await pool.fetchval('SELECT 1 FROM doc_sections WHERE url = $1', url)
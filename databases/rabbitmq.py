@@ -1,8 +1,18 @@
 import pika
+import asyncio
 import logfire
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Literal
 from pika import BlockingConnection
 from pika.exchange_type import ExchangeType
 
+# every job type has a queue per priority, uploads of a user go to the interactive lane and
+# re-syncs of whole folders to the bulk one, so a backfill doesn't hold up an upload
+Priority = Literal["interactive", "bulk"]
+PRIORITIES: tuple[Priority, ...] = ("interactive", "bulk")
+
 class QueueConfig:
     exchange: str
     queue: str
@@ -11,6 +21,12 @@ class QueueConfig:
         self.exchange = exchange
         self.queue = queue
         self.routing_key = routing_key
+
+    def lane(self, priority: Priority) -> tuple[str, str]:
+        """Queue and routing key of a priority lane, the bulk lane is the original queue."""
+        if priority == "bulk":
+            return self.queue, self.routing_key
+        return f"{self.queue}.{priority}", f"{self.routing_key}.{priority}"
         
 queue_configs = {
     "ai.upload": QueueConfig("py-agent.upload", "file-proccess.ai", "q.file-proccess.ai"),
@@ -19,7 +35,7 @@ queue_configs = {
 
 class RabbitClient:
     conn: BlockingConnection
-    def __init__(self, host: str, port: str, username: str, password: str):
+    def __init__(self, host: str, port: int, username: str, password: str):
         logfire.info(f"Connect Rabbit {host}:{port}")
         self.host = host
         self.port = port
@@ -45,25 +61,92 @@ class RabbitClient:
                     config.exchange, 
                     exchange_type=ExchangeType.topic
                 )
-                self.channel.queue_declare(config.queue)
-                self.channel.queue_bind(
-                    exchange=config.exchange, 
-                    queue=config.queue, 
-                    routing_key=config.routing_key
-                )
+                for priority in PRIORITIES:
+                    queue, routing_key = config.lane(priority)
+                    self.channel.queue_declare(queue)
+                    self.channel.queue_bind(
+                        exchange=config.exchange, 
+                        queue=queue, 
+                        routing_key=routing_key
+                    )
                 
-    def publish(self, key: str, message: str):
+    def publish(self, key: str, message: str, priority: Priority = "bulk"):
         with logfire.span("rabbitmq.publish"):
             # check key exists
             if key not in queue_configs:
                 raise Exception(f"Queue config not found for {key}")
             
             config = queue_configs[key]
+            _, routing_key = config.lane(priority)
             self.channel.basic_publish(
                 exchange=config.exchange, 
-                routing_key=config.routing_key, 
+                routing_key=routing_key, 
                 body=message
             )
     
     def get_channel(self):
-        return self.channel
\ No newline at end of file
+        return self.channel
+
+    def close(self):
+        if self.conn.is_open:
+            self.conn.close()
+
+class RabbitPublisher:
+    """A `RabbitClient` for the event loop, kept on a thread of its own.
+
+    A blocking connection and its channel aren't thread-safe, so the connection is
+    opened, published on and closed only by the publisher's thread, and concurrent
+    publishes queue up behind each other instead of blocking the loop.
+    """
+    client: RabbitClient
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rabbitmq-publisher")
+
+    async def _run(self, fn, *args):
+        # carry the context over, so the publish span stays under the request
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(self.executor, context.run, fn, *args)
+
+    @classmethod
+    async def open(cls, connect: Callable[[], RabbitClient]) -> "RabbitPublisher":
+        publisher = cls()
+        try:
+            publisher.client = await publisher._run(connect)
+        except BaseException:
+            publisher.executor.shutdown(wait=False)
+            raise
+        return publisher
+
+    async def publish(self, key: str, message: str, priority: Priority = "bulk"):
+        await self._run(self.client.publish, key, message, priority)
+
+    async def close(self):
+        await self._run(self.client.close)
+        self.executor.shutdown(wait=False)
+
+class LaneScheduler:
+    """Deliveries taken from the priority lanes, in the order they are to be processed.
+
+    Interactive deliveries go first, but after `weight` of them in a row a waiting bulk
+    one is taken, so a stream of uploads doesn't stop a backfill either. With one
+    unacknowledged message per queue an interactive message waits for the job in
+    progress and the interactive ones ahead of it, not for the bulk queue.
+    """
+    def __init__(self):
+        self.pending: dict[Priority, deque] = {priority: deque() for priority in PRIORITIES}
+        # interactive deliveries taken in a row while bulk ones waited
+        self.streak = 0
+
+    def add(self, priority: Priority, delivery: tuple):
+        self.pending[priority].append(delivery)
+
+    def __len__(self) -> int:
+        return sum(len(lane) for lane in self.pending.values())
+
+    def next(self, weight: int = 4) -> tuple | None:
+        interactive, bulk = self.pending["interactive"], self.pending["bulk"]
+        if interactive and (not bulk or self.streak < weight):
+            self.streak = self.streak + 1 if bulk else 0
+            return interactive.popleft()
+        self.streak = 0
+        return bulk.popleft() if bulk else None
@@ -0,0 +1,142 @@
+"""Atlas vector search index for `doc_sections` and the query side that goes with it.
+
+The index declares `group`, `title`, `sources` and `language` as filter fields so a
+search can be narrowed before the nearest-neighbour scan. `num_candidates` sizes the
+scan from how many documents the filter matches instead of a fixed 150.
+
+    python -m databases.search_index    # create or update the index on doc_sections
+"""
+import math
+import time
+import asyncio
+import logfire
+
+from pymongo.operations import SearchIndexModel
+
+from utils.embedders import embedding_provider
+from utils.settings import get_settings
+
+VECTOR_INDEX_NAME = "embedding_index"
+EMBEDDING_PATH = "embedding"
+# `title` is the source file a section was split from, `sources` every file that contains it
+FILTER_FIELDS = ("group", "title", "sources", "language")
+
+# Atlas recommends 10 to 20 candidates per requested result and caps the scan at 10000
+CANDIDATES_PER_RESULT = 10
+MAX_NUM_CANDIDATES = 10000
+
+def vector_index_definition(dimensions: int | None = None, similarity: str = "cosine") -> dict:
+    """Index definition, the vectors have the dimensions of the configured embedding provider by default."""
+    dimensions = dimensions or embedding_provider().dimensions
+    fields = [{"type": "vector", "path": EMBEDDING_PATH, "numDimensions": dimensions, "similarity": similarity}]
+    fields += [{"type": "filter", "path": field} for field in FILTER_FIELDS]
+    return {"fields": fields}
+
+def _normalized(definition: dict) -> list[tuple]:
+    return sorted(tuple(sorted(field.items())) for field in definition.get("fields", []))
+
+async def ensure_vector_index(collection, definition: dict | None = None, name: str = VECTOR_INDEX_NAME) -> str:
+    """Create the vector index, or update it when its definition changed.
+
+    Returns "created", "updated" or "unchanged". Atlas builds the index in the
+    background, searches keep using the previous definition until it is done.
+    """
+    definition = definition or vector_index_definition()
+    cursor = await collection.list_search_indexes(name)
+    existing = await cursor.to_list()
+    if not existing:
+        await collection.create_search_index(SearchIndexModel(definition=definition, name=name, type="vectorSearch"))
+        logfire.info('Created search index {name}', name=name)
+        return "created"
+    current = existing[0].get("latestDefinition", {})
+    if _normalized(current) == _normalized(definition):
+        return "unchanged"
+    await collection.update_search_index(name, definition)
+    logfire.info('Updated search index {name}', name=name)
+    return "updated"
+
+async def ensure_filter_indexes(collection):
+    """Regular indexes on the filter fields, they keep the selectivity counts cheap."""
+    for field in FILTER_FIELDS:
+        await collection.create_index(field)
+
+def group_filter(group: str | None) -> dict:
+    return {"group": {"$eq": group}} if group else {}
+
+def num_candidates(limit: int, matching: int | None = None, total: int | None = None) -> int:
+    """Candidates for an approximate search returning `limit` results.
+
+    When the filter matches no more documents than the usual oversampling would scan,
+    all of them are candidates and the search is exact. For wider filters the scan
+    grows with 1/sqrt(selectivity), filtered out neighbours don't count towards it.
+    """
+    candidates = limit * CANDIDATES_PER_RESULT
+    if matching is not None:
+        if matching <= candidates:
+            return max(limit, matching)
+        if total:
+            candidates = math.ceil(candidates / math.sqrt(matching / total))
+        candidates = min(candidates, matching)
+    return max(limit, min(candidates, MAX_NUM_CANDIDATES))
+
+class SelectivityEstimator:
+    """Cached document counts per filter, refreshed after `ttl` seconds."""
+    ttl: float
+    def __init__(self, ttl: float = 300.0):
+        self.ttl = ttl
+        self.counts: dict[tuple[str, str], tuple[float, int]] = {}
+
+    async def _count(self, collection, query: dict) -> int:
+        key = (collection.name, repr(query))
+        cached = self.counts.get(key)
+        if cached is not None and time.monotonic() - cached[0] < self.ttl:
+            return cached[1]
+        if query:
+            count = await collection.count_documents(query)
+        else:
+            count = await collection.estimated_document_count()
+        self.counts[key] = (time.monotonic(), count)
+        return count
+
+    async def num_candidates(self, collection, query: dict, limit: int) -> int:
+        if not query:
+            return num_candidates(limit)
+        try:
+            matching, total = await asyncio.gather(self._count(collection, query), self._count(collection, {}))
+        except Exception as e:
+            # a missing count only costs precision, not the search
+            logfire.error(f"Could not estimate filter selectivity: {e}")
+            return num_candidates(limit)
+        return num_candidates(limit, matching, total)
+
+selectivity = SelectivityEstimator()
+
+def vector_search_stage(
+    embedding: list[float],
+    limit: int = 20,
+    query: dict | None = None,
+    candidates: int | None = None,
+    index: str = VECTOR_INDEX_NAME,
+) -> dict:
+    return {
+        '$vectorSearch': {
+            'index': index,
+            'path': EMBEDDING_PATH,
+            'filter': query or {},
+            'queryVector': embedding,
+            'numCandidates': candidates or num_candidates(limit),
+            'limit': limit
+        }
+    }
+
+async def main():
+    from databases.mongo import MongoClient
+    mongo_uri = get_settings().mongo_uri
+    if mongo_uri is None:
+        raise ValueError("MONGO_URI not found in .env file")
+    collection = MongoClient(mongo_uri, "pyAgent").get_collection("doc_sections")
+    await ensure_filter_indexes(collection)
+    print(await ensure_vector_index(collection))
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,83 +1,268 @@
+import time
+
+# measured from the very first import so /ready can report the cold start cost
+_import_started = time.perf_counter()
+
+import os
+import signal
 import uvicorn
+import asyncio
 import logging
 import models
 import logfire
 
-from fastapi import FastAPI
-from fastapi.responses import FileResponse
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import FileResponse, JSONResponse, Response
 from routers import default_webhook, rag_webhook, chat, learning
-from databases.memory import engine
-from dotenv import load_dotenv, get_key
+from databases.memory import add_missing_columns, engine
+from dotenv import load_dotenv
 from pathlib import Path
-from databases.mongo import MongoClient
-from databases.rabbitmq import RabbitClient
-from services.file_processor import FileProcessor
-from langchain_text_splitters import MarkdownTextSplitter
+from array import array
+from databases.mongo import get_shared_client, close_shared_clients
+from databases.embedding_space import embedding_spaces
+from databases.corpus_version import corpus_versions
+from databases.search_index import ensure_filter_indexes, ensure_vector_index, group_filter, selectivity, vector_search_stage
+from databases.rabbitmq import RabbitClient, RabbitPublisher
+from utils.admission import Overloaded, admission_stats
+from services.frontend import FrontendBundle
+from services.capture import CAPTURE_DIR, TrafficCapture
+from utils.profiling import ProfilingMiddleware
+from utils.vectors import to_bson_vector, to_float32
+from utils.embedders import embed_in_batches, embed_texts
+from utils.retrieval import cache_stats
+from utils.shared_cache import configured_workers
+from utils.settings import get_settings, reload_settings
 from openai import AsyncOpenAI
 from pydantic import BaseModel, Field
 
 # load the config from dot env file
 load_dotenv()
 
-logfire.configure(send_to_logfire='if-token-present', token=get_key(".env", "LOGFIRE_KEY"))
+logfire.configure(send_to_logfire='if-token-present', token=get_settings().logfire_key)
+logfire.instrument_asyncpg()
+
+THIS_DIR = Path(__file__).parent
+
+# setup logging
+logging.basicConfig(level=logging.INFO)
+
+IMPORT_SECONDS = time.perf_counter() - _import_started
+
+class Readiness:
+    """Startup state reported by `/ready`."""
+    ready: bool
+    checks: dict[str, str]
+    ready_seconds: float | None
+    def __init__(self):
+        self.ready = False
+        self.checks = {"rabbitmq": "pending", "mongo": "pending", "openai": "pending"}
+        self.ready_seconds = None
+
+readiness = Readiness()
+frontend = FrontendBundle()
+
+def connect_rabbit() -> RabbitClient:
+    settings = get_settings()
+    rabbit_client = RabbitClient(
+        host=settings.rabbit_host,
+        port=settings.rabbit_port,
+        username=settings.rabbit_user,
+        password=settings.rabbit_pass
+    )
+    rabbit_client.setup()
+    return rabbit_client
+
+async def warmup_rabbit(app: FastAPI):
+    app.state.rabbit_client = await RabbitPublisher.open(connect_rabbit)
+
+async def warmup_mongo(app: FastAPI):
+    settings = get_settings()
+    mongo_uri = settings.mongo_uri
+    if mongo_uri is None:
+        raise ValueError("MONGO_URI not found in .env file")
+    # opens the pool the request handlers share
+    mongo_client = get_shared_client(mongo_uri, "pyAgent")
+    await mongo_client.ping_async()
+    if settings.mongo_manage_indexes:
+        collection = mongo_client.get_collection("doc_sections")
+        await ensure_filter_indexes(collection)
+        await ensure_vector_index(collection)
+
+async def warmup_openai(app: FastAPI):
+    # any response, even a 401, means the TLS session of the shared model client is open
+    from openai import APIStatusError
+    from pydantic_ai.models import cached_async_http_client
+    from agents.mongo_rag import MongoRagAgent
+    base_url = get_settings().openai_base_url
+    await cached_async_http_client().get(f"{base_url}/models")
+    try:
+        await MongoRagAgent.openai.models.with_raw_response.list()
+    except APIStatusError:
+        pass
+
+def required_checks() -> set[str]:
+    """The checks `/ready` waits for, `READY_CHECKS` is a comma separated subset or `none`."""
+    names = {name.strip() for name in get_settings().ready_checks.split(",")}
+    return names & set(readiness.checks)
+
+async def warmup(app: FastAPI, retry_delay: float = 5.0):
+    """Open connection pools and TLS sessions, retrying failed checks until all pass.
+
+    The service is ready once the checks in `READY_CHECKS` pass, the others keep being
+    retried in the background.
+    """
+    steps = {"rabbitmq": warmup_rabbit, "mongo": warmup_mongo, "openai": warmup_openai}
+    with logfire.span('warmup'):
+        while True:
+            if not readiness.ready and all(readiness.checks[name] == "ok" for name in required_checks()):
+                readiness.ready = True
+                readiness.ready_seconds = time.perf_counter() - _import_started
+                logging.info("Service ready in %.3fs (imports %.3fs)", readiness.ready_seconds, IMPORT_SECONDS)
+            pending = [name for name, state in readiness.checks.items() if state != "ok"]
+            if not pending:
+                break
+            if any(readiness.checks[name] != "pending" for name in pending):
+                # retrying checks that failed
+                await asyncio.sleep(retry_delay)
+            results = await asyncio.gather(*(steps[name](app) for name in pending), return_exceptions=True)
+            for name, result in zip(pending, results):
+                if isinstance(result, BaseException):
+                    logging.error("Warmup of %s failed: %s", name, result)
+                    readiness.checks[name] = f"error: {result}"
+                else:
+                    readiness.checks[name] = "ok"
+
+def log_build_failure(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logging.error("Frontend build failed: %s", task.exception())
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.rabbit_client = None
+    await asyncio.to_thread(models.Base.metadata.create_all, bind=engine)
+    await asyncio.to_thread(add_missing_columns)
+    warmup_task = asyncio.create_task(warmup(app))
+    loop = asyncio.get_running_loop()
+    try:
+        # `kill -HUP <pid>` re-reads .env, with several workers uvicorn restarts them on SIGHUP instead
+        loop.add_signal_handler(signal.SIGHUP, reload_settings)
+    except (AttributeError, NotImplementedError, RuntimeError):
+        # no SIGHUP on Windows, no signal handlers outside the main thread
+        pass
+    build_task = None
+    if get_settings().frontend_build_on_startup:
+        # off the startup path, the page keeps using the in-browser compile until it is done
+        build_task = asyncio.create_task(asyncio.to_thread(frontend.ensure_built))
+        build_task.add_done_callback(log_build_failure)
+    yield
+    warmup_task.cancel()
+    if build_task is not None:
+        build_task.cancel()
+    if hasattr(signal, "SIGHUP"):
+        loop.remove_signal_handler(signal.SIGHUP)
+    if app.state.rabbit_client is not None:
+        await app.state.rabbit_client.close()
+    await close_shared_clients()
 
 # setup fastapi
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 app.include_router(default_webhook.router)
 app.include_router(rag_webhook.router)
 app.include_router(chat.router)
 app.include_router(learning.router)
+startup_settings = get_settings()
+if startup_settings.capture_traffic:
+    # sanitized request and timing traces of the chat, webhook and learning endpoints
+    app.add_middleware(
+        TrafficCapture,
+        directory=Path(startup_settings.capture_dir or CAPTURE_DIR),
+        max_bytes=startup_settings.capture_max_mb * 1024 * 1024,
+    )
+if startup_settings.profile_token:
+    # requests sending `X-Profile: <PROFILE_TOKEN>` are profiled, nothing is installed otherwise
+    app.add_middleware(ProfilingMiddleware, token=startup_settings.profile_token)
 
-models.Base.metadata.create_all(bind=engine)
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded) -> JSONResponse:
+    return JSONResponse(
+        {"message": str(exc)},
+        status_code=503,
+        headers={"Retry-After": str(exc.retry_after)},
+    )
 
-THIS_DIR = Path(__file__).parent
+@app.get('/metrics/admission')
+async def admission_metrics():
+    """Queue depth, in-flight and shed counts per admission controlled endpoint."""
+    return admission_stats()
 
+@app.get('/metrics/cache')
+async def cache_metrics():
+    """Shared cache size and this worker's hit rates."""
+    return {"pid": os.getpid(), **cache_stats()}
 
-rabbit_client = RabbitClient(
-    host=get_key(".env", "RABBIT_HOST"),
-    port=get_key(".env", "RABBIT_PORT"),
-    username=get_key(".env", "RABBIT_USER"),
-    password=get_key(".env", "RABBIT_PASS")
-)
+@app.get('/ready')
+async def ready() -> JSONResponse:
+    """Readiness probe, 503 until the warmup phase has finished."""
+    return JSONResponse(
+        {
+            "ready": readiness.ready,
+            "checks": readiness.checks,
+            "import_seconds": IMPORT_SECONDS,
+            "ready_seconds": readiness.ready_seconds,
+        },
+        status_code=200 if readiness.ready else 503,
+    )
 
-# setup logging
-logging.basicConfig(level=logging.INFO)
 @app.get('/')
-async def index() -> FileResponse:
-    return FileResponse((THIS_DIR / "public" / 'index.html'), media_type='text/html')
+async def index(request: Request) -> Response:
+    return frontend.index_response(request.headers.get('if-none-match'))
+
+
+@app.get('/assets/{filename}')
+async def assets(filename: str, request: Request) -> Response:
+    """Compiled, content hashed frontend bundle, cached by browsers forever."""
+    return frontend.asset_response(
+        filename,
+        request.headers.get('accept-encoding'),
+        request.headers.get('if-none-match'),
+    )
 
 
 @app.get('/chat_app.ts')
 async def main_ts() -> FileResponse:
-    """Get the raw typescript code, it's compiled in the browser, forgive me."""
+    """Get the raw typescript code, only used by the in-browser compile when there is no bundle."""
     return FileResponse((THIS_DIR / "public" / 'chat_app.ts'), media_type='text/plain')
 
 class DocSection:
+    __slots__ = ("slug", "title", "content", "embedding")
     slug: str
     title: str
     content: str
-    embedding: list[float]
+    embedding: array | None
     
-    def __init__(self, slug: str, title: str, content: str, embedding: list[float]):
+    def __init__(self, slug: str, title: str, content: str, embedding: array | list[float] | None = None):
         self.slug = slug
         self.title = title
         self.content = content
-        self.embedding = embedding
+        self.embedding = to_float32(embedding) if embedding is not None else None
     def to_dict(self):
-        return {
+        doc = {
             "slug": self.slug,
             "title": self.title,
             "content": self.content,
-            "embedding": self.embedding
         }
+        if self.embedding is not None:
+            doc["embedding"] = to_bson_vector(self.embedding)
+        return doc
 
 @app.get("/test-mongo")
 async def test_mongo():
-    mongo_uri = get_key(".env", "MONGO_URI")
+    mongo_uri = get_settings().mongo_uri
     if mongo_uri is None:
         logging.error("MONGO_URI not found in .env file")
         return
-    mongo_client = MongoClient(mongo_uri, "pyAgent")
+    mongo_client = get_shared_client(mongo_uri, "pyAgent")
     mongo_client.ping()
     col = mongo_client.get_collection("doc_sections")
     data = col.find({})
@@ -88,27 +273,31 @@ async def test_mongo():
         list_docs.append(DocSection(slug=doc["slug"], title=doc["title"], content=doc["content"]))
     
     return {
-        "data": list_docs
+        "data": [doc.to_dict() for doc in list_docs]
     }
 
 @app.get("/test-rabbit")
-def test_rabbit():
-    rabbit_client.publish("ai.upload", "./uploads/ocbc-doc-tech.pdf")
+async def test_rabbit(request: Request):
+    rabbit_client = request.app.state.rabbit_client
+    if rabbit_client is None:
+        raise HTTPException(status_code=503, detail="RabbitMQ is not connected yet")
+    await rabbit_client.publish("ai.upload", "./uploads/ocbc-doc-tech.pdf")
     return {
         "message": "success"
     }
     
 @app.get("/test-split")
 async def test_split():
+    from langchain_text_splitters import MarkdownTextSplitter
     list_docs: list[DocSection] = []
     content = ""
     open_ai = AsyncOpenAI()
     logfire.instrument_openai(open_ai)
-    mongo_uri = get_key(".env", "MONGO_URI")
+    mongo_uri = get_settings().mongo_uri
     if mongo_uri is None:
         logging.error("MONGO_URI not found in .env file")
         return
-    mongo_client = MongoClient(mongo_uri, "pyAgent")
+    mongo_client = get_shared_client(mongo_uri, "pyAgent")
     mongo_client.ping()
     col = mongo_client.get_collection("doc_sections")
     # open the file
@@ -117,52 +306,40 @@ async def test_split():
     with logfire.span('split_file'):
         md_splitter = MarkdownTextSplitter(chunk_size=1000, chunk_overlap=200)
         chunks = md_splitter.split_text(content)
-        for chunk in chunks:
-            try:
-                embedding = await open_ai.embeddings.create(
-                    input=chunk,
-                    model='text-embedding-3-small',
-                )
-                list_docs.append(DocSection(slug="ocbc-doc-tech.md", title="SNAP OCBC Doc Tech", content=chunk, embedding=embedding.data[0].embedding))
-            except Exception as e:
-                logfire.error(e)
+        embeddings = await embed_in_batches(open_ai, chunks)
+        for chunk, embedding in zip(chunks, embeddings):
+            if embedding is not None:
+                list_docs.append(DocSection(slug="ocbc-doc-tech.md", title="SNAP OCBC Doc Tech", content=chunk, embedding=embedding))
     # with logfire.span('insert'):
         list_docs_dict = [doc.to_dict() for doc in list_docs]
+        await embedding_spaces.ensure(mongo_client, "doc_sections")
         await col.insert_many(list_docs_dict)
+        await corpus_versions.bump(mongo_client, "doc_sections")
     return {
         "message": "success"
     }
 
 class SearchRequest(BaseModel):
     message: str = Field(min_length=1, max_length=1000)
+    group: str | None = None
     
 @app.post("/test-search")
 async def test_search(payload: SearchRequest):
-    mongo_uri = get_key(".env", "MONGO_URI")
+    mongo_uri = get_settings().mongo_uri
     if mongo_uri is None:
         logging.error("MONGO_URI not found in .env file")
         return
-    mongo_client = MongoClient(mongo_uri, "pyAgent")
+    mongo_client = get_shared_client(mongo_uri, "pyAgent")
     mongo_client.ping()
     open_ai = AsyncOpenAI()
+    await embedding_spaces.ensure(mongo_client, "doc_sections")
     col = mongo_client.get_collection("doc_sections")
-    # open the file
-    embedding = await open_ai.embeddings.create(
-        input=payload.message,
-        model='text-embedding-3-small',
-    )
-    query_embedding = embedding.data[0].embedding
+    embeddings = await embed_texts(open_ai, [payload.message])
+    query_embedding = embeddings[0].tolist()
+    query = group_filter(payload.group)
+    candidates = await selectivity.num_candidates(col, query, 20)
     pipeline = [
-        {
-            '$vectorSearch': {
-                'index': 'embedding_index', 
-                'path': 'embedding', 
-                'filter': {}, 
-                'queryVector': query_embedding, 
-                'numCandidates': 150, 
-                'limit': 20
-            }
-        }, 
+        vector_search_stage(query_embedding, limit=20, query=query, candidates=candidates), 
         {
             '$project': {
                 '_id': 0, 
@@ -187,21 +364,21 @@ async def test_search(payload: SearchRequest):
     }
 
 def main():
-    port = get_key(".env", "PORT")
-    try:
-        logging.info("Try to settup RabbitMQ...")
-        rabbit_client.setup()
-    except Exception as e:
-        logging.error("Failed to connect to RabbitMQ: %s", e)
-        return
-    
+    port = get_settings().port
+    # RabbitMQ, Mongo and OpenAI connections are opened by the warmup phase in `lifespan`
     # FileProcessor("./uploads/ocbc-doc-tech.pdf").process_file()
-    if port is None:
-        port = 8000
+    workers = configured_workers()
+    logging.info("Starting Service at port %s with %s worker(s)", port, workers)
+    if workers > 1:
+        # the workers would race to create the tables of a new database
+        models.Base.metadata.create_all(bind=engine)
+        add_missing_columns()
+        # every worker is a fresh interpreter that imports this module and runs `lifespan`,
+        # so connections, clients and logfire are set up per worker, the caches are shared
+        # through SHARED_CACHE_URL
+        uvicorn.run("main:app", host="0.0.0.0", port=port, workers=workers)
     else:
-        port = int(port)
-    logging.info("Starting Service at port %s", port)
-    uvicorn.run(app, host="0.0.0.0", port=port)
+        uvicorn.run(app, host="0.0.0.0", port=port)
 
 if __name__ == "__main__":
     main()
@@ -1,7 +1,9 @@
 from databases.memory import Base
-from sqlalchemy import Column, Integer, String, Enum as SqlEnum, DateTime
+from sqlalchemy import Column, Integer, String, Enum as SqlEnum, DateTime, LargeBinary
 from sqlalchemy.sql import func
 from enum import Enum
+from array import array
+from utils.vectors import to_bson_vector, to_float32
 
 class MessageRole(Enum):
     AI = 'AI'
@@ -19,22 +21,55 @@ class Messages(Base):
     session_id = Column(String)
     message = Column(String)
     created_at = Column(DateTime, default=func.now())
+
+class MessageTurns(Base):
+    """Every model message of one agent run, tool calls and results included, as a compressed JSON blob."""
+    __tablename__ = 'message_turns'
+
+    id = Column(Integer, primary_key=True, index=True)
+    session_id = Column(String, index=True)
+    messages = Column(LargeBinary)
+    # prompt tokens of the messages, counted once when the turn is saved
+    tokens = Column(Integer, nullable=True)
+    created_at = Column(DateTime, default=func.now())
+
+class SessionSummary(Base):
+    """Running summary of the oldest `turns` turns of a session, sent instead of them."""
+    __tablename__ = 'session_summaries'
+
+    session_id = Column(String, primary_key=True)
+    summary = Column(String)
+    turns = Column(Integer)
+    updated_at = Column(DateTime, default=func.now())
     
 class DocSection:
+    """A chunk on its way into `doc_sections`, the embedding is a float32 array (6 KB instead of ~50 KB of floats)."""
+    __slots__ = ("group", "title", "content", "embedding", "content_hash", "minhash", "language")
     group: str
     title: str
     content: str
-    embedding: list[float]
+    embedding: array
+    content_hash: str
+    minhash: list[int]
+    language: str
     
-    def __init__(self, group: str, title: str, content: str, embedding: list[float]):
+    def __init__(self, group: str, title: str, content: str, embedding: array | list[float], content_hash: str = "", minhash: list[int] | None = None, language: str = "en"):
         self.group = group
         self.title = title
         self.content = content
-        self.embedding = embedding
+        self.embedding = to_float32(embedding)
+        self.content_hash = content_hash
+        self.minhash = minhash if minhash is not None else []
+        self.language = language
     def to_dict(self):
         return {
             "group": self.group,
             "title": self.title,
             "content": self.content,
-            "embedding": self.embedding
-        }
\ No newline at end of file
+            # written as a BSON float32 vector, no list of floats is built on the way
+            "embedding": to_bson_vector(self.embedding),
+            "content_hash": self.content_hash,
+            "minhash": self.minhash,
+            "sources": [self.title],
+            "language": self.language,
+        }
@@ -1,12 +1,17 @@
-// BIG FAT WARNING: to avoid the complexity of npm, this typescript is compiled in the browser
-// there's currently no static type checking
+// compiled once to minified JS by `python -m services.frontend` (esbuild, no static type checking),
+// the in-browser compile in index.html is only the fallback when no build exists
 
 import { marked } from 'https://cdnjs.cloudflare.com/ajax/libs/marked/15.0.0/lib/marked.esm.js'
 const convElement = document.getElementById('conversation')
 
 const promptInput = document.getElementById('prompt-input') as HTMLInputElement
 const spinner = document.getElementById('spinner')
-const learnButton = document.getElementById('learn-btn')
+const learnButton = document.getElementById('learn-btn') as HTMLButtonElement | null
+const loadOlderButton = document.getElementById('load-older-btn') as HTMLButtonElement
+
+// history is loaded a page at a time, older pages when the user asks for them
+const HISTORY_PAGE_SIZE = 50
+let nextBefore: string | null = null
 
 // stream the response and render messages as each chunk is received
 // data is sent as newline-delimited JSON
@@ -40,6 +45,7 @@ interface Message {
   role: string
   content: string
   timestamp: string
+  id?: number
 }
 
 // take raw response text and render messages into the `#conversation` element
@@ -49,25 +55,52 @@ interface Message {
 function addMessages(responseText: string) {
   const lines = responseText.split('\n')
   const messages: Message[] = lines.filter(line => line.length > 1).map(j => JSON.parse(j))
-  let counter = 0
   for (const message of messages) {
-    // we use the timestamp as a crude element id
-    const {timestamp, role, content} = message
-    const id = `msg-${timestamp}-${role}`
-    let msgDiv = document.getElementById(id)
-    if (!msgDiv) {
-      msgDiv = document.createElement('div')
-      msgDiv.id = id
-      msgDiv.title = `${role} at ${timestamp}`
-      msgDiv.classList.add('border-top', 'pt-2', role)
-      convElement.appendChild(msgDiv)
-    }
-    msgDiv.innerHTML = marked.parse(content)
-    counter++
+    renderMessage(message, null)
   }
   window.scrollTo({ top: document.body.scrollHeight, behavior: 'smooth' })
 }
 
+// render a message, new elements are appended or inserted before `before`
+function renderMessage(message: Message, before: Element | null) {
+  // we use the timestamp as a crude element id
+  const {timestamp, role, content} = message
+  const id = `msg-${timestamp}-${role}`
+  let msgDiv = document.getElementById(id)
+  if (!msgDiv) {
+    msgDiv = document.createElement('div')
+    msgDiv.id = id
+    msgDiv.title = `${role} at ${timestamp}`
+    msgDiv.classList.add('border-top', 'pt-2', role)
+    convElement.insertBefore(msgDiv, before)
+  }
+  msgDiv.innerHTML = marked.parse(content)
+}
+
+function updateLoadOlder(response: Response) {
+  nextBefore = response.headers.get('X-Next-Before')
+  loadOlderButton?.classList.toggle('d-none', !nextBefore)
+}
+
+// older pages go above the messages already shown, without scrolling away from them
+async function onLoadOlder(e: MouseEvent): Promise<void> {
+  e.preventDefault()
+  if (!nextBefore) {
+    return
+  }
+  const response = await fetch(`/chat/?limit=${HISTORY_PAGE_SIZE}&before=${nextBefore}`)
+  if (!response.ok) {
+    throw new Error(`Unexpected response: ${response.status}`)
+  }
+  updateLoadOlder(response)
+  const text = await response.text()
+  const first = convElement.firstElementChild
+  const messages: Message[] = text.split('\n').filter(line => line.length > 1).map(j => JSON.parse(j))
+  for (const message of messages) {
+    renderMessage(message, first)
+  }
+}
+
 function onError(error: any) {
   console.error(error)
   document.getElementById('error').classList.remove('d-none')
@@ -89,7 +122,7 @@ async function onSubmit(e: SubmitEvent): Promise<void> {
 async function onLearn(e: MouseEvent): Promise<void> {
   e.preventDefault()
   spinner.classList.add('active')
-  learnButton?.disabled = true
+  if (learnButton) learnButton.disabled = true
   const response = await fetch('/webhook/rag/build', {method: 'POST'})
   if (response.ok) {
     alert('RAG built successfully')
@@ -97,13 +130,17 @@ async function onLearn(e: MouseEvent): Promise<void> {
     console.error(`Unexpected response: ${response.status}`)
     throw new Error(`Unexpected response: ${response.status}`)
   }
-  learnButton?.disabled = false
+  if (learnButton) learnButton.disabled = false
   spinner.classList.remove('active')
 }
 
 // call onSubmit when the form is submitted (e.g. user clicks the send button or hits Enter)
 document.querySelector('form').addEventListener('submit', (e) => onSubmit(e).catch(onError))
 learnButton?.addEventListener('click', (e) => onLearn(e).catch(onError))
+loadOlderButton?.addEventListener('click', (e) => onLoadOlder(e).catch(onError))
 
-// load messages on page load
-fetch('/chat/').then(onFetchResponse).catch(onError)
+// load the newest page of messages on page load
+fetch(`/chat/?limit=${HISTORY_PAGE_SIZE}`).then((response) => {
+  updateLoadOlder(response)
+  return onFetchResponse(response)
+}).catch(onError)
@@ -2,24 +2,24 @@ import json
 
 from datetime import datetime, timezone
 from typing import Annotated, Literal
-from typing_extensions import TypedDict
-from dotenv import get_key
+from typing_extensions import NotRequired, TypedDict
 
 from models import Messages, MessageRole
 from databases.memory import SessionLocal
 from sqlalchemy.orm import Session
 
-from fastapi import APIRouter, Depends, Form as FastApiForm
-from fastapi.responses import FileResponse, Response, StreamingResponse
+from fastapi import APIRouter, Depends, Query, Request, Form as FastApiForm
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 
 from agents.rag import run_stream_agent
 from agents.mongo_rag import MongoRagAgent
+from utils.admission import get_controller
+from utils.compression import accepts_gzip, gzip_stream
+from utils.history import load_history, save_turn
+from utils.profiling import scope
+from utils.settings import Settings, get_settings
 
-from pydantic_ai.messages import (
-    ModelMessage,
-    ModelResponse,
-    TextPart,
-)
 from pydantic_ai.exceptions import UnexpectedModelBehavior
 
 router = APIRouter(
@@ -33,23 +33,104 @@ def get_db():
     finally:
         db.close()
 db_dependency = Annotated[Session, Depends(get_db)]
+settings_dependency = Annotated[Settings, Depends(get_settings)]
 
 SESSION_ID = 'rag-session-05' # TODO: get from session
 
+HISTORY_BATCH_SIZE = 100
+
 @router.get('/')
-async def index(db: db_dependency) -> FileResponse:
-    messages = db.query(Messages).filter(Messages.session_id == SESSION_ID).all()
-    return Response(
-        b'\n'.join(json.dumps(to_chat_message(m)).encode('utf-8') for m in messages),
-        media_type='text/plain',
-    )
+async def index(
+    request: Request,
+    db: db_dependency,
+    before: int | None = None,
+    after: int | None = None,
+    limit: Annotated[int, Query(ge=1, le=500)] = 50,
+) -> StreamingResponse:
+    """Page of the chat history as new line delimited JSON, oldest message first.
+
+    Without a cursor the newest `limit` messages are returned. `before` pages back to older
+    messages, `after` fetches messages newer than the given id. The cursors for the next
+    pages are sent in the `X-Next-Before` and `X-Next-After` headers.
+    """
+    # only the ids of the page are loaded here, the rows themselves are streamed below
+    ids_query = db.query(Messages.id).filter(Messages.session_id == SESSION_ID)
+    if after is not None:
+        ids_query = ids_query.filter(Messages.id > after).order_by(Messages.id.asc())
+    else:
+        if before is not None:
+            ids_query = ids_query.filter(Messages.id < before)
+        ids_query = ids_query.order_by(Messages.id.desc())
+    ids = [row.id for row in ids_query.limit(limit)]
+
+    headers = {'Vary': 'Accept-Encoding'}
+    if ids:
+        headers['X-Next-After'] = str(max(ids))
+        if after is None and len(ids) == limit:
+            headers['X-Next-Before'] = str(min(ids))
+    elif after is not None:
+        headers['X-Next-After'] = str(after)
+
+    def stream_history():
+        if not ids:
+            return
+        # own session, the request scoped one is closed once the handler returns
+        stream_db = SessionLocal()
+        try:
+            rows = (
+                stream_db.query(Messages)
+                .filter(Messages.session_id == SESSION_ID, Messages.id >= min(ids), Messages.id <= max(ids))
+                .order_by(Messages.id.asc())
+                .execution_options(stream_results=True)
+                .yield_per(HISTORY_BATCH_SIZE)
+            )
+            for m in rows:
+                yield json.dumps(to_chat_message(m)).encode('utf-8') + b'\n'
+        finally:
+            stream_db.close()
+
+    body = stream_history()
+    if accepts_gzip(request.headers.get('accept-encoding')):
+        body = gzip_stream(body)
+        headers['Content-Encoding'] = 'gzip'
+    # a sync iterator, starlette runs it in the threadpool so the database reads don't block the loop
+    return StreamingResponse(body, media_type='text/plain', headers=headers)
 
 @router.post('/')
 async def post_chat(
-    prompt: Annotated[str, FastApiForm()], db: db_dependency
+    prompt: Annotated[str, FastApiForm()], db: db_dependency, settings: settings_dependency
 ) -> StreamingResponse:
+    # the slot is taken before streaming starts, so an overloaded server answers 503 straight away,
+    # and it is held until the stream has finished
+    admission = get_controller("chat")
+    admitted_at = await admission.acquire()
+    try:
+        agent = MongoRagAgent(settings.mongo_uri, eager=settings.eager_retrieval)
+        # in eager mode the question is embedded and searched while the history loads
+        agent.prefetch(prompt)
+    except BaseException:
+        admission.release(admitted_at)
+        raise
+
+    released = False
+    def release_slot():
+        # called from the stream and as background task, the latter also covers a client
+        # that disconnects before the stream is started
+        nonlocal released
+        if not released:
+            released = True
+            admission.release(admitted_at)
+
     async def stream_messages():
         """Streams new line delimited JSON `Message`s to the client."""
+        try:
+            with scope("post_chat stream"):
+                async for chunk in stream_agent_messages():
+                    yield chunk
+        finally:
+            release_slot()
+
+    async def stream_agent_messages():
         # stream the user prompt so that can be displayed straight away
         yield (
             json.dumps(
@@ -62,16 +143,9 @@ async def post_chat(
             + b'\n'
         )
         result = ""
-        messages = db.query(Messages).filter(Messages.session_id == SESSION_ID).all()
-        message_history: list = []
-        for m in messages:
-            if m.role == MessageRole.USER:
-                continue
-            message_history.append(
-                to_model_message(m)
-            )
-        mongo_uri = get_key(".env", "MONGO_URI")
-        agent = MongoRagAgent(mongo_uri)
+        new_messages = []
+        # the full history, tool calls and their results included, so follow-ups reuse what was retrieved
+        message_history = load_history(db, SESSION_ID)
         # async for stream in run_stream_agent(prompt, messages=message_history):
         async for stream in agent.run_stream_agent(prompt, messages=message_history):
             async for text in stream.stream(debounce_by=0.01):
@@ -85,21 +159,10 @@ async def post_chat(
                     created_at=stream.timestamp(),
                 )
                 yield json.dumps(to_chat_message(m)).encode('utf-8') + b'\n'
+            new_messages = stream.new_messages()
         #  insert chat histories
-        user_message = Messages(
-            role=MessageRole.USER,
-            session_id=SESSION_ID,
-            message=prompt,
-        )
-        db.add(user_message)
-        ai_message = Messages(
-            role=MessageRole.AI,
-            session_id=SESSION_ID,
-            message=result,
-        )
-        db.add(ai_message)
-        db.commit()
-    return StreamingResponse(stream_messages(), media_type='text/plain')
+        save_turn(db, SESSION_ID, prompt, result, new_messages)
+    return StreamingResponse(stream_messages(), media_type='text/plain', background=BackgroundTask(release_slot))
 
 class ChatMessage(TypedDict):
     """Format of messages sent to the browser."""
@@ -107,25 +170,24 @@ class ChatMessage(TypedDict):
     role: Literal['user', 'model']
     timestamp: str
     content: str
+    id: NotRequired[int]
 
 def to_chat_message(m: Messages) -> ChatMessage:
     if m.role == MessageRole.USER:
-        return {
+        message: ChatMessage = {
             'role': 'user',
             'timestamp': m.created_at.isoformat(),
             'content': m.message,
         }
     elif m.role == MessageRole.AI:
-        return {
+        message = {
             'role': 'model',
             'timestamp': m.created_at.isoformat(),
             'content': m.message,
         }
-    raise UnexpectedModelBehavior(f'Unexpected message type for chat app: {m}')
-
-def to_model_message(message: Messages) -> ModelMessage:
-    if message.role != MessageRole.USER:
-        return ModelResponse(
-        parts=[TextPart(content=message.message)],
-        timestamp=message.created_at.timestamp(),
-    )
\ No newline at end of file
+    else:
+        raise UnexpectedModelBehavior(f'Unexpected message type for chat app: {m}')
+    # stored messages carry their id, the frontend uses it as pagination cursor
+    if m.id is not None:
+        message['id'] = m.id
+    return message
@@ -2,15 +2,12 @@ from pydantic import BaseModel, Field
 from sqlalchemy.orm import Session
 from fastapi import APIRouter, Depends
 from starlette import status
-from models import Messages, MessageRole
 from databases.memory import SessionLocal
 from agents.chat import ChatAgent
+from utils.admission import get_controller
+from utils.history import load_history, save_turn
+from utils.answer_stream import admitted_response, answer_events
 from typing import Annotated
-from pydantic_ai.messages import (
-    ModelMessage, 
-    TextPart, 
-    ModelResponse
-)
 
 router = APIRouter(
     prefix="/webhook/default",
@@ -30,38 +27,34 @@ class MessageRequest(BaseModel):
     session_id: str = Field(min_length=1)
     message: str = Field(min_length=1, max_length=1000)
     
-def to_model_message(message: Messages) -> ModelMessage:
-    if message.role != MessageRole.USER:
-        return ModelResponse(
-        parts=[TextPart(content=message.message)],
-        timestamp=message.created_at.timestamp(),
-    )
-
 @router.post("/", status_code=status.HTTP_200_OK)
 async def default_webhook(message_request: MessageRequest, db: db_dependency):
-    messages = db.query(Messages).filter(Messages.session_id == message_request.session_id).all()
-    message_history: list = []
-    for m in messages:
-        if m.role == MessageRole.USER:
-            continue
-        message_history.append(
-            to_model_message(m)
-        )
+    message_history = load_history(db, message_request.session_id)
     
-    result = await chat_agent.chat(message_request.message, message_history)
-    user_message = Messages(
-        role=MessageRole.USER,
-        session_id=message_request.session_id,
-        message=message_request.message,
-    )
-    db.add(user_message)
+    async with get_controller("default_webhook").admit():
+        result = await chat_agent.chat(message_request.message, message_history)
+    save_turn(db, message_request.session_id, message_request.message, result.data, result.new_messages())
     
-    ai_message = Messages(
-        role=MessageRole.AI,
-        session_id=message_request.session_id,
-        message=result.data,
+    return {"message": message_request.message, "session_id": message_request.session_id, "content": result.data}
+
+@router.post("/stream", status_code=status.HTTP_200_OK)
+async def default_webhook_stream(message_request: MessageRequest, db: db_dependency):
+    """`default_webhook` streamed as new line delimited JSON events, see `utils.answer_stream`."""
+    message_history = load_history(db, message_request.session_id)
+    admission = get_controller("default_webhook")
+    admitted_at = await admission.acquire()
+
+    def save(answer: str, stream):
+        # own session, the request scoped one is closed by the time the stream ends
+        stream_db = SessionLocal()
+        try:
+            save_turn(stream_db, message_request.session_id, message_request.message, answer, stream.new_messages())
+        finally:
+            stream_db.close()
+
+    events = answer_events(
+        chat_agent.chat_stream(message_request.message, message_history),
+        on_complete=save,
+        extra={"session_id": message_request.session_id},
     )
-    db.add(ai_message)
-    db.commit()
-    
-    return {"message": message_request.message, "session_id": message_request.session_id, "content": result.data}
\ No newline at end of file
+    return admitted_response(admission, admitted_at, events)
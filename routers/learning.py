@@ -1,27 +1,40 @@
 import os
+import asyncio
 import logfire
 
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 from starlette import status
 from openai import AsyncOpenAI
-from dotenv import get_key
-from langchain_text_splitters import MarkdownTextSplitter
 from pydantic import BaseModel, Field
+from pydantic_ai.result import RunResult
+from typing import Annotated
 
-from databases.mongo import MongoClient
-from databases.rabbitmq import RabbitClient
+from databases.mongo import get_shared_client
+from databases.corpus_version import corpus_versions
+from databases.rabbitmq import Priority
 from models import DocSection
 from utils.embedding import Embedding
-from agents.mongo_rag import MongoRagAgent
+from utils.embedders import embed_in_batches
+from agents.mongo_rag import MongoRagAgent, ask_many
+from utils.admission import get_controller
+from utils.retrieval import answer_cache
+from services.upload import UPLOAD_DIR, UploadError, receive_upload
+from utils.settings import Settings, get_settings
+from utils.answer_stream import MEDIA_TYPE, admitted_response, answer_events, event
 
 router = APIRouter(
     prefix="/learning",
 )
 
+settings_dependency = Annotated[Settings, Depends(get_settings)]
+
 async def create_embbeding(file_path: str, filename: str):
     content = ""
     list_docs: list[DocSection] = []
     open_ai = AsyncOpenAI()
+    from langchain_text_splitters import MarkdownTextSplitter
     # open the file
     with open(file_path, "r") as f:
             content = f.read()
@@ -29,34 +42,27 @@ async def create_embbeding(file_path: str, filename: str):
     # splitting file
     with logfire.span('split_file'):
         md_splitter = MarkdownTextSplitter(chunk_size=1000, chunk_overlap=200)
-        chunks = md_splitter.split_text(content)
-        for chunk in chunks:
-            chunk = f"{filename} {chunk}"
-            try:
-                # create embedding for each chunk
-                embedding = await open_ai.embeddings.create(
-                    input=chunk,
-                    model='text-embedding-3-small',
-                )
-                list_docs.append(DocSection(group="ocbc-doc-tech", title=filename, content=chunk, embedding=embedding.data[0].embedding))
-            except Exception as e:
-                logfire.error(e)
+        chunks = [f"{filename} {chunk}" for chunk in md_splitter.split_text(content)]
+        embeddings = await embed_in_batches(open_ai, chunks)
+        for chunk, embedding in zip(chunks, embeddings):
+            if embedding is not None:
+                list_docs.append(DocSection(group="ocbc-doc-tech", title=filename, content=chunk, embedding=embedding))
         list_docs_dict = [doc.to_dict() for doc in list_docs]
         return list_docs_dict
 
 @router.get("/sync", status_code=status.HTTP_200_OK)
-async def get_learning():
+async def get_learning(settings: settings_dependency):
     """Learing all documents in folder uploads/ocbc-doc-tech
 
     Returns:
         _type_: _description_
     """
     file_path = "./uploads/ocbc-doc-tech/01.intro.md"
-    mongo_uri = get_key(".env", "MONGO_URI")
+    mongo_uri = settings.mongo_uri
     if mongo_uri is None:
         logfire.error("MONGO_URI not found in .env file")
         return
-    mongo_client = MongoClient(mongo_uri, "pyAgent")
+    mongo_client = get_shared_client(mongo_uri, "pyAgent")
     mongo_client.ping()
     emmbedding_pkg = Embedding()
     embeding_file = await emmbedding_pkg.generate_from_file(file_path, "01.intro.md")
@@ -64,26 +70,25 @@ async def get_learning():
     # col = mongo_client.get_collection("doc_sections")
     
     
-    return {"message": "Learning", "file": file_path, "embeding_file": embeding_file}
+    # the vectors are binary now, the response only shows what was generated
+    sections = [{k: v for k, v in doc.items() if k != "embedding"} for doc in embeding_file]
+    return {"message": "Learning", "file": file_path, "embeding_file": sections}
 
 
 @router.get("/async", status_code=status.HTTP_200_OK)
-async def async_learning():
-    """Learing all documents in folder asynchronously
+async def async_learning(request: Request, settings: settings_dependency, priority: Priority = "bulk"):
+    """Learing all documents in folder asynchronously, in the bulk lane unless `priority` says otherwise
     """
     folder_path = "./uploads/ocbc-doc-tech"
-    mongo_uri = get_key(".env", "MONGO_URI")
+    mongo_uri = settings.mongo_uri
     if mongo_uri is None:
         logfire.error("MONGO_URI not found in .env file")
         return
-    mongo_client = MongoClient(mongo_uri, "pyAgent")
+    mongo_client = get_shared_client(mongo_uri, "pyAgent")
     mongo_client.ping()
-    rabbit_client = RabbitClient(
-        host=get_key(".env", "RABBIT_HOST"),
-        port=get_key(".env", "RABBIT_PORT"),
-        username=get_key(".env", "RABBIT_USER"),
-        password=get_key(".env", "RABBIT_PASS")
-    )
+    rabbit_client = request.app.state.rabbit_client
+    if rabbit_client is None:
+        raise HTTPException(status_code=503, detail="RabbitMQ is not connected yet")
     
     # collection = mongo_client.get_collection("doc_sections")
     
@@ -93,20 +98,119 @@ async def async_learning():
     for root, dirs, files in os.walk(folder_path):
         for file in files:
             file_path = os.path.join(root, file)
-            rabbit_client.publish("learning.async",file_path)
+            await rabbit_client.publish("learning.async", file_path, priority)
             learning_files.append(file_path)
     
     
-    return {"message": "Learning", "files": learning_files}
+    return {"message": "Learning", "files": learning_files, "priority": priority}
+
+@router.post("/upload", status_code=status.HTTP_202_ACCEPTED)
+async def upload(request: Request, settings: settings_dependency, priority: Priority = "interactive"):
+    """Upload a document to learn from, as multipart form field `file`.
+
+    The body is streamed to disk and hashed while it arrives. A file with the same content
+    as an earlier upload is not queued again. PDFs go to the conversion queue, markdown and
+    text files straight to the learning queue, both in the interactive lane by default so a
+    running re-sync doesn't hold them up.
+    """
+    rabbit_client = request.app.state.rabbit_client
+    if rabbit_client is None:
+        raise HTTPException(status_code=503, detail="RabbitMQ is not connected yet")
+    mongo_uri = settings.mongo_uri
+    if mongo_uri is None:
+        raise HTTPException(status_code=503, detail="MONGO_URI not found in .env file")
+    try:
+        spooled = await receive_upload(request)
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
+    mongo_client = get_shared_client(mongo_uri, "pyAgent")
+    path = UPLOAD_DIR / f"{spooled.file_hash[:16]}-{spooled.filename}"
+    existing = await mongo_client.register_upload(spooled.file_hash, spooled.filename, str(path))
+    if existing is not None and existing["status"] != "failed":
+        await spooled.discard()
+        logfire.info(f"Skipping {spooled.filename}, same content as {existing['filename']}")
+        return {"message": "Already uploaded", "file_hash": spooled.file_hash, "status": existing["status"]}
+    try:
+        await asyncio.to_thread(UPLOAD_DIR.mkdir, parents=True, exist_ok=True)
+        await spooled.move_to(path)
+        queue = "ai.upload" if path.suffix.lower() == ".pdf" else "learning.async"
+        await rabbit_client.publish(queue, str(path), priority)
+    except Exception:
+        await spooled.discard()
+        await mongo_client.set_upload_status(spooled.file_hash, "failed")
+        raise
+    if existing is not None:
+        await mongo_client.set_upload_status(spooled.file_hash, "queued", path=str(path))
+    return {"message": "Queued", "file": str(path), "file_hash": spooled.file_hash, "size": spooled.size, "queue": queue, "priority": priority}
 
 class MessageRequest(BaseModel):
     question: str = Field(min_length=1, max_length=1000)
 
 @router.post("/ask", status_code=status.HTTP_200_OK)
-async def ask(message_request: MessageRequest):
+async def ask(message_request: MessageRequest, settings: settings_dependency):
     """Ask a question to the agent"""
-    mongo_uri = get_key(".env", "MONGO_URI")
-    with logfire.span('mongo_rag_agent'):
-        agent = MongoRagAgent(mongo_uri)
-        answer = await agent.run_agent(message_request.question, [])
-        return {"message": "Ask", "answer": answer}
\ No newline at end of file
+    agent = MongoRagAgent(settings.mongo_uri, eager=settings.eager_retrieval)
+    # answered by any worker within ANSWER_CACHE_TTL without taking a slot, until the sections change
+    version = await corpus_versions.current(agent.mongo_client, "doc_sections")
+    cached = answer_cache.get(version, message_request.question)
+    if cached is not None:
+        return {"message": "Ask", "answer": cached}
+    async with get_controller("learning_ask").admit():
+        with logfire.span('mongo_rag_agent'):
+            answer = jsonable_encoder(await agent.run_agent(message_request.question, []))
+    answer_cache.put(version, message_request.question, None, answer)
+    return {"message": "Ask", "answer": answer}
+
+@router.post("/ask/stream", status_code=status.HTTP_200_OK)
+async def ask_stream(message_request: MessageRequest, settings: settings_dependency) -> StreamingResponse:
+    """`ask` streamed as new line delimited JSON events, see `utils.answer_stream`."""
+    agent = MongoRagAgent(settings.mongo_uri, eager=settings.eager_retrieval)
+    version = await corpus_versions.current(agent.mongo_client, "doc_sections")
+    cached = answer_cache.get(version, message_request.question)
+    if cached is not None:
+        done = {"type": "done", "content": cached["data"], "usage": None, "cached": True}
+        return StreamingResponse(iter([event(done)]), media_type=MEDIA_TYPE)
+    # taken last, nothing raises between here and the response that releases it
+    admission = get_controller("learning_ask")
+    admitted_at = await admission.acquire()
+
+    def cache_answer(answer: str, stream):
+        # the same entry `ask` puts, so both answer from it
+        all_messages = stream.all_messages()
+        result = RunResult(all_messages, len(all_messages) - len(stream.new_messages()), answer, None, stream.usage())
+        answer_cache.put(version, message_request.question, None, jsonable_encoder(result))
+
+    events = answer_events(agent.run_stream_agent(message_request.question, []), on_complete=cache_answer)
+    return admitted_response(admission, admitted_at, events)
+
+class BatchRequest(BaseModel):
+    questions: list[str] = Field(min_length=1, max_length=100)
+
+@router.post("/ask/batch", status_code=status.HTTP_200_OK)
+async def ask_batch(batch_request: BatchRequest, settings: settings_dependency) -> StreamingResponse:
+    """Ask several questions at once.
+
+    The questions are embedded with one request and every distinct question is searched
+    once, then the agent answers them concurrently. Answers are streamed as new line
+    delimited JSON in the order they complete, `index` is the position of the question.
+    """
+    if any(not question.strip() or len(question) > 1000 for question in batch_request.questions):
+        raise HTTPException(status_code=422, detail="Questions must be 1 to 1000 characters")
+    agent = MongoRagAgent(settings.mongo_uri)
+    concurrency = settings.batch_ask_concurrency
+    # as in /chat the slot is held until the stream has finished
+    admission = get_controller("learning_ask_batch")
+    admitted_at = await admission.acquire()
+
+    async def stream_answers():
+        with logfire.span('mongo_rag_agent batch of {count}', count=len(batch_request.questions)):
+            async for index, result in ask_many(agent, batch_request.questions, concurrency):
+                item = {"index": index, "question": batch_request.questions[index]}
+                if isinstance(result, Exception):
+                    item["error"] = str(result)
+                else:
+                    item["answer"] = result.data
+                yield event(item)
+
+    return admitted_response(admission, admitted_at, stream_answers())
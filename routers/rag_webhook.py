@@ -1,15 +1,16 @@
-from fastapi import APIRouter, Depends
+import logfire
+
+from fastapi import APIRouter, Depends, HTTPException
+from openai import APITimeoutError
 from starlette import status
-from agents.rag import build_search_db, run_agent
+from agents.rag import build_search_db, run_agent, run_stream_agent
 from databases.memory import SessionLocal
 from sqlalchemy.orm import Session
 from typing import Annotated
 from pydantic import BaseModel, Field
-from models import Messages, MessageRole
-from pydantic_ai.messages import (
-    TextPart, 
-    ModelResponse
-)
+from utils.admission import get_controller
+from utils.history import load_history, save_turn
+from utils.answer_stream import admitted_response, answer_events
 
 router = APIRouter(
     prefix="/webhook/rag",
@@ -30,41 +31,38 @@ class MessageRequest(BaseModel):
 
 @router.post("/build", status_code=status.HTTP_200_OK)
 async def build_rag_webhook():
-    try:
-        await build_search_db()
-        return {"message": "RAG webhook called"}
-    except Exception as e:
-        return {"message": f"Error: {e}"}
+    await build_search_db()
+    return {"message": "RAG webhook called"}
     
 @router.post("/chat", status_code=status.HTTP_200_OK)
 async def chat_rag_webhook(message_request: MessageRequest, db: db_dependency):
     try:
-        messages = db.query(Messages).filter(Messages.session_id == message_request.session_id).all()
-        message_history: list = []
-        for m in messages:
-            if m.role == MessageRole.USER:
-                continue
-            message_history.append(
-                ModelResponse(
-                    parts=[TextPart(content=m.message)],
-                    timestamp=m.created_at.timestamp(),
-                )
-            )
-        result = await run_agent(messages=message_request.message, message_history=message_history)
-        user_message = Messages(
-            role=MessageRole.USER,
-            session_id=message_request.session_id,
-            message=message_request.message,
-        )
-        db.add(user_message)
-        
-        ai_message = Messages(
-            role=MessageRole.AI,
-            session_id=message_request.session_id,
-            message=result.data,
-        )
-        db.add(ai_message)
-        db.commit()
+        message_history = load_history(db, message_request.session_id)
+        async with get_controller("rag_chat").admit():
+            result = await run_agent(message_request.message, message_history)
+        save_turn(db, message_request.session_id, message_request.message, result.data, result.new_messages())
         return {"message": result.data}
-    except Exception as e:
-        return {"message": f"Error: {e}"}
\ No newline at end of file
+    except (TimeoutError, APITimeoutError) as e:
+        logfire.error(f"RAG chat timed out: {e}")
+        raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail="Model request timed out")
+
+@router.post("/chat/stream", status_code=status.HTTP_200_OK)
+async def chat_rag_webhook_stream(message_request: MessageRequest, db: db_dependency):
+    """`chat_rag_webhook` streamed as new line delimited JSON events, see `utils.answer_stream`."""
+    message_history = load_history(db, message_request.session_id)
+    admission = get_controller("rag_chat")
+    admitted_at = await admission.acquire()
+
+    def save(answer: str, stream):
+        # own session, the request scoped one is closed by the time the stream ends
+        stream_db = SessionLocal()
+        try:
+            save_turn(stream_db, message_request.session_id, message_request.message, answer, stream.new_messages())
+        finally:
+            stream_db.close()
+
+    events = answer_events(
+        run_stream_agent(message_request.message, message_history),
+        on_complete=save,
+    )
+    return admitted_response(admission, admitted_at, events)
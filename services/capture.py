@@ -0,0 +1,155 @@
+"""Opt-in capture of production traffic for offline replay.
+
+`TrafficCapture` is a plain ASGI middleware, streamed responses pass through untouched
+while it notes when the first and the last body bytes left. Every finished request of
+the captured endpoints becomes one JSON line: arrival time, method, path, a sanitized
+body and the timings. Lines go through a queue to a rotating file written by a
+background thread, so the event loop never waits on the disk.
+
+Replay a capture with `python -m benchmarks.replay`.
+"""
+import re
+import json
+import time
+import queue
+import logging
+import logging.handlers
+
+from pathlib import Path
+from urllib.parse import parse_qsl, urlencode
+
+CAPTURE_DIR = Path("./captures")
+CAPTURE_FILE = "traffic.jsonl"
+CAPTURED_PREFIXES = ("/chat", "/webhook", "/learning")
+# bodies larger than this, uploads mostly, are recorded by size only
+MAX_BODY_BYTES = 64 * 1024
+
+SECRET_KEYS = re.compile(r"pass|secret|token|api_?key|auth", re.IGNORECASE)
+EMAIL = re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+")
+# account and card numbers, phone numbers
+LONG_NUMBER = re.compile(r"\b\d[\d -]{7,}\d\b")
+
+def sanitize_text(text: str) -> str:
+    return LONG_NUMBER.sub("<number>", EMAIL.sub("<email>", text))
+
+def sanitize_value(value, key: str = ""):
+    if SECRET_KEYS.search(key):
+        return "<redacted>"
+    if isinstance(value, str):
+        return sanitize_text(value)
+    if isinstance(value, dict):
+        return {k: sanitize_value(v, k) for k, v in value.items()}
+    if isinstance(value, list):
+        return [sanitize_value(v, key) for v in value]
+    return value
+
+def sanitize_body(body: bytes, content_type: str) -> str | None:
+    """Body as replayable text with secrets and personal data masked, None if it can't be kept."""
+    if len(body) > MAX_BODY_BYTES or content_type.startswith("multipart/"):
+        return None
+    try:
+        text = body.decode("utf-8")
+    except UnicodeDecodeError:
+        return None
+    if content_type.startswith("application/json"):
+        try:
+            return json.dumps(sanitize_value(json.loads(text)))
+        except ValueError:
+            return sanitize_text(text)
+    if content_type.startswith("application/x-www-form-urlencoded"):
+        return urlencode([(k, sanitize_value(v, k)) for k, v in parse_qsl(text, keep_blank_values=True)])
+    return sanitize_text(text)
+
+def open_capture_log(directory: Path = CAPTURE_DIR, max_bytes: int = 50 * 1024 * 1024, backups: int = 5) -> tuple[logging.Logger, logging.handlers.QueueListener]:
+    directory.mkdir(parents=True, exist_ok=True)
+    handler = logging.handlers.RotatingFileHandler(directory / CAPTURE_FILE, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, handler)
+    logger = logging.getLogger("traffic_capture")
+    logger.setLevel(logging.INFO)
+    # the capture isn't application logging
+    logger.propagate = False
+    logger.handlers = [logging.handlers.QueueHandler(records)]
+    return logger, listener
+
+def capture_files(directory: Path = CAPTURE_DIR) -> list[Path]:
+    """Capture files oldest first, the rotated backups followed by the live file."""
+    backups = sorted(directory.glob(f"{CAPTURE_FILE}.*"), key=lambda p: int(p.suffix[1:]), reverse=True)
+    live = directory / CAPTURE_FILE
+    return backups + ([live] if live.exists() else [])
+
+class TrafficCapture:
+    def __init__(self, app, directory: Path = CAPTURE_DIR, max_bytes: int = 50 * 1024 * 1024, backups: int = 5, prefixes: tuple[str, ...] = CAPTURED_PREFIXES):
+        self.app = app
+        self.prefixes = prefixes
+        self.logger, self.listener = open_capture_log(directory, max_bytes, backups)
+        self.listener.start()
+
+    def close(self):
+        self.listener.stop()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            async def send_and_close(message):
+                # flush what is still queued before the server exits
+                if message["type"] == "lifespan.shutdown.complete":
+                    self.close()
+                await send(message)
+            await self.app(scope, receive, send_and_close)
+            return
+        if scope["type"] != "http" or not scope["path"].startswith(self.prefixes):
+            await self.app(scope, receive, send)
+            return
+
+        arrived = time.time()
+        started = time.perf_counter()
+        body = bytearray()
+        body_size = 0
+        response = {"status": None, "first_byte": None, "bytes": 0}
+
+        async def receive_and_record():
+            nonlocal body_size
+            message = await receive()
+            if message["type"] == "http.request":
+                chunk = message.get("body", b"")
+                body_size += len(chunk)
+                # past the limit the body is dropped, keep only its size
+                if body_size <= MAX_BODY_BYTES:
+                    body.extend(chunk)
+            return message
+
+        async def send_and_record(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                if response["first_byte"] is None:
+                    response["first_byte"] = time.perf_counter() - started
+                response["bytes"] += len(message.get("body", b""))
+            await send(message)
+
+        error = None
+        try:
+            await self.app(scope, receive_and_record, send_and_record)
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            headers = dict(scope.get("headers") or [])
+            content_type = headers.get(b"content-type", b"").decode("latin-1")
+            record = {
+                "arrived": arrived,
+                "method": scope["method"],
+                "path": scope["path"],
+                "query": sanitize_text(scope.get("query_string", b"").decode("latin-1")),
+                "content_type": content_type,
+                "body": sanitize_body(bytes(body), content_type) if body_size <= MAX_BODY_BYTES else None,
+                "body_bytes": body_size,
+                "status": response["status"],
+                "first_byte": response["first_byte"],
+                "duration": time.perf_counter() - started,
+                "response_bytes": response["bytes"],
+            }
+            if error is not None:
+                record["error"] = error
+            self.logger.info(json.dumps(record))
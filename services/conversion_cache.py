@@ -0,0 +1,70 @@
+import os
+import re
+import json
+import hashlib
+
+from pathlib import Path
+
+CONVERSION_CACHE_DIR = "./uploads/.cache/conversions"
+# the file identifier and dates pdfium writes anew every time it saves a document
+PDF_VOLATILE_PATTERN = re.compile(rb"/ID\s*\[\s*<[0-9A-Fa-f]*>\s*<[0-9A-Fa-f]*>\s*\]|/(?:CreationDate|ModDate)\s*\([^)]*\)")
+
+def hash_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+def hash_page(page_pdf: bytes) -> str:
+    """Hash a single page PDF written by `split_pages`, the same page hashes the same in every run."""
+    return hash_bytes(PDF_VOLATILE_PATTERN.sub(b"", page_pdf))
+
+def hash_file(file_path: str, chunk_size: int = 1024 * 1024) -> str:
+    """Hash a file by its content, reading it in fixed size chunks."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class ConversionCache:
+    """File backed cache of PDF to markdown conversions.
+
+    Whole documents are keyed by the hash of the PDF, single pages by the hash
+    of the page, so a re-upload under another name is a cache hit and an edited
+    PDF only has to convert the pages that changed.
+    """
+    cache_dir: Path
+    def __init__(self, cache_dir: str = CONVERSION_CACHE_DIR):
+        self.cache_dir = Path(cache_dir)
+        (self.cache_dir / "documents").mkdir(parents=True, exist_ok=True)
+        (self.cache_dir / "pages").mkdir(parents=True, exist_ok=True)
+
+    def get_document(self, file_hash: str) -> dict | None:
+        return self._read(self.cache_dir / "documents" / f"{file_hash}.json")
+
+    def put_document(self, file_hash: str, markdown: str, pages: list[dict]):
+        self._write(
+            self.cache_dir / "documents" / f"{file_hash}.json",
+            {"markdown": markdown, "pages": pages},
+        )
+
+    def get_page(self, page_hash: str) -> dict | None:
+        return self._read(self.cache_dir / "pages" / f"{page_hash}.json")
+
+    def put_page(self, page_hash: str, page: dict):
+        self._write(self.cache_dir / "pages" / f"{page_hash}.json", page)
+
+    def _read(self, path: Path) -> dict | None:
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except json.JSONDecodeError:
+            # a broken entry is treated as a miss and overwritten later
+            return None
+
+    def _write(self, path: Path, data: dict):
+        # write to a temp file first so concurrent readers never see half an entry
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
@@ -1,42 +1,133 @@
-import spacy
+import io
 import logfire
 
-from spacy_layout import spaCyLayout
+from concurrent.futures import ProcessPoolExecutor
 from databases.mongo import MongoClient
+from services.conversion_cache import ConversionCache, hash_file, hash_page
+from utils.profiling import scope
 
 from openai import AsyncOpenAI
-from langchain_text_splitters import MarkdownTextSplitter
+
+# spaCy, spacy_layout and pypdfium2 take seconds to import, they are only imported once a file gets converted
+
+# layout parser of the current worker process, created once by `init_layout_worker`
+_layout = None
+
+def init_layout_worker():
+    import spacy
+    from spacy_layout import spaCyLayout
+    global _layout
+    _layout = spaCyLayout(spacy.blank("en"))
+
+def convert_page(page_pdf: bytes) -> dict:
+    """Convert a single page PDF to markdown and its page layout."""
+    if _layout is None:
+        init_layout_worker()
+    doc = _layout(page_pdf)
+    page_layout = doc._.layout.pages[0] if doc._.layout.pages else None
+    spans = []
+    for span in doc.spans.get("layout", []):
+        span_layout = span._.layout
+        spans.append({
+            "label": span.label_,
+            "text": span.text,
+            "x": span_layout.x if span_layout else 0,
+            "y": span_layout.y if span_layout else 0,
+            "width": span_layout.width if span_layout else 0,
+            "height": span_layout.height if span_layout else 0,
+        })
+    return {
+        "markdown": doc._.markdown,
+        "width": page_layout.width if page_layout else 0,
+        "height": page_layout.height if page_layout else 0,
+        "spans": spans,
+    }
+
+def split_pages(file_path: str) -> list[bytes]:
+    """Split a PDF into one single page PDF per page."""
+    import pypdfium2 as pdfium
+    pdf = pdfium.PdfDocument(file_path)
+    pages: list[bytes] = []
+    try:
+        for index in range(len(pdf)):
+            single = pdfium.PdfDocument.new()
+            single.import_pages(pdf, [index])
+            buffer = io.BytesIO()
+            single.save(buffer)
+            single.close()
+            pages.append(buffer.getvalue())
+    finally:
+        pdf.close()
+    return pages
 
 class FileProcessor:
     mongo_client: MongoClient | None
     openai: AsyncOpenAI | None
-    def __init__(self, file_path: str):
+    cache: ConversionCache
+    workers: int
+    def __init__(self, file_path: str, cache: ConversionCache | None = None):
         self.file_path = file_path
-    
+        self.cache = cache if cache is not None else ConversionCache()
+        self.workers = 4
+
     def with_open_ai(self, client: AsyncOpenAI):
         self.openai = client
         return self
-    
+
     def with_mongo(self, client: MongoClient):
         self.mongo_client = client
         return self
-        
-    def process_file(self):
-        nlp = spacy.blank("en")
-        layout = spaCyLayout(nlp)
+
+    def with_workers(self, workers: int):
+        self.workers = max(1, workers)
+        return self
+
+    def convert_to_markdown(self) -> str:
+        """Convert the PDF to markdown, reusing cached documents and pages."""
+        file_hash = hash_file(self.file_path)
+        cached = self.cache.get_document(file_hash)
+        if cached is not None:
+            logfire.info(f"Conversion cache hit for {self.file_path}")
+            return cached["markdown"]
+
         logfire.info(f"Reading file {self.file_path}")
-        # Process a document and create a spaCy Doc object
-        doc = layout(self.file_path)
+        page_pdfs = split_pages(self.file_path)
+        page_hashes = [hash_page(page_pdf) for page_pdf in page_pdfs]
+        pages: dict[int, dict] = {}
+        missing: list[int] = []
+        for index, page_hash in enumerate(page_hashes):
+            page = self.cache.get_page(page_hash)
+            if page is None:
+                missing.append(index)
+            else:
+                pages[index] = page
+        logfire.info(f"{len(pages)} of {len(page_pdfs)} pages cached for {self.file_path}")
+
+        if missing:
+            with logfire.span('convert_pages', pages=len(missing)):
+                if len(missing) == 1 or self.workers == 1:
+                    converted = [convert_page(page_pdfs[index]) for index in missing]
+                else:
+                    workers = min(self.workers, len(missing))
+                    with ProcessPoolExecutor(max_workers=workers, initializer=init_layout_worker) as executor:
+                        converted = list(executor.map(convert_page, [page_pdfs[index] for index in missing]))
+            for index, page in zip(missing, converted):
+                self.cache.put_page(page_hashes[index], page)
+                pages[index] = page
         logfire.info(f"Done reading file {self.file_path}")
-        
-        # save content to file
-        content = doc._.markdown
-        with open(self.file_path + ".md", "w") as f:
-            f.write(content)
-        
-        # Markdown representation of the document
-        with logfire.span('process_file'):
-            md_splitter = MarkdownTextSplitter(chunk_size=1000, chunk_overlap=200)
-            chunks = md_splitter.split_text(content)
-            for chunk in chunks:
-                print(chunk)
\ No newline at end of file
+
+        ordered = [pages[index] | {"page_no": index + 1} for index in range(len(page_pdfs))]
+        markdown = "\n\n".join(page["markdown"] for page in ordered if page["markdown"])
+        self.cache.put_document(file_hash, markdown, ordered)
+        return markdown
+
+    def process_file(self) -> str:
+        """Convert the PDF and write the markdown next to it, returns the markdown file path."""
+        with scope("FileProcessor.process_file"):
+            content = self.convert_to_markdown()
+
+            # save content to file
+            markdown_path = self.file_path + ".md"
+            with open(markdown_path, "w") as f:
+                f.write(content)
+            return markdown_path
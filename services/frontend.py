@@ -0,0 +1,134 @@
+"""Compiled frontend bundle.
+
+`python -m services.frontend` compiles `public/chat_app.ts` once with esbuild into
+minified JS under a content hashed name in `public/dist`, next to gzip and brotli
+variants and a manifest. The API serves those with strong ETags and immutable
+cache headers. Without a build the page falls back to compiling in the browser.
+"""
+import re
+import gzip
+import json
+import hashlib
+import logging
+import subprocess
+
+from pathlib import Path
+from fastapi.responses import Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+PUBLIC_DIR = Path(__file__).parent.parent / "public"
+DIST_DIR = PUBLIC_DIR / "dist"
+SOURCE = PUBLIC_DIR / "chat_app.ts"
+ESBUILD = ["npx", "--yes", "esbuild@0.24.2"]
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+LOADER_PATTERN = re.compile(r"<!-- ts-loader.*?<!-- /ts-loader -->", re.DOTALL)
+BUNDLE_PATTERN = re.compile(r"chat_app\.([0-9a-f]{16})\.js")
+
+def source_hash() -> str:
+    return hashlib.sha256(SOURCE.read_bytes()).hexdigest()
+
+def build(dist_dir: Path = DIST_DIR) -> dict:
+    """Compile, minify, hash and precompress the frontend, returns the manifest."""
+    result = subprocess.run(
+        ESBUILD + [str(SOURCE), "--minify", "--format=esm", "--target=es2017", "--loader=ts"],
+        check=True,
+        capture_output=True,
+    )
+    code = result.stdout
+    digest = hashlib.sha256(code).hexdigest()[:16]
+    name = f"chat_app.{digest}.js"
+
+    # older bundles stay in place and are served for pages that still reference them
+    dist_dir.mkdir(parents=True, exist_ok=True)
+    (dist_dir / name).write_bytes(code)
+    (dist_dir / f"{name}.gz").write_bytes(gzip.compress(code, compresslevel=9, mtime=0))
+    if brotli is not None:
+        (dist_dir / f"{name}.br").write_bytes(brotli.compress(code, quality=11))
+
+    manifest = {"chat_app.js": name, "etag": digest, "source_hash": source_hash()}
+    (dist_dir / "manifest.json").write_text(json.dumps(manifest))
+    return manifest
+
+class FrontendBundle:
+    """Serves the compiled bundle, loaded once from the manifest in `dist_dir`."""
+    manifest: dict | None
+    def __init__(self, dist_dir: Path = DIST_DIR):
+        self.dist_dir = dist_dir
+        self.manifest = None
+        self.index_html = b""
+        self.index_etag = ""
+        # bundle name -> encoding ("" for identity) -> bytes, kept in memory, bundles are small
+        self.bundles: dict[str, dict[str, bytes]] = {}
+        self.load()
+
+    def read_bundle(self, name: str) -> dict[str, bytes]:
+        assets = {}
+        for encoding, suffix in (("", ""), ("gzip", ".gz"), ("br", ".br")):
+            path = self.dist_dir / f"{name}{suffix}"
+            if path.exists():
+                assets[encoding] = path.read_bytes()
+        return assets
+
+    def load(self):
+        manifest_path = self.dist_dir / "manifest.json"
+        self.manifest = json.loads(manifest_path.read_text()) if manifest_path.exists() else None
+        if self.manifest is not None and self.manifest.get("source_hash") != source_hash():
+            logging.warning("Frontend bundle is older than public/chat_app.ts, run `python -m services.frontend`")
+        self.bundles = {}
+        if self.manifest is not None:
+            name = self.manifest["chat_app.js"]
+            self.bundles[name] = self.read_bundle(name)
+        html = (PUBLIC_DIR / "index.html").read_text()
+        if self.manifest is not None:
+            script = f'<script type="module" src="/assets/{self.manifest["chat_app.js"]}"></script>'
+            html = LOADER_PATTERN.sub(lambda _: script, html)
+        self.index_html = html.encode("utf-8")
+        self.index_etag = '"' + hashlib.sha256(self.index_html).hexdigest()[:16] + '"'
+
+    def ensure_built(self):
+        """Compile once at startup when there is no bundle for the current source."""
+        if self.manifest is not None and self.manifest.get("source_hash") == source_hash():
+            return
+        try:
+            build(self.dist_dir)
+        except (OSError, subprocess.CalledProcessError) as e:
+            logging.error("Could not build the frontend, serving the in-browser compiler: %s", e)
+            return
+        self.load()
+
+    def index_response(self, if_none_match: str | None) -> Response:
+        # the page itself revalidates every time, it is what points at the current bundle
+        headers = {"ETag": self.index_etag, "Cache-Control": "no-cache"}
+        if if_none_match == self.index_etag:
+            return Response(status_code=304, headers=headers)
+        return Response(self.index_html, media_type="text/html", headers=headers)
+
+    def asset_response(self, filename: str, accept_encoding: str | None, if_none_match: str | None) -> Response:
+        match = BUNDLE_PATTERN.fullmatch(filename)
+        if match is None:
+            return Response(status_code=404)
+        if filename not in self.bundles:
+            # a bundle of an earlier build, still referenced by pages loaded before it
+            assets = self.read_bundle(filename)
+            if "" not in assets:
+                return Response(status_code=404)
+            self.bundles[filename] = assets
+        assets = self.bundles[filename]
+        etag = f'"{match.group(1)}"'
+        headers = {"ETag": etag, "Cache-Control": IMMUTABLE, "Vary": "Accept-Encoding"}
+        if if_none_match == etag:
+            return Response(status_code=304, headers=headers)
+        encodings = [e.split(";")[0].strip() for e in (accept_encoding or "").split(",")]
+        for encoding in ("br", "gzip"):
+            if encoding in encodings and encoding in assets:
+                headers["Content-Encoding"] = encoding
+                return Response(assets[encoding], media_type="text/javascript", headers=headers)
+        return Response(assets[""], media_type="text/javascript", headers=headers)
+
+if __name__ == "__main__":
+    print(json.dumps(build(), indent=2))
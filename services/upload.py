@@ -0,0 +1,155 @@
+"""Streaming multipart uploads.
+
+The request body is parsed as it arrives and the file part is written to a spool
+file in fixed size chunks, hashed on the way. Writes and hashing run in a thread,
+so the event loop never waits on the disk and no more than one chunk of the file
+is held in memory, whatever its size.
+"""
+import os
+import re
+import uuid
+import asyncio
+import hashlib
+
+from pathlib import Path
+from fastapi import Request
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+UPLOAD_DIR = Path("./uploads/files")
+# same file system as UPLOAD_DIR, a finished spool file is moved into place, not copied
+SPOOL_DIR = Path("./uploads/.spool")
+CHUNK_SIZE = 1024 * 1024
+ALLOWED_EXTENSIONS = (".pdf", ".md", ".markdown", ".txt")
+
+class UploadError(Exception):
+    """Invalid upload request, `status_code` is sent back to the client."""
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+class SpooledUpload:
+    filename: str
+    path: Path
+    size: int
+    file_hash: str
+    def __init__(self, filename: str, path: Path, size: int, file_hash: str):
+        self.filename = filename
+        self.path = path
+        self.size = size
+        self.file_hash = file_hash
+
+    async def move_to(self, path: Path):
+        await asyncio.to_thread(os.replace, self.path, path)
+        self.path = path
+
+    async def discard(self):
+        await asyncio.to_thread(self.path.unlink, True)
+
+class SpoolWriter:
+    """Writes a part to a spool file `chunk_size` bytes at a time, hashing in the same thread."""
+    def __init__(self, spool_dir: Path = SPOOL_DIR, chunk_size: int = CHUNK_SIZE):
+        self.path = spool_dir / uuid.uuid4().hex
+        self.chunk_size = chunk_size
+        self.digest = hashlib.sha256()
+        self.buffer = bytearray()
+        self.size = 0
+        self.file = None
+
+    def _write(self, data: bytes):
+        # both release the GIL for large buffers
+        self.file.write(data)
+        self.digest.update(data)
+
+    async def open(self):
+        await asyncio.to_thread(self.path.parent.mkdir, parents=True, exist_ok=True)
+        self.file = await asyncio.to_thread(open, self.path, "wb")
+
+    async def write(self, data: bytes):
+        self.buffer += data
+        self.size += len(data)
+        while len(self.buffer) >= self.chunk_size:
+            chunk = bytes(self.buffer[:self.chunk_size])
+            del self.buffer[:self.chunk_size]
+            await asyncio.to_thread(self._write, chunk)
+
+    async def close(self):
+        if self.buffer:
+            await asyncio.to_thread(self._write, bytes(self.buffer))
+            self.buffer.clear()
+        await asyncio.to_thread(self.file.close)
+
+    async def discard(self):
+        if self.file is not None:
+            await asyncio.to_thread(self.file.close)
+        await asyncio.to_thread(self.path.unlink, True)
+
+def safe_filename(filename: str) -> str:
+    name = re.sub(r"[^\w.\- ]", "_", Path(filename.replace("\\", "/")).name).strip(" .")
+    return name or "upload"
+
+async def receive_upload(request: Request, field: str = "file", spool_dir: Path = SPOOL_DIR) -> SpooledUpload:
+    """Stream the file in form field `field` of a multipart request to a spool file."""
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise UploadError("Expected a multipart/form-data body")
+
+    # the parser calls back synchronously, events are collected and handled after each chunk
+    events: list[tuple[str, bytes]] = []
+    header = [b"", b""]
+    def on_header_field(data: bytes, start: int, end: int):
+        header[0] += data[start:end]
+    def on_header_value(data: bytes, start: int, end: int):
+        header[1] += data[start:end]
+    def on_header_end():
+        events.append(("header", header[0] + b":" + header[1]))
+        header[0] = header[1] = b""
+    parser = MultipartParser(params[b"boundary"], {
+        "on_part_begin": lambda: events.append(("begin", b"")),
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": lambda: events.append(("headers", b"")),
+        "on_part_data": lambda data, start, end: events.append(("data", data[start:end])),
+        "on_part_end": lambda: events.append(("end", b"")),
+    })
+
+    headers: dict[bytes, bytes] = {}
+    writer: SpoolWriter | None = None
+    current: SpoolWriter | None = None
+    filename = ""
+    upload: SpooledUpload | None = None
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            for kind, data in events:
+                if kind == "begin":
+                    headers = {}
+                elif kind == "header":
+                    name, _, value = data.partition(b":")
+                    headers[name.strip().lower()] = value.strip()
+                elif kind == "headers":
+                    _, options = parse_options_header(headers.get(b"content-disposition", b""))
+                    if writer is None and options.get(b"name") == field.encode() and b"filename" in options:
+                        filename = safe_filename(options[b"filename"].decode("utf-8", "replace"))
+                        if not filename.lower().endswith(ALLOWED_EXTENSIONS):
+                            raise UploadError(f"Unsupported file type, expected one of {', '.join(ALLOWED_EXTENSIONS)}", 415)
+                        writer = current = SpoolWriter(spool_dir)
+                        await writer.open()
+                elif kind == "data" and current is not None:
+                    await current.write(data)
+                elif kind == "end" and current is not None:
+                    await current.close()
+                    upload = SpooledUpload(filename, current.path, current.size, current.digest.hexdigest())
+                    current = None
+            events.clear()
+        parser.finalize()
+    except BaseException:
+        # a client that disconnects halfway leaves nothing behind
+        if writer is not None:
+            await writer.discard()
+        raise
+    if upload is None:
+        if writer is not None:
+            await writer.discard()
+        raise UploadError(f"No file in form field '{field}'")
+    return upload
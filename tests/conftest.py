@@ -0,0 +1,5 @@
+import os
+
+# the OpenAI clients need a key to be created, nothing is sent to the API in the tests
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("LOGFIRE_IGNORE_NO_CONFIG", "1")
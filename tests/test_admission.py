@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from main import overloaded_handler
+from utils.admission import AdmissionController, Overloaded
+
+def test_waits_for_a_free_slot():
+    async def scenario():
+        controller = AdmissionController("test", max_concurrent=1, max_queue=1, queue_timeout=1.0)
+        admitted_at = await controller.acquire()
+        waiter = asyncio.create_task(controller.acquire())
+        await asyncio.sleep(0)
+        assert controller.waiting == 1
+        controller.release(admitted_at)
+        controller.release(await waiter)
+        return controller.stats()
+    stats = asyncio.run(scenario())
+    assert stats["admitted"] == 2
+    assert stats["shed"] == 0
+    assert stats["active"] == 0
+    assert stats["queue_depth"] == 0
+
+def test_queue_deadline():
+    async def scenario():
+        controller = AdmissionController("test", max_concurrent=1, max_queue=1, queue_timeout=0.01)
+        await controller.acquire()
+        with pytest.raises(Overloaded) as raised:
+            await controller.acquire()
+        return controller, raised.value
+    controller, overloaded = asyncio.run(scenario())
+    assert overloaded.endpoint == "test"
+    assert overloaded.retry_after >= 1
+    assert controller.shed == 1
+    assert controller.waiting == 0
+
+def test_sheds_when_the_queue_is_full():
+    async def scenario():
+        controller = AdmissionController("test", max_concurrent=1, max_queue=1, queue_timeout=1.0)
+        admitted_at = await controller.acquire()
+        waiter = asyncio.create_task(controller.acquire())
+        await asyncio.sleep(0)
+        # shed straight away, not after the queue deadline
+        with pytest.raises(Overloaded):
+            await asyncio.wait_for(controller.acquire(), timeout=0.1)
+        controller.release(admitted_at)
+        controller.release(await waiter)
+        return controller.stats()
+    stats = asyncio.run(scenario())
+    assert stats["shed"] == 1
+    assert stats["admitted"] == 2
+
+def test_retry_after_grows_with_the_queue():
+    controller = AdmissionController("test", max_concurrent=2, max_queue=10, queue_timeout=1.0)
+    controller.service_seconds = 3.0
+    assert controller.retry_after() == 2
+    controller.waiting = 3
+    assert controller.retry_after() == 6
+
+def test_slot_released_on_error():
+    async def scenario():
+        controller = AdmissionController("test", max_concurrent=1, max_queue=0, queue_timeout=0.01)
+        with pytest.raises(RuntimeError):
+            async with controller.admit():
+                raise RuntimeError("handler failed")
+        # the slot is free again, nothing has to wait for it
+        async with controller.admit():
+            pass
+        return controller.stats()
+    stats = asyncio.run(scenario())
+    assert stats["admitted"] == 2
+    assert stats["active"] == 0
+    assert stats["shed"] == 0
+
+def test_overloaded_is_a_503_with_retry_after():
+    app = FastAPI()
+    app.add_exception_handler(Overloaded, overloaded_handler)
+
+    @app.get("/busy")
+    async def busy():
+        raise Overloaded("busy", 7)
+
+    response = TestClient(app).get("/busy")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "7"
+    assert "busy is overloaded" in response.json()["message"]
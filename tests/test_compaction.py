@@ -0,0 +1,51 @@
+import asyncio
+
+from utils.compaction import HistoryCompactor, budget_start
+
+def test_budget_start_keeps_the_newest_turns_that_fit():
+    assert budget_start([10, 10, 10, 10], 25) == 2
+    assert budget_start([10, 10, 10, 10], 40) == 0
+    assert budget_start([10, 10, 10, 10], 1000) == 0
+
+def test_budget_start_always_keeps_the_newest_turn():
+    assert budget_start([10, 10, 500], 100) == 2
+    assert budget_start([], 100) == 0
+
+def compactor_with(summary: str, covered: int) -> HistoryCompactor:
+    compactor = HistoryCompactor()
+    compactor.remember("s", (summary, covered))
+    return compactor
+
+def summary_text(message) -> str:
+    return message.parts[0].content
+
+def test_no_summary_sends_every_turn():
+    message, start = compactor_with("", 0).compact(None, "s", [10] * 6, 25)
+    assert message is None and start == 0
+
+def test_summary_covering_the_old_turns():
+    message, start = compactor_with("user asked about tokens", 4).compact(None, "s", [10] * 6, 25)
+    assert "user asked about tokens" in summary_text(message)
+    assert start == 4
+
+def test_turns_the_summary_lags_behind_are_sent_verbatim():
+    # the budget only fits the last two turns, the summary covers the first two
+    message, start = compactor_with("summary", 2).compact(None, "s", [10] * 6, 25)
+    assert message is not None and start == 2
+
+def test_turns_covered_by_the_summary_are_not_sent_again():
+    # after the budget was raised it fits every turn, the summary already covers four
+    message, start = compactor_with("summary", 4).compact(None, "s", [10] * 6, 1000)
+    assert message is not None and start == 4
+
+def test_refresh_is_scheduled_when_the_summary_lags():
+    compactor = compactor_with("summary", 1)
+    scheduled = []
+    async def refresh(session_id, through):
+        scheduled.append((session_id, through))
+    compactor.refresh = refresh
+    async def run():
+        compactor.compact(None, "s", [10] * 6, 25)
+        await asyncio.sleep(0)
+    asyncio.run(run())
+    assert scheduled == [("s", 4)]
@@ -0,0 +1,41 @@
+import re
+
+import pytest
+
+from services.conversion_cache import ConversionCache, hash_bytes, hash_page
+
+pdfium = pytest.importorskip("pypdfium2")
+
+from services.file_processor import split_pages
+
+@pytest.fixture
+def pdf_path(tmp_path):
+    pdf = pdfium.PdfDocument.new()
+    for width, height in ((612, 792), (595, 842), (300, 400)):
+        pdf.new_page(width, height)
+    path = tmp_path / "doc.pdf"
+    pdf.save(str(path))
+    pdf.close()
+    return str(path)
+
+def test_splitting_twice_gives_the_same_page_hashes(pdf_path):
+    first = [hash_page(page) for page in split_pages(pdf_path)]
+    second = [hash_page(page) for page in split_pages(pdf_path)]
+    assert first == second
+    assert len(set(first)) == 3
+
+def test_page_hash_ignores_the_generated_id_and_dates(pdf_path):
+    page = split_pages(pdf_path)[0]
+    assert re.search(rb"/ID\s*\[", page)
+    resaved = re.sub(rb"<[0-9A-F]{32}>", b"<" + b"0" * 32 + b">", page)
+    resaved = re.sub(rb"\(D:\d{14}", b"(D:19990101000000", resaved)
+    assert hash_bytes(resaved) != hash_bytes(page)
+    assert hash_page(resaved) == hash_page(page)
+
+def test_cache_round_trip(tmp_path):
+    cache = ConversionCache(str(tmp_path))
+    assert cache.get_page("abc") is None
+    cache.put_page("abc", {"markdown": "# Page"})
+    assert cache.get_page("abc") == {"markdown": "# Page"}
+    cache.put_document("def", "# Doc", [{"markdown": "# Doc"}])
+    assert cache.get_document("def")["markdown"] == "# Doc"
@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+import consumer
+import utils.embedders
+import utils.embedding
+from databases.local_vector import LocalMongoClient
+from utils.dedup import ChunkDeduplicator, content_hash
+
+TEXT = " ".join(f"word{i}" for i in range(200))
+
+def test_content_hash_ignores_whitespace_and_case():
+    assert content_hash("Hello   World\n") == content_hash("hello world")
+    assert content_hash("hello world") != content_hash("hello there")
+
+def test_exact_duplicate():
+    dedup = ChunkDeduplicator()
+    key = content_hash(TEXT)
+    assert dedup.find_duplicate(key, dedup.signature(TEXT)) is None
+    dedup.add(key, dedup.signature(TEXT))
+    assert dedup.find_duplicate(key, dedup.signature(TEXT)) == key
+
+def test_near_duplicate():
+    dedup = ChunkDeduplicator()
+    dedup.add("original", dedup.signature(TEXT))
+    edited = TEXT.replace("word100", "changed")
+    assert dedup.find_duplicate(content_hash(edited), dedup.signature(edited)) == "original"
+    other = " ".join(f"other{i}" for i in range(200))
+    assert dedup.find_duplicate(content_hash(other), dedup.signature(other)) is None
+
+def test_pending_chunks_are_not_in_the_index():
+    dedup = ChunkDeduplicator()
+    key, signature = content_hash(TEXT), dedup.signature(TEXT)
+    assert dedup.find_duplicate(key, signature, {key: signature}) == key
+    assert dedup.find_duplicate(key, signature) is None
+
+def test_bands_must_divide_permutations():
+    with pytest.raises(ValueError):
+        ChunkDeduplicator(num_perm=100, bands=16)
+
+class FailingOnceMongo(LocalMongoClient):
+    def __init__(self):
+        super().__init__()
+        self.saves = 0
+        self.saved: list[dict] = []
+
+    async def save_doc_sections(self, collection_name, docs, references):
+        self.saves += 1
+        if self.saves == 1:
+            raise ConnectionError("bulk write failed")
+        self.saved.extend(docs)
+
+def test_failed_save_is_indexed_in_full_on_retry(tmp_path, monkeypatch):
+    async def embed_texts(openai, texts):
+        return [[1.0, 0.0] for _ in texts]
+    mongo = FailingOnceMongo()
+    monkeypatch.setattr(consumer, "mongo_client", mongo)
+    monkeypatch.setattr(consumer, "deduplicator", ChunkDeduplicator())
+    monkeypatch.setattr(utils.embedders, "embed_texts", embed_texts)
+    path = tmp_path / "doc.md"
+    path.write_text("# First\n\n" + TEXT + "\n\n# Second\n\n" + " ".join(f"other{i}" for i in range(100)))
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(consumer.index_file(str(path), "doc.md"))
+    assert mongo.saved == []
+
+    asyncio.run(consumer.index_file(str(path), "doc.md"))
+    assert len(mongo.saved) > 0
+    # stored now, a third run finds every chunk
+    embedding = utils.embedding.Embedding()
+    docs = asyncio.run(embedding.generate_from_file(str(path), "doc.md", dedup=consumer.deduplicator))
+    assert docs == []
+    assert len(embedding.references) == len(mongo.saved)
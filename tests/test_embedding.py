@@ -0,0 +1,42 @@
+import asyncio
+
+import utils.embedders
+from utils.dedup import ChunkDeduplicator
+from utils.embedders import embed_in_batches
+from utils.embedding import Embedding
+
+def fake_embed_texts(calls: list[int], fail_on: int | None = None):
+    async def embed_texts(openai, texts):
+        calls.append(len(texts))
+        if len(calls) == fail_on:
+            raise ConnectionError("provider down")
+        return [[float(len(text)), 1.0] for text in texts]
+    return embed_texts
+
+def test_embed_in_batches(monkeypatch):
+    calls: list[int] = []
+    monkeypatch.setattr(utils.embedders, "embed_texts", fake_embed_texts(calls))
+    vectors = asyncio.run(embed_in_batches(None, [f"text {i}" for i in range(10)], batch_size=4))
+    assert calls == [4, 4, 2]
+    assert len(vectors) == 10 and all(vector is not None for vector in vectors)
+
+def test_failed_batch_gives_none(monkeypatch):
+    calls: list[int] = []
+    monkeypatch.setattr(utils.embedders, "embed_texts", fake_embed_texts(calls, fail_on=2))
+    vectors = asyncio.run(embed_in_batches(None, [f"text {i}" for i in range(10)], batch_size=4))
+    assert vectors[4:8] == [None] * 4
+    assert all(vector is not None for vector in vectors[:4] + vectors[8:])
+
+def test_file_is_embedded_in_one_call(tmp_path, monkeypatch):
+    calls: list[int] = []
+    monkeypatch.setattr(utils.embedders, "embed_texts", fake_embed_texts(calls))
+    sections = [f"# Section {i}\n\n" + " ".join(f"s{i}w{j}" for j in range(150)) for i in range(6)]
+    # the last section repeats the first, it is referenced instead of embedded
+    path = tmp_path / "doc.md"
+    path.write_text("\n\n".join(sections + [sections[0]]))
+    embedding = Embedding()
+    docs = asyncio.run(embedding.generate_from_file(str(path), "doc.md", dedup=ChunkDeduplicator()))
+    assert len(calls) == 1
+    assert calls[0] == len(docs) > 1
+    assert len(embedding.references) >= 1
+    assert set(embedding.pending) == {doc["content_hash"] for doc in docs}
@@ -0,0 +1,46 @@
+import asyncio
+import json
+
+import pytest
+
+from utils.json_stream import iter_json_array
+
+ITEMS = [
+    {"title": "quote \" and backslash \\", "text": "line\nbreak, comma ] bracket"},
+    {"nested": {"list": [1, [2, 3], {"deep": [4]}], "empty": {}}},
+    "unicode café ☃",
+    12345,
+    -1.5e3,
+    True,
+    None,
+    [],
+]
+
+async def chunked(data: bytes, size: int):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+def parse(data: bytes, size: int) -> list:
+    async def collect():
+        return [item async for item in iter_json_array(chunked(data, size))]
+    return asyncio.run(collect())
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, 100000])
+def test_items_split_across_chunks(size):
+    data = json.dumps(ITEMS, indent=1, ensure_ascii=False).encode()
+    assert parse(data, size) == ITEMS
+
+def test_number_at_chunk_end_waits_for_more_digits():
+    assert parse(b"[12,345]", 3) == [12, 345]
+    assert parse(b"[123]", 3) == [123]
+
+def test_empty_array():
+    assert parse(b"  [ ]  ", 1) == []
+
+def test_not_an_array():
+    with pytest.raises(ValueError, match="Expected a JSON array"):
+        parse(b'{"a": 1}', 4)
+
+def test_truncated_array():
+    with pytest.raises(ValueError):
+        parse(b'[{"a": 1}, {"b": ', 4)
@@ -0,0 +1,52 @@
+import time
+import asyncio
+
+import pytest
+
+from utils.profiling import profiled, scope
+
+@pytest.fixture(autouse=True)
+def profile_dir(tmp_path, monkeypatch):
+    # profiles are written to ./profiles
+    monkeypatch.chdir(tmp_path)
+
+def busy(seconds: float):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        sum(range(1000))
+
+def test_profiled_block_records_samples():
+    with profiled("sync") as profile:
+        busy(0.2)
+    assert profile.samples > 0
+    assert all(stack.startswith("sync;") for stack in profile.stacks)
+    assert profile.path.exists()
+
+def test_tasks_started_while_profiling_are_recorded():
+    async def child():
+        with scope("child scope"):
+            busy(0.2)
+
+    async def main():
+        with profiled("async") as profile:
+            await asyncio.create_task(child())
+        return profile
+
+    profile = asyncio.run(main())
+    assert profile.samples > 0
+    assert any(stack.startswith("child scope;") for stack in profile.stacks)
+
+def test_tasks_outliving_the_profile_are_not_recorded():
+    async def child():
+        await asyncio.sleep(0.05)
+        busy(0.2)
+
+    async def main():
+        with profiled("outlived") as profile:
+            task = asyncio.create_task(child())
+        samples = profile.samples
+        await task
+        return profile, samples
+
+    profile, samples = asyncio.run(main())
+    assert profile.samples == samples
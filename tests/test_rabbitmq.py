@@ -0,0 +1,50 @@
+from databases.rabbitmq import LaneScheduler
+
+def lanes(interactive: int, bulk: int) -> LaneScheduler:
+    scheduler = LaneScheduler()
+    for index in range(interactive):
+        scheduler.add("interactive", ("interactive", index))
+    for index in range(bulk):
+        scheduler.add("bulk", ("bulk", index))
+    return scheduler
+
+def drain(scheduler: LaneScheduler, weight: int) -> list[tuple]:
+    order = []
+    while (delivery := scheduler.next(weight)) is not None:
+        order.append(delivery)
+    return order
+
+def test_empty():
+    scheduler = LaneScheduler()
+    assert scheduler.next() is None
+    assert len(scheduler) == 0
+
+def test_interactive_first_with_bulk_every_weight():
+    order = drain(lanes(6, 3), weight=2)
+    assert [lane for lane, _ in order] == [
+        "interactive", "interactive", "bulk",
+        "interactive", "interactive", "bulk",
+        "interactive", "interactive", "bulk",
+    ]
+    # each lane keeps its own order
+    assert [index for lane, index in order if lane == "bulk"] == [0, 1, 2]
+    assert [index for lane, index in order if lane == "interactive"] == list(range(6))
+
+def test_bulk_not_starved_by_a_stream_of_interactive():
+    scheduler = lanes(0, 1)
+    taken = []
+    for index in range(10):
+        scheduler.add("interactive", ("interactive", index))
+        taken.append(scheduler.next(weight=4))
+    assert ("bulk", 0) in taken
+    assert taken.index(("bulk", 0)) == 4
+
+def test_streak_only_counts_while_bulk_waits():
+    scheduler = lanes(5, 0)
+    assert [scheduler.next(weight=2) for _ in range(3)] == [("interactive", i) for i in range(3)]
+    # the interactive deliveries taken with no bulk one waiting don't count against it
+    scheduler.add("bulk", ("bulk", 0))
+    assert drain(scheduler, weight=2) == [("interactive", 3), ("interactive", 4), ("bulk", 0)]
+
+def test_only_bulk():
+    assert drain(lanes(0, 3), weight=4) == [("bulk", i) for i in range(3)]
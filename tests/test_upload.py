@@ -0,0 +1,73 @@
+import asyncio
+import hashlib
+
+import pytest
+from starlette.requests import Request
+
+from services.upload import SpoolWriter, UploadError, receive_upload
+
+BOUNDARY = "----testboundary7MA4YWxkTrZu0gW"
+# looks like a boundary and a part end without being one
+CONTENT = b"# Title\r\n\r\n------testboundary7MA4\r\n--\r\n" + bytes(range(256)) * 40 + b"\r\n-- end"
+
+def multipart(parts: list[tuple[str, str | None, bytes]]) -> bytes:
+    body = b""
+    for name, filename, data in parts:
+        disposition = f'form-data; name="{name}"' + (f'; filename="{filename}"' if filename else "")
+        body += f"--{BOUNDARY}\r\nContent-Disposition: {disposition}\r\n".encode()
+        if filename:
+            body += b"Content-Type: application/octet-stream\r\n"
+        body += b"\r\n" + data + b"\r\n"
+    return body + f"--{BOUNDARY}--\r\n".encode()
+
+def request(body: bytes, chunk_size: int, content_type: str = f"multipart/form-data; boundary={BOUNDARY}") -> Request:
+    chunks = [body[start:start + chunk_size] for start in range(0, len(body), chunk_size)]
+    async def receive():
+        chunk = chunks.pop(0) if chunks else b""
+        return {"type": "http.request", "body": chunk, "more_body": bool(chunks)}
+    scope = {"type": "http", "method": "POST", "headers": [(b"content-type", content_type.encode())]}
+    return Request(scope, receive)
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 37, 1000, 100000])
+def test_boundaries_straddling_chunks(tmp_path, chunk_size):
+    body = multipart([("note", None, b"a form field"), ("file", "../guide.md", CONTENT)])
+    upload = asyncio.run(receive_upload(request(body, chunk_size), spool_dir=tmp_path))
+    assert upload.filename == "guide.md"
+    assert upload.size == len(CONTENT)
+    assert upload.file_hash == hashlib.sha256(CONTENT).hexdigest()
+    assert upload.path.read_bytes() == CONTENT
+    assert upload.path.parent == tmp_path
+
+def test_spool_writer_hashes_across_chunks(tmp_path):
+    async def spool():
+        writer = SpoolWriter(tmp_path, chunk_size=7)
+        await writer.open()
+        for start in range(0, len(CONTENT), 3):
+            await writer.write(CONTENT[start:start + 3])
+        await writer.close()
+        return writer
+    writer = asyncio.run(spool())
+    assert writer.digest.hexdigest() == hashlib.sha256(CONTENT).hexdigest()
+    assert writer.path.read_bytes() == CONTENT
+
+def test_missing_file(tmp_path):
+    body = multipart([("note", None, b"no file here")])
+    with pytest.raises(UploadError, match="No file"):
+        asyncio.run(receive_upload(request(body, 16), spool_dir=tmp_path))
+
+def test_unsupported_type_leaves_nothing(tmp_path):
+    body = multipart([("file", "tool.exe", CONTENT)])
+    with pytest.raises(UploadError) as raised:
+        asyncio.run(receive_upload(request(body, 16), spool_dir=tmp_path))
+    assert raised.value.status_code == 415
+    assert list(tmp_path.iterdir()) == []
+
+def test_not_multipart(tmp_path):
+    with pytest.raises(UploadError, match="multipart"):
+        asyncio.run(receive_upload(request(b"{}", 16, "application/json"), spool_dir=tmp_path))
+
+def test_truncated_body_leaves_nothing(tmp_path):
+    body = multipart([("file", "guide.md", CONTENT)])
+    with pytest.raises(UploadError):
+        asyncio.run(receive_upload(request(body[:len(body) // 2], 64), spool_dir=tmp_path))
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,141 @@
+import math
+import time
+import asyncio
+import logfire
+
+from contextlib import asynccontextmanager
+from utils.settings import Settings, get_settings, on_reload
+
+shed_counter = logfire.metric_counter('admission.shed', unit='1', description='Requests rejected by admission control')
+queue_gauge = logfire.metric_up_down_counter('admission.queue_depth', unit='1', description='Requests waiting for a slot')
+
+class Overloaded(Exception):
+    """Raised when a request can't get a slot, turned into a 503 with `Retry-After`."""
+    def __init__(self, endpoint: str, retry_after: int):
+        super().__init__(f"{endpoint} is overloaded, retry after {retry_after}s")
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+class AdmissionController:
+    """Concurrency limit for one endpoint with a bounded, deadline-limited wait queue.
+
+    Up to `max_concurrent` requests run at once, up to `max_queue` more wait at most
+    `queue_timeout` seconds for a slot, anything beyond that is shed straight away.
+    """
+    name: str
+    max_concurrent: int
+    max_queue: int
+    queue_timeout: float
+    def __init__(self, name: str, max_concurrent: int, max_queue: int, queue_timeout: float):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.shed = 0
+        # moving average of how long an admitted request holds its slot, for Retry-After
+        self.service_seconds = 1.0
+
+    def configure(self, max_concurrent: int, max_queue: int, queue_timeout: float):
+        """Change the limits in place, requests in flight keep their slots."""
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        change = max_concurrent - self.max_concurrent
+        self.max_concurrent = max_concurrent
+        for _ in range(change):
+            self.semaphore.release()
+        if change < 0:
+            # fewer slots: the freed ones are taken out of circulation as requests finish
+            asyncio.get_running_loop().create_task(self._withdraw(-change))
+
+    async def _withdraw(self, slots: int):
+        for _ in range(slots):
+            await self.semaphore.acquire()
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.service_seconds * (self.waiting + 1) / self.max_concurrent))
+
+    def _shed(self, reason: str) -> Overloaded:
+        self.shed += 1
+        shed_counter.add(1, {"endpoint": self.name, "reason": reason})
+        logfire.warn('Shedding {endpoint} request: {reason}', endpoint=self.name, reason=reason)
+        return Overloaded(self.name, self.retry_after())
+
+    async def acquire(self) -> float:
+        """Wait for a slot, returns the admission time to pass back to `release`."""
+        if self.semaphore.locked() and self.waiting >= self.max_queue:
+            raise self._shed("queue full")
+        self.waiting += 1
+        queue_gauge.add(1, {"endpoint": self.name})
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), timeout=self.queue_timeout)
+        except TimeoutError:
+            raise self._shed("queue deadline")
+        finally:
+            self.waiting -= 1
+            queue_gauge.add(-1, {"endpoint": self.name})
+        self.active += 1
+        self.admitted += 1
+        return time.perf_counter()
+
+    def release(self, admitted_at: float):
+        self.active -= 1
+        self.service_seconds = 0.9 * self.service_seconds + 0.1 * (time.perf_counter() - admitted_at)
+        self.semaphore.release()
+
+    @asynccontextmanager
+    async def admit(self):
+        admitted_at = await self.acquire()
+        try:
+            yield
+        finally:
+            self.release(admitted_at)
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "active": self.active,
+            "queue_depth": self.waiting,
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "service_seconds": self.service_seconds,
+        }
+
+# per endpoint defaults, ADMISSION_<NAME>_CONCURRENCY / _QUEUE / _QUEUE_TIMEOUT override them
+ENDPOINT_LIMITS = {
+    "chat": (8, 16, 5.0),
+    "default_webhook": (16, 32, 5.0),
+    "rag_chat": (8, 16, 5.0),
+    "learning_ask": (8, 16, 5.0),
+    # every batch runs up to BATCH_ASK_CONCURRENCY agent calls of its own
+    "learning_ask_batch": (2, 4, 5.0),
+}
+
+controllers: dict[str, AdmissionController] = {}
+
+def endpoint_limits(name: str, settings: Settings) -> tuple[int, int, float]:
+    concurrency, queue, timeout = ENDPOINT_LIMITS.get(name, (8, 16, 5.0))
+    return (
+        int(settings.admission.get(f"{name}_concurrency", concurrency)),
+        int(settings.admission.get(f"{name}_queue", queue)),
+        float(settings.admission.get(f"{name}_queue_timeout", timeout)),
+    )
+
+def get_controller(name: str) -> AdmissionController:
+    if name not in controllers:
+        max_concurrent, max_queue, queue_timeout = endpoint_limits(name, get_settings())
+        controllers[name] = AdmissionController(name, max_concurrent, max_queue, queue_timeout)
+    return controllers[name]
+
+def _apply_settings(settings: Settings):
+    for name, controller in controllers.items():
+        controller.configure(*endpoint_limits(name, settings))
+
+on_reload(_apply_settings)
+
+def admission_stats() -> dict[str, dict]:
+    return {name: controller.stats() for name, controller in controllers.items()}
@@ -0,0 +1,83 @@
+"""Streamed agent answers as new line delimited JSON.
+
+The streaming variants of `/learning/ask` and the webhooks send one event per line:
+
+    {"type": "delta", "content": "Call the token "}
+    {"type": "delta", "content": "endpoint with the refresh token."}
+    {"type": "done", "content": "Call the token endpoint with the refresh token.", "usage": {...}}
+
+`done` comes after the turn was saved, `usage` covers every model request of the run,
+tool call rounds included. A run failing after the response has started ends with
+`{"type": "error", "message": ...}` instead, the status code is already sent by then.
+"""
+import json
+import logfire
+
+from typing import AsyncIterator, Callable
+
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from pydantic_ai.result import StreamedRunResult
+from pydantic_ai.usage import Usage
+
+from utils.admission import AdmissionController
+
+MEDIA_TYPE = "application/x-ndjson"
+
+def event(payload: dict) -> bytes:
+    return json.dumps(payload).encode("utf-8") + b"\n"
+
+def usage_dict(usage: Usage) -> dict:
+    return {
+        "requests": usage.requests,
+        "request_tokens": usage.request_tokens,
+        "response_tokens": usage.response_tokens,
+        "total_tokens": usage.total_tokens,
+    }
+
+async def answer_events(
+    runs: AsyncIterator[StreamedRunResult],
+    on_complete: Callable[[str, StreamedRunResult], None] | None = None,
+    extra: dict | None = None,
+    debounce_by: float | None = 0.05,
+) -> AsyncIterator[bytes]:
+    """Events of the run `runs` yields, `on_complete` persists the answer of the finished run before `done`."""
+    chunks: list[str] = []
+    try:
+        async for stream in runs:
+            async for delta in stream.stream_text(delta=True, debounce_by=debounce_by):
+                chunks.append(delta)
+                yield event({"type": "delta", "content": delta})
+            answer = "".join(chunks)
+            usage = stream.usage()
+        if on_complete is not None:
+            on_complete(answer, stream)
+    except Exception as e:
+        logfire.error(f"Streamed answer failed: {e}")
+        yield event({"type": "error", "message": str(e)})
+        return
+    yield event({"type": "done", "content": answer, "usage": usage_dict(usage), **(extra or {})})
+
+def admitted_response(admission: AdmissionController, admitted_at: float, events: AsyncIterator[bytes]) -> StreamingResponse:
+    """Stream `events` while holding the admission slot taken at `admitted_at`.
+
+    The slot is released when the stream ends, or by the background task when the
+    client disconnects before the stream has started.
+    """
+    released = False
+    def release_slot():
+        nonlocal released
+        if not released:
+            released = True
+            admission.release(admitted_at)
+
+    async def stream():
+        try:
+            async for chunk in events:
+                yield chunk
+        finally:
+            # closes the agent run as well when the client went away mid answer
+            await events.aclose()
+            release_slot()
+
+    return StreamingResponse(stream(), media_type=MEDIA_TYPE, background=BackgroundTask(release_slot))
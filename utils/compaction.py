@@ -0,0 +1,181 @@
+"""Token-budgeted chat histories.
+
+The most recent turns of a session are sent verbatim as long as they fit the token
+budget, everything older is replaced by a running summary. Summaries are written by
+a background task with the fast model, a request only ever reads the latest one, so
+compaction adds no model call to the request path. Until a refresh has caught up, the
+turns it doesn't cover yet stay in the history verbatim.
+"""
+import asyncio
+import logfire
+
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from pydantic_ai import Agent
+from pydantic_ai.messages import (
+    ModelMessage,
+    ModelRequest,
+    ModelResponse,
+    SystemPromptPart,
+    TextPart,
+    ToolCallPart,
+    ToolReturnPart,
+    UserPromptPart,
+)
+
+from agents.model_router import model_router
+from databases.memory import SessionLocal
+from models import SessionSummary
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# roughly what the API adds around every message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+def count_tokens(text: str) -> int:
+    if tiktoken is None:
+        # close enough for English prose when tiktoken isn't installed
+        return len(text) // 4
+    return len(tiktoken.encoding_for_model("gpt-4o").encode(text))
+
+def part_text(part) -> str:
+    if isinstance(part, ToolCallPart):
+        return f"{part.tool_name} {part.args_as_json_str()}"
+    if isinstance(part, ToolReturnPart):
+        return part.model_response_str()
+    content = getattr(part, "content", "")
+    return content if isinstance(content, str) else str(content)
+
+def message_tokens(messages: list[ModelMessage]) -> int:
+    return sum(
+        MESSAGE_OVERHEAD_TOKENS + sum(count_tokens(part_text(part)) for part in message.parts)
+        for message in messages
+    )
+
+def transcript(turns: list[list[ModelMessage]]) -> str:
+    """What was said in the turns, tool calls and retrieved documents left out."""
+    lines = []
+    for messages in turns:
+        for message in messages:
+            for part in message.parts:
+                if isinstance(part, UserPromptPart):
+                    lines.append(f"User: {part.content}")
+                elif isinstance(part, TextPart) and isinstance(message, ModelResponse):
+                    lines.append(f"Assistant: {part.content}")
+    return "\n".join(lines)
+
+def budget_start(tokens: list[int], budget: int) -> int:
+    """Index of the oldest turn kept verbatim, the newest turn is always kept."""
+    used = 0
+    start = len(tokens)
+    while start > 0 and used + tokens[start - 1] <= budget:
+        start -= 1
+        used += tokens[start]
+    return min(start, max(len(tokens) - 1, 0))
+
+# runs on the fast model of `model_router`
+summarizer = Agent(
+    result_type=str,
+    system_prompt=(
+        'You keep a running summary of a conversation between a user and a documentation assistant. '
+        'Merge the new part of the conversation into the existing summary. Keep facts, names, settings, '
+        'decisions and open questions the user may come back to, drop pleasantries. '
+        'Answer with the updated summary only, at most 300 words.'
+    ),
+)
+
+class HistoryCompactor:
+    """Running summaries per session, cached in memory and stored in `session_summaries`."""
+    max_sessions: int
+    def __init__(self, max_sessions: int = 1000):
+        self.max_sessions = max_sessions
+        # session id -> (summary, number of turns it covers)
+        self.summaries: OrderedDict[str, tuple[str, int]] = OrderedDict()
+        self.refreshing: dict[str, asyncio.Task] = {}
+
+    def summary(self, db, session_id: str) -> tuple[str, int]:
+        cached = self.summaries.get(session_id)
+        if cached is not None:
+            self.summaries.move_to_end(session_id)
+            return cached
+        row = db.get(SessionSummary, session_id)
+        cached = (row.summary, row.turns) if row is not None else ("", 0)
+        self.remember(session_id, cached)
+        return cached
+
+    def remember(self, session_id: str, summary: tuple[str, int]):
+        self.summaries[session_id] = summary
+        self.summaries.move_to_end(session_id)
+        while len(self.summaries) > self.max_sessions:
+            self.summaries.popitem(last=False)
+
+    def compact(self, db, session_id: str, tokens: list[int], budget: int) -> tuple[ModelMessage | None, int]:
+        """The summary message to send and the index of the first turn to send verbatim."""
+        start = budget_start(tokens, budget)
+        summary, covered = self.summary(db, session_id)
+        if covered < start:
+            self.schedule_refresh(session_id, start)
+        if not summary:
+            return None, 0
+        # verbatim from where the summary ends, turns it doesn't cover yet are sent as they
+        # are and turns it covers are not sent again, even when the budget would fit them
+        message = ModelRequest(parts=[SystemPromptPart(content=f'Summary of the earlier conversation:\n{summary}')])
+        return message, min(covered, len(tokens))
+
+    def schedule_refresh(self, session_id: str, through: int):
+        if session_id in self.refreshing:
+            return
+        try:
+            task = asyncio.get_running_loop().create_task(self.refresh(session_id, through))
+        except RuntimeError:
+            # no loop, e.g. a script loading a history, the summary waits for the next request
+            return
+        self.refreshing[session_id] = task
+        task.add_done_callback(lambda _: self.refreshing.pop(session_id, None))
+
+    async def refresh(self, session_id: str, through: int):
+        """Fold the turns up to `through` into the session's summary."""
+        try:
+            with logfire.span('refresh history summary of {session_id=}', session_id=session_id):
+                summary, covered = await asyncio.to_thread(self.load_summary, session_id)
+                turns = await asyncio.to_thread(self.load_turns, session_id, covered, through)
+                if not turns:
+                    return
+                prompt = f'Summary so far:\n{summary or "(empty)"}\n\nNew part of the conversation:\n{transcript(turns)}'
+                result = await summarizer.run(prompt, model=model_router.model("fast"))
+                await asyncio.to_thread(self.store, session_id, result.data, through)
+                self.remember(session_id, (result.data, through))
+        except Exception as e:
+            logfire.error(f"History summary of {session_id} failed: {e}")
+
+    def load_summary(self, session_id: str) -> tuple[str, int]:
+        with SessionLocal() as db:
+            row = db.get(SessionSummary, session_id)
+            return (row.summary, row.turns) if row is not None else ("", 0)
+
+    def load_turns(self, session_id: str, start: int, end: int) -> list[list[ModelMessage]]:
+        # utils.history imports this module
+        from utils.history import load_turns
+        with SessionLocal() as db:
+            return [turn.messages() for turn in load_turns(db, session_id)[start:end]]
+
+    def store(self, session_id: str, summary: str, turns: int):
+        with SessionLocal() as db:
+            row = db.get(SessionSummary, session_id)
+            if row is None:
+                row = SessionSummary(session_id=session_id)
+                db.add(row)
+            # a slower refresh never overwrites a newer summary
+            if row.turns is not None and row.turns >= turns:
+                return
+            row.summary = summary
+            row.turns = turns
+            row.updated_at = datetime.now(tz=timezone.utc)
+            db.commit()
+
+# shared by the routers, summaries are keyed by the chat session id
+history_compactor = HistoryCompactor()
@@ -0,0 +1,26 @@
+import zlib
+
+from typing import Iterable, Iterator
+
+def accepts_gzip(accept_encoding: str | None) -> bool:
+    if not accept_encoding:
+        return False
+    for encoding in accept_encoding.split(","):
+        name, _, params = encoding.strip().partition(";")
+        if name.strip() in ("gzip", "*") and params.replace(" ", "") != "q=0":
+            return True
+    return False
+
+def gzip_stream(chunks: Iterable[bytes], flush_bytes: int = 16 * 1024) -> Iterator[bytes]:
+    """Gzip a stream of chunks, flushing every `flush_bytes` so the client can decode as it goes."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    pending = 0
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        pending += len(chunk)
+        if pending >= flush_bytes:
+            data += compressor.flush(zlib.Z_SYNC_FLUSH)
+            pending = 0
+        if data:
+            yield data
+    yield compressor.flush()
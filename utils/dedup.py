@@ -0,0 +1,108 @@
+import re
+import hashlib
+import logfire
+
+# Mersenne prime used for the MinHash permutations, larger than any 32 bit shingle hash
+_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+def normalize_chunk(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+def content_hash(text: str) -> str:
+    """Exact duplicate key of a chunk, insensitive to whitespace and case."""
+    return hashlib.sha256(normalize_chunk(text).encode("utf-8")).hexdigest()
+
+class ChunkDeduplicator:
+    """Exact hash plus MinHash/LSH near-duplicate detection for chunks.
+
+    The index lives in memory and is seeded from the already stored sections
+    with `load`, so duplicates are detected across the whole corpus and not
+    only inside one file.
+    """
+    num_perm: int
+    bands: int
+    threshold: float
+    def __init__(self, num_perm: int = 128, bands: int = 16, threshold: float = 0.85, shingle_size: int = 5):
+        if num_perm % bands != 0:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.loaded = False
+        # fixed seed so signatures stored in the database stay comparable between runs
+        seed = hashlib.sha256(b"py-ai-agent-minhash").digest()
+        self._perms = []
+        for i in range(num_perm):
+            a = int.from_bytes(hashlib.sha256(seed + b"a" + i.to_bytes(2, "big")).digest()[:8], "big") % _PRIME
+            b = int.from_bytes(hashlib.sha256(seed + b"b" + i.to_bytes(2, "big")).digest()[:8], "big") % _PRIME
+            self._perms.append((a or 1, b))
+        self._hashes: set[str] = set()
+        self._signatures: dict[str, list[int]] = {}
+        self._buckets: dict[tuple[int, tuple[int, ...]], list[str]] = {}
+
+    def _shingles(self, text: str) -> set[int]:
+        words = normalize_chunk(text).split(" ")
+        if len(words) < self.shingle_size:
+            grams = [" ".join(words)]
+        else:
+            grams = [" ".join(words[i:i + self.shingle_size]) for i in range(len(words) - self.shingle_size + 1)]
+        return {int.from_bytes(hashlib.blake2b(g.encode("utf-8"), digest_size=4).digest(), "big") for g in grams}
+
+    def signature(self, text: str) -> list[int]:
+        shingles = self._shingles(text)
+        return [
+            min(((a * s + b) % _PRIME) & _MAX_HASH for s in shingles)
+            for a, b in self._perms
+        ]
+
+    def _band_keys(self, signature: list[int]):
+        for band in range(self.bands):
+            yield (band, tuple(signature[band * self.rows:(band + 1) * self.rows]))
+
+    def similarity(self, left: list[int], right: list[int]) -> float:
+        return sum(1 for l, r in zip(left, right) if l == r) / self.num_perm
+
+    def add(self, key: str, signature: list[int]):
+        self._hashes.add(key)
+        self._signatures[key] = signature
+        for band_key in self._band_keys(signature):
+            self._buckets.setdefault(band_key, []).append(key)
+
+    def find_duplicate(self, key: str, signature: list[int], pending: dict[str, list[int]] | None = None) -> str | None:
+        """Return the key of a stored chunk this one duplicates, if any.
+
+        `pending` are the chunks of the file being indexed that aren't stored yet, they are
+        only added to the index once their sections are saved.
+        """
+        if key in self._hashes:
+            return key
+        for candidate, candidate_signature in (pending or {}).items():
+            if candidate == key or self.similarity(signature, candidate_signature) >= self.threshold:
+                return candidate
+        seen: set[str] = set()
+        for band_key in self._band_keys(signature):
+            for candidate in self._buckets.get(band_key, []):
+                if candidate in seen:
+                    continue
+                seen.add(candidate)
+                if self.similarity(signature, self._signatures[candidate]) >= self.threshold:
+                    return candidate
+        return None
+
+    async def load(self, collection):
+        """Seed the index with the sections already stored in `collection`."""
+        with logfire.span('dedup.load'):
+            cursor = collection.find(
+                {"content_hash": {"$exists": True}},
+                {"_id": 0, "content_hash": 1, "minhash": 1},
+            )
+            async for doc in cursor:
+                if doc.get("minhash"):
+                    self.add(doc["content_hash"], doc["minhash"])
+                else:
+                    self._hashes.add(doc["content_hash"])
+            self.loaded = True
+            logfire.info(f"Loaded {len(self._hashes)} chunk hashes for dedup")
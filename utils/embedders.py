@@ -0,0 +1,220 @@
+"""Embedding providers.
+
+`EMBEDDING_PROVIDER` picks how sections and search queries are embedded:
+
+- `openai:<model>[:<dimensions>]`, the default `openai:text-embedding-3-small`, one
+  API request per batch of texts
+- `local:<path>`, a sentence embedding model exported to ONNX, `model.onnx` or
+  `model_quantized.onnx` next to its `tokenizer.json`, run on the CPU without any
+  network call, needs `onnxruntime`, `tokenizers` and `numpy`
+- `hashing[:<dimensions>]`, a deterministic hashed bag of words, for tests and
+  offline runs, its similarity is only lexical
+
+Vectors of different providers, or of one model at different sizes, can't be compared.
+The provider name and dimensions are recorded per collection (`databases.embedding_space`)
+and a search or write with another provider is rejected with `EmbeddingMismatch`.
+"""
+import os
+import re
+import math
+import asyncio
+import hashlib
+import logfire
+
+from array import array
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.settings import Settings, get_settings, on_reload
+from utils.vectors import decode_base64
+
+# texts per `embed_texts` call when indexing files, the local provider splits them into its own batches
+INGEST_BATCH_SIZE = 128
+
+OPENAI_DIMENSIONS = {
+    "text-embedding-3-small": 1536,
+    "text-embedding-3-large": 3072,
+    "text-embedding-ada-002": 1536,
+}
+
+class EmbeddingMismatch(ValueError):
+    pass
+
+class OpenAIEmbedder:
+    name: str
+    dimensions: int
+    def __init__(self, model: str = "text-embedding-3-small", dimensions: int | None = None):
+        self.model = model
+        self.name = f"openai:{model}"
+        # text-embedding-3 models return shortened vectors when asked for fewer dimensions
+        self.requested_dimensions = dimensions
+        self.dimensions = dimensions or OPENAI_DIMENSIONS.get(model, 1536)
+        self.client = None
+
+    async def embed(self, texts: list[str], openai=None) -> list[array]:
+        """Float32 arrays decoded straight from the base64 response, `openai` is the client to call."""
+        if openai is None:
+            if self.client is None:
+                from openai import AsyncOpenAI
+                self.client = AsyncOpenAI()
+            openai = self.client
+        options = {"dimensions": self.requested_dimensions} if self.requested_dimensions else {}
+        response = await openai.embeddings.create(input=texts, model=self.model, encoding_format="base64", **options)
+        assert (
+            len(response.data) == len(texts)
+        ), f'Expected {len(texts)} embeddings, got {len(response.data)}'
+        return [decode_base64(item.embedding) for item in sorted(response.data, key=lambda item: item.index)]
+
+class LocalEmbedder:
+    """An ONNX sentence embedding model run on the CPU.
+
+    Texts are split into batches of `batch_size` that a pool of `workers` threads embeds
+    at the same time. onnxruntime and the tokenizer release the GIL while they run, so the
+    threads use as many cores, each session run is kept to one thread to not oversubscribe.
+    """
+    name: str
+    dimensions: int
+    def __init__(self, path: str, batch_size: int = 32, workers: int | None = None, max_length: int = 256):
+        try:
+            import numpy
+            import onnxruntime
+            from tokenizers import Tokenizer
+        except ImportError:
+            raise RuntimeError("EMBEDDING_PROVIDER is local:<path>, install `onnxruntime`, `tokenizers` and `numpy`")
+        self.np = numpy
+        location = Path(path)
+        directory = location.parent if location.suffix == ".onnx" else location
+        model_file = location if location.suffix == ".onnx" else next(
+            (directory / name for name in ("model_quantized.onnx", "model.onnx", "onnx/model.onnx") if (directory / name).exists()),
+            None,
+        )
+        if model_file is None or not (directory / "tokenizer.json").exists():
+            raise RuntimeError(f"No model.onnx and tokenizer.json in {directory}")
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(str(model_file), options, providers=["CPUExecutionProvider"])
+        self.inputs = {item.name for item in self.session.get_inputs()}
+        self.tokenizer = Tokenizer.from_file(str(directory / "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length)
+        self.tokenizer.enable_padding()
+        self.batch_size = batch_size
+        self.executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count(), thread_name_prefix="embedding")
+        self.name = f"local:{directory.name}"
+        self.dimensions = len(self.encode(["dimensions"])[0])
+
+    def encode(self, texts: list[str]):
+        np = self.np
+        encodings = self.tokenizer.encode_batch(texts)
+        ids = np.array([encoding.ids for encoding in encodings], dtype=np.int64)
+        mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+        feeds = {"input_ids": ids, "attention_mask": mask}
+        if "token_type_ids" in self.inputs:
+            feeds["token_type_ids"] = np.zeros_like(ids)
+        output = self.session.run(None, feeds)[0]
+        if output.ndim == 3:
+            # token embeddings, mean pooled over the tokens that aren't padding
+            weights = mask[:, :, None].astype(np.float32)
+            output = (output * weights).sum(axis=1) / np.clip(weights.sum(axis=1), 1e-9, None)
+        norms = np.linalg.norm(output, axis=1, keepdims=True)
+        return (output / np.clip(norms, 1e-12, None)).astype(np.float32)
+
+    async def embed(self, texts: list[str], openai=None) -> list[array]:
+        loop = asyncio.get_running_loop()
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        encoded = await asyncio.gather(*(loop.run_in_executor(self.executor, self.encode, batch) for batch in batches))
+        return [array("f", row.tobytes()) for vectors in encoded for row in vectors]
+
+class HashingEmbedder:
+    """Words hashed into signed buckets, the same text always gets the same vector."""
+    name: str
+    dimensions: int
+    def __init__(self, dimensions: int = 256):
+        self.dimensions = dimensions
+        self.name = "hashing"
+
+    def vector(self, text: str) -> array:
+        vector = array("f", bytes(4 * self.dimensions))
+        for word in re.findall(r"\w+", text.lower()):
+            digest = hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest()
+            index = int.from_bytes(digest[:4], "big") % self.dimensions
+            vector[index] += 1.0 if digest[4] & 1 else -1.0
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return array("f", (v / norm for v in vector))
+
+    async def embed(self, texts: list[str], openai=None) -> list[array]:
+        return [self.vector(text) for text in texts]
+
+Embedder = OpenAIEmbedder | LocalEmbedder | HashingEmbedder
+
+def open_embedder(spec: str) -> Embedder:
+    kind, _, argument = spec.partition(":")
+    if kind == "openai":
+        model, _, dimensions = (argument or "text-embedding-3-small").partition(":")
+        return OpenAIEmbedder(model, int(dimensions) if dimensions else None)
+    if kind == "local":
+        if not argument:
+            raise ValueError("EMBEDDING_PROVIDER local:<path> needs the model directory")
+        settings = get_settings()
+        return LocalEmbedder(argument, settings.embedding_batch_size, settings.embedding_workers)
+    if kind == "hashing":
+        return HashingEmbedder(int(argument) if argument else 256)
+    raise ValueError(f"Unsupported EMBEDDING_PROVIDER {spec!r}")
+
+_provider: Embedder | None = None
+# the EMBEDDING_PROVIDER value the provider was opened from, None for one set in code
+_provider_spec: str | None = None
+
+def embedding_provider() -> Embedder:
+    """The provider of this process, loaded on first use."""
+    global _provider, _provider_spec
+    if _provider is None:
+        _provider_spec = get_settings().embedding_provider
+        _provider = open_embedder(_provider_spec)
+    return _provider
+
+def set_embedding_provider(embedder: Embedder | None):
+    """Use `embedder` from now on, None goes back to `EMBEDDING_PROVIDER`."""
+    global _provider, _provider_spec
+    _provider = embedder
+    _provider_spec = None
+
+def _forget_provider():
+    global _provider
+    _provider = None
+
+def _apply_settings(settings: Settings):
+    # opened again on next use when EMBEDDING_PROVIDER changed, a provider set in code is kept
+    if _provider_spec is not None and _provider_spec != settings.embedding_provider:
+        _forget_provider()
+
+on_reload(_apply_settings)
+
+# the thread pool and the onnxruntime session of the parent don't survive a fork
+os.register_at_fork(after_in_child=_forget_provider)
+
+async def embed_texts(openai, texts: list[str]) -> list[array]:
+    """Embed texts into float32 arrays with the configured provider.
+
+    `openai` is the client the OpenAI provider calls, the local providers don't use it.
+    """
+    return await embedding_provider().embed(texts, openai)
+
+async def embed_in_batches(openai, texts: list[str], batch_size: int = INGEST_BATCH_SIZE) -> list[array | None]:
+    """`embed_texts` with one call per `batch_size` texts, the texts of a failed call get None."""
+    vectors: list[array | None] = []
+    for start in range(0, len(texts), batch_size):
+        batch = texts[start:start + batch_size]
+        try:
+            vectors.extend(await embed_texts(openai, batch))
+        except Exception as e:
+            logfire.error(f"Embedding {len(batch)} texts failed: {e}")
+            vectors.extend([None] * len(batch))
+    return vectors
+
+def check_space(collection: str, provider: str, dimensions: int, embedder: Embedder):
+    """Reject `embedder` for a collection whose vectors were recorded as `provider` and `dimensions`."""
+    if provider != embedder.name or dimensions != embedder.dimensions:
+        raise EmbeddingMismatch(
+            f"{collection} holds {provider} vectors of {dimensions} dimensions, "
+            f"EMBEDDING_PROVIDER is {embedder.name} with {embedder.dimensions}"
+        )
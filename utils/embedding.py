@@ -1,16 +1,25 @@
 import logfire
 
 from openai import AsyncOpenAI
-from langchain_text_splitters import MarkdownTextSplitter
 
 from models import DocSection
+from utils.dedup import ChunkDeduplicator, content_hash
+from utils.embedders import embed_in_batches
+from utils.profiling import scope
 
 class Embedding:
     open_ai: AsyncOpenAI
+    references: list[tuple[str, str]]
+    pending: dict[str, list[int]]
     def __init__(self):
         self.open_ai = AsyncOpenAI()
-    
-    async def generate_from_file(self, file_path: str, filename: str):
+        # (content_hash, source) pairs of chunks that duplicate an already stored section
+        self.references = []
+        # content_hash -> signature of the new chunks, added to the deduplicator once they are saved
+        self.pending = {}
+
+    async def generate_from_file(self, file_path: str, filename: str, dedup: ChunkDeduplicator | None = None):
+        from langchain_text_splitters import MarkdownTextSplitter
         content = ""
         list_docs: list[DocSection] = []
         # open the file
@@ -23,15 +32,32 @@ class Embedding:
         with logfire.span('split_file'):
             md_splitter = MarkdownTextSplitter(chunk_size=1000, chunk_overlap=200)
             chunks = md_splitter.split_text(content)
+            # (chunk, content_hash, signature) of the chunks to embed
+            new_chunks: list[tuple[str, str, list[int]]] = []
+            new_signatures: dict[str, list[int]] = {}
             for chunk in chunks:
-                try:
-                    # create embedding for each chunk
-                    embedding = await self.open_ai.embeddings.create(
-                        input=f"{filename} {chunk}",
-                        model='text-embedding-3-small',
-                    )
-                    list_docs.append(DocSection(group="ocbc-doc-tech", title=filename, content=chunk, embedding=embedding.data[0].embedding))
-                except Exception as e:
-                    logfire.error(e)
-            list_docs_dict = [doc.to_dict() for doc in list_docs]
-            return list_docs_dict
\ No newline at end of file
+                chunk_hash = content_hash(chunk)
+                signature = []
+                if dedup is not None:
+                    signature = dedup.signature(chunk)
+                    duplicate_of = dedup.find_duplicate(chunk_hash, signature, new_signatures)
+                    if duplicate_of is not None:
+                        # keep a reference from this file instead of embedding the chunk again
+                        self.references.append((duplicate_of, filename))
+                        continue
+                    new_signatures[chunk_hash] = signature
+                new_chunks.append((chunk, chunk_hash, signature))
+
+            # batched, a local provider runs its batches on all of its threads
+            with logfire.span('embed {count} chunks', count=len(new_chunks)):
+                embeddings = await embed_in_batches(self.open_ai, [f"{filename} {chunk}" for chunk, _, _ in new_chunks])
+            for (chunk, chunk_hash, signature), embedding in zip(new_chunks, embeddings):
+                if embedding is None:
+                    continue
+                list_docs.append(DocSection(group="ocbc-doc-tech", title=filename, content=chunk, embedding=embedding, content_hash=chunk_hash, minhash=signature))
+                if dedup is not None:
+                    self.pending[chunk_hash] = signature
+            logfire.info(f"{len(list_docs)} new chunks, {len(self.references)} duplicates in {filename}")
+            with scope("DocSection.to_dict"):
+                list_docs_dict = [doc.to_dict() for doc in list_docs]
+            return list_docs_dict
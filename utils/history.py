@@ -0,0 +1,101 @@
+import zlib
+
+from sqlalchemy.orm import Session
+from pydantic_ai.messages import (
+    ModelMessage,
+    ModelMessagesTypeAdapter,
+    ModelRequest,
+    ModelResponse,
+    TextPart,
+    UserPromptPart,
+)
+
+from models import Messages, MessageRole, MessageTurns
+from utils.compaction import history_compactor, message_tokens
+from utils.settings import get_settings
+
+def encode_messages(messages: list[ModelMessage]) -> bytes:
+    return zlib.compress(ModelMessagesTypeAdapter.dump_json(messages), 6)
+
+def decode_messages(blob: bytes) -> list[ModelMessage]:
+    return ModelMessagesTypeAdapter.validate_json(zlib.decompress(blob))
+
+def legacy_message(m: Messages) -> ModelMessage:
+    if m.role == MessageRole.USER:
+        return ModelRequest(parts=[UserPromptPart(content=m.message, timestamp=m.created_at)])
+    return ModelResponse(parts=[TextPart(content=m.message)], timestamp=m.created_at)
+
+class HistoryTurn:
+    """One turn of a session, its messages are only decoded when they are sent."""
+    tokens: int
+    def __init__(self, tokens: int, blob: bytes | None = None, messages: list[ModelMessage] | None = None):
+        self.tokens = tokens
+        self.blob = blob
+        self._messages = messages
+
+    def messages(self) -> list[ModelMessage]:
+        if self._messages is None:
+            self._messages = decode_messages(self.blob)
+        return self._messages
+
+def load_turns(db: Session, session_id: str) -> list[HistoryTurn]:
+    """Turns of a session, oldest first.
+
+    Turns stored before full histories were kept only have their text, those are
+    rebuilt from `Messages`, user prompts included, one turn per prompt.
+    """
+    rows = db.query(MessageTurns).filter(MessageTurns.session_id == session_id).order_by(MessageTurns.id.asc()).all()
+    # `save_turn` writes two `Messages` rows per turn, whatever is older than those is legacy
+    total = db.query(Messages).filter(Messages.session_id == session_id).count()
+    legacy_count = max(0, total - 2 * len(rows))
+    legacy = (
+        db.query(Messages)
+        .filter(Messages.session_id == session_id)
+        .order_by(Messages.id.asc())
+        .limit(legacy_count)
+    )
+    grouped: list[list[ModelMessage]] = []
+    for m in (legacy if legacy_count else []):
+        if m.role == MessageRole.USER or not grouped:
+            grouped.append([])
+        grouped[-1].append(legacy_message(m))
+    turns = [HistoryTurn(message_tokens(messages), messages=messages) for messages in grouped]
+    for row in rows:
+        turn = HistoryTurn(row.tokens, row.messages)
+        if row.tokens is None:
+            # saved before tokens were counted, written back with the next commit
+            turn.tokens = row.tokens = message_tokens(turn.messages())
+        turns.append(turn)
+    return turns
+
+def history_budget() -> int:
+    return get_settings().history_token_budget
+
+def load_history(db: Session, session_id: str, budget: int | None = None) -> list[ModelMessage]:
+    """Message history of a session for the next agent run.
+
+    The newest turns that fit in `budget` tokens are sent as they are, older ones are
+    replaced by the session's running summary. A budget of 0 sends the full history.
+    """
+    if budget is None:
+        budget = history_budget()
+    turns = load_turns(db, session_id)
+    history = []
+    start = 0
+    if budget > 0 and turns:
+        summary, start = history_compactor.compact(db, session_id, [turn.tokens for turn in turns], budget)
+        if summary is not None:
+            history.append(summary)
+    for turn in turns[start:]:
+        history.extend(turn.messages())
+    # hand the connection back to the pool while the model runs, `save_turn` checks out
+    # another one, otherwise a burst of chats exhausts the pool and blocks the event loop
+    db.commit()
+    return history
+
+def save_turn(db: Session, session_id: str, prompt: str, answer: str, new_messages: list[ModelMessage]):
+    """Store the prompt and answer shown in the chat and the run's full message sequence."""
+    db.add(Messages(role=MessageRole.USER, session_id=session_id, message=prompt))
+    db.add(Messages(role=MessageRole.AI, session_id=session_id, message=answer))
+    db.add(MessageTurns(session_id=session_id, messages=encode_messages(new_messages), tokens=message_tokens(new_messages)))
+    db.commit()
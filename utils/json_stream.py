@@ -0,0 +1,73 @@
+import json
+import codecs
+import asyncio
+
+from typing import AsyncIterable, AsyncIterator
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+_DELIMITERS = _WHITESPACE + ",]"
+
+async def iter_json_array(chunks: AsyncIterable[bytes]) -> AsyncIterator[object]:
+    """Yield the items of a top-level JSON array as its bytes arrive.
+
+    Only the current item is kept in memory, so a corpus of any size is parsed with
+    memory bounded by the largest single item.
+    """
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    position = 0
+    started = False
+    finished = False
+    eof = False
+    iterator = chunks.__aiter__()
+
+    while not finished:
+        # skip whitespace and separators up to the next item
+        while position < len(buffer) and buffer[position] in _WHITESPACE:
+            position += 1
+        if position < len(buffer):
+            char = buffer[position]
+            if not started:
+                if char != "[":
+                    raise ValueError(f"Expected a JSON array, got {char!r}")
+                started = True
+                position += 1
+                continue
+            if char == "]":
+                finished = True
+                continue
+            if char == ",":
+                position += 1
+                continue
+            try:
+                item, end = _decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                # a number may still be missing digits, a fraction or an exponent until the
+                # separator after it has arrived, "1" and "1." both decode as 1
+                if eof or (end < len(buffer) and buffer[end] in _DELIMITERS):
+                    yield item
+                    position = end
+                    continue
+        if eof:
+            raise ValueError("Unexpected end of JSON array")
+        try:
+            chunk = await iterator.__anext__()
+        except StopAsyncIteration:
+            eof = True
+            buffer += text_decoder.decode(b"", final=True)
+            continue
+        buffer = buffer[position:] + text_decoder.decode(chunk)
+        position = 0
+
+async def iter_file(path: str, chunk_size: int = 64 * 1024) -> AsyncIterator[bytes]:
+    """Read a file in chunks off the event loop."""
+    f = await asyncio.to_thread(open, path, "rb")
+    try:
+        while chunk := await asyncio.to_thread(f.read, chunk_size):
+            yield chunk
+    finally:
+        f.close()
@@ -0,0 +1,219 @@
+"""On-demand sampled profiling.
+
+A profile is started for one request (`X-Profile` header carrying `PROFILE_TOKEN`) or
+for a share of consumer messages (`PROFILE_CONSUMER_RATE`). Hot paths mark themselves
+with `scope(name)`, while a profile is active in the current context every scope it
+enters registers its frame, and a sampler thread reads the stacks of the running
+threads every `PROFILE_INTERVAL_MS`. A sample counts for the innermost scope whose
+frame is on the stack, so on the event loop only the profiled request's own work is
+recorded, not the requests it is interleaved with. Tasks the request starts, a
+prefetch or a streamed body, run outside its frames, while profiling a task factory on
+the event loop watches the coroutine frame of every task created in a profiled context.
+
+Profiles are written to `PROFILE_DIR` in the collapsed stack format, one
+`scope;frame;frame count` line per stack, as read by flamegraph.pl, speedscope and
+inferno. Without an active profile `scope` is a single context variable lookup and
+no sampler thread runs.
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import logging
+import threading
+import contextvars
+
+from collections import Counter
+from contextlib import nullcontext
+from pathlib import Path
+
+from utils.settings import get_settings
+
+PROFILE_DIR = Path("./profiles")
+PROFILE_HEADER = b"x-profile"
+
+class Profile:
+    name: str
+    path: Path
+    def __init__(self, name: str, directory: Path = PROFILE_DIR):
+        self.name = name
+        # set once written, tasks that outlive the profile aren't counted any more
+        self.finished = False
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        safe = "".join(char if char.isalnum() else "-" for char in name).strip("-")
+        self.path = directory / f"{stamp}-{safe}-{os.getpid()}-{random.randrange(16**6):06x}.folded"
+        self.stacks: Counter[str] = Counter()
+        self.samples = 0
+
+    def write(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+class Watch:
+    """A scope entered while profiling, samples are counted from `frame` down."""
+    def __init__(self, profile: Profile, name: str, thread_id: int, frame):
+        self.profile = profile
+        self.name = name
+        self.thread_id = thread_id
+        self.frame = frame
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_qualname} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+
+class Sampler:
+    """One thread for the process, running only while scopes are watched."""
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.watches: dict[int, Watch] = {}
+        self.thread: threading.Thread | None = None
+
+    def add(self, watch: Watch):
+        with self.lock:
+            self.watches[id(watch.frame)] = watch
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="profiling-sampler", daemon=True)
+                self.thread.start()
+
+    def remove(self, watch: Watch):
+        with self.lock:
+            if self.watches.get(id(watch.frame)) is watch:
+                del self.watches[id(watch.frame)]
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.watches:
+                    self.thread = None
+                    return
+                watches = dict(self.watches)
+            thread_ids = {watch.thread_id for watch in watches.values()}
+            frames = sys._current_frames()
+            for thread_id in thread_ids:
+                self.sample(frames.get(thread_id), watches)
+
+    def sample(self, frame, watches: dict[int, Watch]):
+        labels = []
+        while frame is not None:
+            watch = watches.get(id(frame))
+            if watch is not None and watch.frame is frame:
+                if watch.profile.finished:
+                    return
+                labels.append(frame_label(frame))
+                labels.append(watch.name)
+                watch.profile.stacks[";".join(reversed(labels))] += 1
+                watch.profile.samples += 1
+                return
+            labels.append(frame_label(frame))
+            frame = frame.f_back
+
+def profile_interval() -> float:
+    return get_settings().profile_interval_ms / 1000
+
+sampler = Sampler(profile_interval())
+active_profile: contextvars.ContextVar[Profile | None] = contextvars.ContextVar("active_profile", default=None)
+
+class _Scope:
+    def __init__(self, profile: Profile, name: str):
+        self.profile = profile
+        self.name = name
+        self.watch: Watch | None = None
+
+    def __enter__(self):
+        # the frame of the code that entered the scope
+        self.watch = Watch(self.profile, self.name, threading.get_ident(), sys._getframe(1))
+        sampler.add(self.watch)
+
+    def __exit__(self, *exc):
+        sampler.remove(self.watch)
+        self.watch = None
+
+def watch_tasks(loop: asyncio.AbstractEventLoop):
+    """Watch the tasks created on `loop` in a profiled context, installed once per loop."""
+    previous = loop.get_task_factory()
+    if getattr(previous, "watches_tasks", False):
+        return
+
+    def factory(loop, coro, **kwargs):
+        task = previous(loop, coro, **kwargs) if previous is not None else asyncio.Task(coro, loop=loop, **kwargs)
+        context = kwargs.get("context")
+        profile = context.get(active_profile) if context is not None else active_profile.get()
+        frame = getattr(coro, "cr_frame", None)
+        if profile is not None and frame is not None and not task.done():
+            watch = Watch(profile, profile.name, threading.get_ident(), frame)
+            sampler.add(watch)
+            task.add_done_callback(lambda _: sampler.remove(watch))
+        return task
+
+    factory.watches_tasks = True
+    loop.set_task_factory(factory)
+
+def scope(name: str):
+    """Mark a hot path, sampled only when the current request or message is being profiled."""
+    profile = active_profile.get()
+    if profile is None:
+        return nullcontext()
+    return _Scope(profile, name)
+
+class _Profiled:
+    def __init__(self, name: str):
+        self.profile = Profile(name)
+        self.token: contextvars.Token | None = None
+        self.watch: Watch | None = None
+
+    def __enter__(self) -> Profile:
+        self.token = active_profile.set(self.profile)
+        # the frame of the `with` block, what runs under it is on the stack above that frame
+        self.watch = Watch(self.profile, self.profile.name, threading.get_ident(), sys._getframe(1))
+        sampler.add(self.watch)
+        try:
+            watch_tasks(asyncio.get_running_loop())
+        except RuntimeError:
+            # no event loop, e.g. a consumer message, no tasks to watch either
+            pass
+        return self.profile
+
+    def __exit__(self, *exc):
+        sampler.remove(self.watch)
+        active_profile.reset(self.token)
+        profile = self.profile
+        profile.finished = True
+        try:
+            profile.write()
+            logging.info("Profile of %s written to %s (%d samples)", profile.name, profile.path, profile.samples)
+        except OSError as e:
+            logging.error("Could not write the profile of %s: %s", profile.name, e)
+
+def profiled(name: str) -> _Profiled:
+    """Profile everything under this block, written out when it ends."""
+    return _Profiled(name)
+
+def maybe_profiled(name: str, rate: float | None = None):
+    """Profile a `rate` share of calls, `PROFILE_CONSUMER_RATE` by default."""
+    if rate is None:
+        rate = get_settings().profile_consumer_rate
+    if rate <= 0 or random.random() >= rate:
+        return nullcontext()
+    return profiled(name)
+
+class ProfilingMiddleware:
+    """Profiles the requests that send `X-Profile: <PROFILE_TOKEN>`, answering with the profile path."""
+    def __init__(self, app, token: str):
+        self.app = app
+        self.token = token.encode()
+
+    async def __call__(self, scope_, receive, send):
+        if scope_["type"] != "http" or dict(scope_["headers"]).get(PROFILE_HEADER) != self.token:
+            await self.app(scope_, receive, send)
+            return
+        with profiled(f'{scope_["method"]} {scope_["path"]}') as profile:
+            async def send_with_path(message):
+                if message["type"] == "http.response.start":
+                    message["headers"] = [*message.get("headers", []), (b"x-profile-path", str(profile.path).encode())]
+                await send(message)
+            await self.app(scope_, receive, send_with_path)
@@ -0,0 +1,151 @@
+import re
+import json
+import hashlib
+
+from array import array
+from typing import Callable
+
+from utils.shared_cache import shared_store
+from utils.embedders import embedding_provider
+from utils.settings import Settings, get_settings, on_reload
+
+# limit of sections one `retrieve_many` call returns after merging
+MAX_MERGED_SECTIONS = 30
+
+async def embed_queries(openai, queries: list[str]) -> list[list[float]]:
+    """Embed several search queries, the ones not in the embedding cache with one batched request."""
+    embedder = embedding_provider()
+    # the same text has another vector with another provider or size
+    space = f"{embedder.name}:{embedder.dimensions}"
+    embeddings = [embedding_cache.get(space, query) for query in queries]
+    missing = list(dict.fromkeys(query for query, embedding in zip(queries, embeddings) if embedding is None))
+    if not missing:
+        return embeddings
+    vectors = await embedder.embed(missing, openai)
+    created = dict(zip(missing, (vector.tolist() for vector in vectors)))
+    for query, vector in created.items():
+        embedding_cache.put(space, query, vector)
+    return [embedding if embedding is not None else created[query] for query, embedding in zip(queries, embeddings)]
+
+def merge_results(
+    result_lists: list[list[dict]],
+    key: Callable[[dict], object] = lambda row: (row["title"], row["content"]),
+    limit: int = MAX_MERGED_SECTIONS,
+) -> list[dict]:
+    """Merge ranked result lists with reciprocal rank fusion, dropping duplicates."""
+    scores: dict[object, float] = {}
+    rows: dict[object, dict] = {}
+    for results in result_lists:
+        for rank, row in enumerate(results):
+            row_key = key(row)
+            scores[row_key] = scores.get(row_key, 0.0) + 1.0 / (60 + rank)
+            rows.setdefault(row_key, row)
+    ordered = sorted(scores, key=lambda row_key: scores[row_key], reverse=True)
+    return [rows[row_key] for row_key in ordered[:limit]]
+
+def normalize_query(query: str) -> str:
+    return re.sub(r"\s+", " ", query).strip(" ?.!").lower()
+
+def cache_key(*parts: str | None) -> str:
+    return hashlib.sha1("\x00".join(part or "" for part in parts).encode("utf-8")).hexdigest()
+
+class CacheCounters:
+    """Hits and misses of this process, the entries themselves are in the shared store."""
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def count(self, hit: bool):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else None}
+
+class EmbeddingCache(CacheCounters):
+    """Query embeddings as float32 bytes, keyed by model and text. A `ttl` of 0 turns it off."""
+    def __init__(self, ttl: float = 7 * 24 * 3600.0):
+        super().__init__()
+        self.ttl = ttl
+
+    def get(self, model: str, text: str) -> list[float] | None:
+        if self.ttl <= 0:
+            return None
+        value = shared_store().get(f"emb:{cache_key(model, text)}")
+        self.count(value is not None)
+        return array("f", value).tolist() if value is not None else None
+
+    def put(self, model: str, text: str, embedding: list[float]):
+        if self.ttl > 0:
+            shared_store().set(f"emb:{cache_key(model, text)}", array("f", embedding).tobytes(), self.ttl)
+
+class RetrievalCache(CacheCounters):
+    """Sections found for a search, shared by every session and worker.
+
+    Keyed by the normalised search query, group, limit and embedding space, and by the
+    corpus version read before the search (`databases.corpus_version`). A write to the
+    sections bumps the version, entries of the earlier contents are never found again
+    and expire with their TTL. `kind` tells apart the row formats of the agents. A `ttl`
+    of 0 turns it off.
+    """
+    def __init__(self, ttl: float = 3600.0):
+        super().__init__()
+        self.ttl = ttl
+
+    def key(self, version: str, kind: str, query: str, group: str | None, limit: int) -> str:
+        embedder = embedding_provider()
+        space = f"{embedder.name}:{embedder.dimensions}"
+        return f"ret:{cache_key(version, kind, space, normalize_query(query), group, str(limit))}"
+
+    def get(self, version: str, kind: str, query: str, group: str | None = None, limit: int = 20) -> list[dict] | None:
+        if self.ttl <= 0:
+            return None
+        value = shared_store().get(self.key(version, kind, query, group, limit))
+        self.count(value is not None)
+        return json.loads(value) if value is not None else None
+
+    def put(self, version: str, kind: str, query: str, group: str | None, rows: list[dict], limit: int = 20):
+        if self.ttl > 0:
+            shared_store().set(self.key(version, kind, query, group, limit), json.dumps(rows).encode("utf-8"), self.ttl)
+
+class AnswerCache(CacheCounters):
+    """Answers to stateless questions, keyed by the normalised question and group.
+
+    Like the retrieval cache keyed by the corpus version read before the answer was
+    generated, an answer built on sections since re-indexed is not served again.
+    """
+    def __init__(self, ttl: float = 900.0):
+        super().__init__()
+        self.ttl = ttl
+
+    def get(self, version: str, question: str, group: str | None = None) -> dict | None:
+        if self.ttl <= 0:
+            return None
+        value = shared_store().get(f"ans:{cache_key(version, normalize_query(question), group)}")
+        self.count(value is not None)
+        return json.loads(value) if value is not None else None
+
+    def put(self, version: str, question: str, group: str | None, answer: dict):
+        if self.ttl > 0:
+            shared_store().set(f"ans:{cache_key(version, normalize_query(question), group)}", json.dumps(answer).encode("utf-8"), self.ttl)
+
+def cache_stats() -> dict:
+    return {
+        "store": shared_store().stats(),
+        "embeddings": embedding_cache.stats(),
+        "retrieval": retrieval_cache.stats(),
+        "answers": answer_cache.stats(),
+    }
+
+embedding_cache = EmbeddingCache()
+retrieval_cache = RetrievalCache(get_settings().retrieval_cache_ttl)
+answer_cache = AnswerCache(get_settings().answer_cache_ttl)
+
+def _apply_settings(settings: Settings):
+    retrieval_cache.ttl = settings.retrieval_cache_ttl
+    answer_cache.ttl = settings.answer_cache_ttl
+
+on_reload(_apply_settings)
@@ -0,0 +1,99 @@
+"""Typed settings, read from `.env` once instead of on every call.
+
+`get_settings()` returns the current `Settings`, parsed on first use. `reload_settings()`
+parses `.env` again and swaps the whole object, the API and the consumer call it on
+SIGHUP. A request holding a `Settings` keeps seeing consistent values, the next one
+gets the new ones. Empty values count as unset, as `get_key(...) or default` did.
+
+Settings read per request or per message take effect on reload: `MONGO_URI`,
+`EAGER_RETRIEVAL`, `HISTORY_TOKEN_BUDGET`, `BATCH_ASK_CONCURRENCY`, the models, the
+admission limits, the cache TTLs, the embedding provider and the consumer's lane
+weight. Connections, middleware, `WORKERS` and `PORT` are set up at startup and need
+a restart.
+"""
+import logging
+
+from typing import Callable
+from dotenv import dotenv_values
+from pydantic import BaseModel, ConfigDict, ValidationError
+
+ENV_FILE = ".env"
+
+class Settings(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="ignore", alias_generator=str.upper, populate_by_name=True)
+
+    port: int = 8000
+    workers: int = 1
+    ready_checks: str = "rabbitmq,mongo,openai"
+    shared_cache_url: str = ""
+    retrieval_cache_ttl: float = 3600.0
+    answer_cache_ttl: float = 900.0
+    logfire_key: str | None = None
+    openai_base_url: str = "https://api.openai.com/v1"
+    docs_json: str = ""
+    mongo_uri: str | None = None
+    mongo_manage_indexes: bool = False
+    eager_retrieval: bool = True
+    history_token_budget: int = 4000
+    batch_ask_concurrency: int = 8
+    model_strong: str = "openai:gpt-4o"
+    model_fast: str = "openai:gpt-4o-mini"
+    model_strong_backup: str | None = None
+    model_fast_backup: str | None = None
+    model_simple_max_words: int = 30
+    embedding_provider: str = "openai:text-embedding-3-small"
+    embedding_batch_size: int = 32
+    embedding_workers: int | None = None
+    frontend_build_on_startup: bool = False
+    capture_traffic: bool = False
+    capture_dir: str = "./captures"
+    capture_max_mb: int = 50
+    consumer_interactive_weight: int = 4
+    profile_token: str = ""
+    profile_consumer_rate: float = 0.0
+    profile_interval_ms: float = 5.0
+    rabbit_host: str = "localhost"
+    rabbit_port: int = 5672
+    rabbit_user: str = "guest"
+    rabbit_pass: str = "guest"
+    # ADMISSION_<NAME>_CONCURRENCY / _QUEUE / _QUEUE_TIMEOUT, keyed by the lower case rest of the name
+    admission: dict[str, float] = {}
+
+def load_settings(path: str = ENV_FILE) -> Settings:
+    values = {key: value for key, value in dotenv_values(path).items() if value not in (None, "")}
+    admission = {
+        key.removeprefix("ADMISSION_").lower(): value
+        for key, value in values.items()
+        if key.startswith("ADMISSION_")
+    }
+    return Settings.model_validate({**values, "ADMISSION": admission})
+
+_settings: Settings | None = None
+_listeners: list[Callable[[Settings], None]] = []
+
+def get_settings() -> Settings:
+    global _settings
+    if _settings is None:
+        _settings = load_settings()
+    return _settings
+
+def on_reload(listener: Callable[[Settings], None]):
+    """Call `listener` with the new settings after every reload, for state built from them."""
+    _listeners.append(listener)
+
+def reload_settings() -> bool:
+    """Parse `.env` again, an invalid file keeps the current settings."""
+    global _settings
+    try:
+        settings = load_settings()
+    except (OSError, ValidationError) as e:
+        logging.error("Settings not reloaded, %s is invalid: %s", ENV_FILE, e)
+        return False
+    _settings = settings
+    for listener in _listeners:
+        try:
+            listener(settings)
+        except Exception as e:
+            logging.error("Applying reloaded settings failed in %s: %s", getattr(listener, "__qualname__", listener), e)
+    logging.info("Settings reloaded from %s", ENV_FILE)
+    return True
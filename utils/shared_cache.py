@@ -0,0 +1,159 @@
+"""Key-value store behind the embedding, retrieval and answer caches.
+
+With several workers an in-process cache splits its hits across them, each worker
+embedding and searching the same queries again. `SHARED_CACHE_URL` picks where the
+entries live:
+
+- `memory://`, a dict in the process, the default with a single worker
+- `sqlite:///path`, a WAL mode SQLite file every worker on the host opens, the
+  default with `WORKERS` above 1 and the local stand-in for Redis
+- `redis://host:port/db`, needs the `redis` package
+
+Values are bytes with a time to live. Lookups are point reads on the primary key, a
+fraction of a millisecond for the SQLite file, so they are made inline.
+"""
+import os
+import time
+import sqlite3
+import threading
+
+from collections import OrderedDict
+from pathlib import Path
+
+from utils.settings import get_settings
+
+DEFAULT_SQLITE_PATH = "./.cache/shared.db"
+
+class MemoryStore:
+    def __init__(self, max_entries: int = 100_000):
+        self.max_entries = max_entries
+        self.entries: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+
+    def get(self, key: str) -> bytes | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: bytes, ttl: float):
+        self.entries[key] = (time.time() + ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def delete_prefix(self, prefix: str):
+        for key in [key for key in self.entries if key.startswith(prefix)]:
+            del self.entries[key]
+
+    def stats(self) -> dict:
+        return {"backend": "memory", "entries": len(self.entries)}
+
+class SQLiteStore:
+    """Shared by the processes that open the same file, one connection per thread."""
+    def __init__(self, path: str = DEFAULT_SQLITE_PATH, max_entries: int = 1_000_000, purge_every: int = 1000):
+        self.path = path
+        self.max_entries = max_entries
+        self.purge_every = purge_every
+        self.local = threading.local()
+        self.writes = 0
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with self.connection() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)")
+
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        # a connection opened before a fork is never used in the child
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    def get(self, key: str) -> bytes | None:
+        row = self.connection().execute("SELECT value FROM cache WHERE key = ? AND expires >= ?", (key, time.time())).fetchone()
+        return row[0] if row is not None else None
+
+    def set(self, key: str, value: bytes, ttl: float):
+        connection = self.connection()
+        connection.execute("INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)", (key, value, time.time() + ttl))
+        self.writes += 1
+        if self.writes % self.purge_every == 0:
+            self.purge(connection)
+
+    def purge(self, connection: sqlite3.Connection):
+        connection.execute("DELETE FROM cache WHERE expires < ?", (time.time(),))
+        (count,) = connection.execute("SELECT COUNT(*) FROM cache").fetchone()
+        if count > self.max_entries:
+            # the entries closest to expiring go first
+            connection.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY expires LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def delete_prefix(self, prefix: str):
+        self.connection().execute("DELETE FROM cache WHERE key >= ? AND key < ?", (prefix, prefix + "\uffff"))
+
+    def stats(self) -> dict:
+        (count,) = self.connection().execute("SELECT COUNT(*) FROM cache").fetchone()
+        return {"backend": "sqlite", "path": self.path, "entries": count}
+
+class RedisStore:
+    def __init__(self, url: str):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("SHARED_CACHE_URL is a redis:// URL, install the `redis` package")
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key: str) -> bytes | None:
+        return self.client.get(key)
+
+    def set(self, key: str, value: bytes, ttl: float):
+        self.client.set(key, value, ex=max(1, int(ttl)))
+
+    def delete_prefix(self, prefix: str):
+        keys = list(self.client.scan_iter(match=f"{prefix}*", count=500))
+        if keys:
+            self.client.delete(*keys)
+
+    def stats(self) -> dict:
+        return {"backend": "redis", "entries": self.client.dbsize()}
+
+def open_store(url: str) -> MemoryStore | SQLiteStore | RedisStore:
+    if url.startswith("sqlite:///"):
+        return SQLiteStore(url.removeprefix("sqlite:///"))
+    if url.startswith(("redis://", "rediss://")):
+        return RedisStore(url)
+    if url in ("", "memory://"):
+        return MemoryStore()
+    raise ValueError(f"Unsupported SHARED_CACHE_URL {url!r}")
+
+def configured_workers() -> int:
+    return get_settings().workers
+
+_store = None
+
+def shared_store() -> MemoryStore | SQLiteStore | RedisStore:
+    """The store of this process, opened on first use so every worker opens its own."""
+    global _store
+    if _store is None:
+        url = get_settings().shared_cache_url
+        if not url:
+            url = f"sqlite:///{DEFAULT_SQLITE_PATH}" if configured_workers() > 1 else "memory://"
+        _store = open_store(url)
+    return _store
+
+def _forget_store():
+    global _store
+    _store = None
+
+# a store inherited through fork would share the parent's sockets and locks
+os.register_at_fork(after_in_child=_forget_store)
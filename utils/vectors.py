@@ -0,0 +1,39 @@
+import sys
+import base64
+
+from array import array
+from typing import Iterable
+
+from bson.binary import Binary, VECTOR_SUBTYPE
+
+# BSON vector header: dtype byte (float32) and the padding byte, followed by little-endian floats
+FLOAT32_HEADER = bytes([0x27, 0])
+
+def to_float32(values: Iterable[float] | array) -> array:
+    if isinstance(values, array) and values.typecode == "f":
+        return values
+    return array("f", values)
+
+def _little_endian(vector: array) -> array:
+    if sys.byteorder == "big":
+        vector = array("f", vector)
+        vector.byteswap()
+    return vector
+
+def decode_base64(data: str) -> array:
+    """Decode an OpenAI `base64` embedding (little-endian float32) without building floats."""
+    return _little_endian(array("f", base64.b64decode(data)))
+
+def to_bson_vector(vector: array) -> Binary:
+    """Float32 BSON vector, stored by Mongo and indexed by Atlas Vector Search as is."""
+    return Binary(FLOAT32_HEADER + _little_endian(vector).tobytes(), VECTOR_SUBTYPE)
+
+def as_floats(value) -> array | list[float]:
+    """Vector as stored, a BSON vector, a float32 array or a plain list, as something indexable."""
+    if isinstance(value, Binary) and value.subtype == VECTOR_SUBTYPE:
+        return _little_endian(array("f", bytes(value[2:])))
+    return value
+
+def vector_literal(vector: array | list[float]) -> str:
+    """pgvector text form of a vector."""
+    return "[" + ",".join(map(repr, vector)) + "]"